@@ -15,6 +15,7 @@ structure = [
     'scenario_1.py',
     'scenario_2.py',
     'clean_db.py',
+    'split_groups.py',
     'src',
     #'.cpan',
     'test_input',
@@ -1,11 +1,10 @@
 #!/usr/bin/env python
-from shutil import move, copy
+from shutil import move, copyfile
 import sys
 import logging
 from os import chdir, mkdir, getcwd, listdir, makedirs
 from os.path import join, exists, isdir, isfile, dirname, realpath, \
     basename, relpath, splitext, abspath, expanduser
-from Bio import SeqIO
 
 from src.fetch_annotations import fetch_annotations_for_species_from_ftp, \
     fetch_annotations_for_ids, fetch_annotations_species_name_entrez
@@ -16,7 +15,8 @@ from src.argparse import ArgumentParser
 
 from src.utils import make_workflow_id, read_list, set_up_config, \
     get_starting_step, interrupt, register_ctrl_c, \
-    test_entrez_conn, test_blast_conn, test_ftp_conn, check_and_install_tools
+    test_entrez_conn, test_blast_conn, test_ftp_conn, check_and_install_tools, \
+    is_fasta, is_genbank
 
 from src.parse_args import arg_parse_error, check_file, check_dir, \
     add_common_arguments, check_common_args
@@ -24,6 +24,7 @@ from src.logger import set_up_logging
 from src.Workflow import Workflow, Step
 
 from src import config
+from src import run_report
 
 from src.config import log_fname
 log = logging.getLogger(log_fname)
@@ -138,23 +139,17 @@ def collect_proteomes_and_annotaitons(input_dir):
 
     for f in (join(input_dir, f) for f in files if isfile(join(input_dir, f))):
         if '.' in f and splitext(f)[1] in ['.fasta', '.faa', '.fa', '.fsa']:
-            try:
-                log.debug('   Checking if %s is fasta.' % f)
-                next(SeqIO.parse(f, 'fasta'))
-            except ValueError, e:
-                pass
-            else:
+            log.debug('   Checking if %s is fasta.' % f)
+            if is_fasta(f):
                 proteomes.append(f)
                 continue
 
         if '.' in f and splitext(f)[1] in ['.gb', '.genbank', '.gbk']:
-            try:
-                log.debug('   Checking if %s is genbank.' % f)
-                SeqIO.read(f, 'genbank')
-            except Exception, e:
-                log.debug(str(e) + ', ' + f)
-            else:
+            log.debug('   Checking if %s is genbank.' % f)
+            if is_genbank(f):
                 annotations.append(f)
+            else:
+                log.debug('No LOCUS line in ' + f)
 
     log.debug('')
     return proteomes, annotations
@@ -172,7 +167,7 @@ def step_prepare_proteomes_and_annotations(p):
             log.debug('species_list: ' + str(gb_ids))
             res = fetch_annotations_species_name_entrez(config.annotations_dir, gb_ids, p.proxy)
             if res != 0: return res
-            return make_proteomes(config.annotations_dir, config.proteomes_dir)
+            return make_proteomes(config.annotations_dir, config.proteomes_dir, int(p.threads) or None)
 
         elif p.ids_list:
             if not test_entrez_conn():
@@ -183,7 +178,7 @@ def step_prepare_proteomes_and_annotations(p):
             ref_ids = read_list(p.ids_list)
             res = fetch_annotations_for_ids(config.annotations_dir, ref_ids)
             if res != 0: return res
-            return make_proteomes(config.annotations_dir, config.proteomes_dir)
+            return make_proteomes(config.annotations_dir, config.proteomes_dir, int(p.threads) or None)
 
         else:
             proteomes, annotations = [], []
@@ -209,9 +204,9 @@ def step_prepare_proteomes_and_annotations(p):
                     mkdir(config.annotations_dir)
 
                 for annotation in annotations:
-                    copy(annotation, config.annotations_dir)
+                    copyfile(annotation, join(config.annotations_dir, basename(annotation)))
 
-                return make_proteomes(config.annotations_dir, config.proteomes_dir)
+                return make_proteomes(config.annotations_dir, config.proteomes_dir, int(p.threads) or None)
 
             elif proteomes:
                 if not isdir(config.proteomes_dir):
@@ -242,7 +237,9 @@ def step_prepare_proteomes_and_annotations(p):
     return Step(
         'Preparing proteomes and annotations',
         run=run,
-        prod_files=[config.proteomes_dir, config.annotations_dir])
+        req_files=filter(None, [p.species_list, p.ids_list, p.proteomes, p.annotations]),
+        prod_files=[config.proteomes_dir, config.annotations_dir],
+        params=dict(prot_id_field=p.prot_id_field, download_anno=p.download_anno))
 
 
 def main(args):
@@ -257,11 +254,7 @@ def main(args):
     try:
         working_dir = p.out
 
-        with open(config.config_file) as f:
-            conf = dict(l.strip().lower().split('=', 1)
-                        for l in f.readlines() if l.strip() and l.strip()[0] != '#')
-
-        check_and_install_tools(p.debug, conf.get('db_vendor', 'sqlite') == 'sqlite', log_path)
+        check_and_install_tools(p.debug, p.settings.db_vendor == 'sqlite', log_path)
 
         start_from, start_after = get_starting_step(p.start_from, join(p.out, log_fname))
 
@@ -274,15 +267,15 @@ def main(args):
         if not exists(config.intermediate_dir):
             mkdir(config.intermediate_dir)
 
-        set_up_config(working_dir)
+        set_up_config(working_dir, p.settings)
 
         # Building the workflow
         workflow = Workflow(working_dir, id=make_workflow_id(working_dir),
-                            cmdline_args=['python', __file__] + args)
+                            cmdline_args=['python', __file__] + args, settings=p.settings)
         log.debug('Workflow id is "' + workflow.id + '"')
         log.debug('')
 
-        suffix = '' if conf.get('db_vendor', 'sqlite') == 'sqlite' else '_' + workflow.id
+        suffix = '' if p.settings.db_vendor == 'sqlite' else '_' + workflow.id
 
         njobs = p.threads or p.jobs or 30
 
@@ -290,30 +283,32 @@ def main(args):
             step_prepare_proteomes_and_annotations(p),
             steps.filter_proteomes(
                 min_length=int(p.min_length),
-                max_percent_stop=int(p.max_percent_stop)),
+                max_percent_stop=int(p.max_percent_stop),
+                threads=int(p.threads) or None),
             steps.make_blast_db(),
             steps.blast(
                 workflow.id,
                 int(p.threads) or int(p.jobs) or 30,
                 on_cluster=njobs and not p.threads,
-                evalue=float(p.evalue)),
-            steps.parse_blast_results(),
-            steps.clean_database(suffix),
-            steps.install_schema(suffix),
-            steps.load_blast_results(suffix),
-            steps.find_pairs(suffix),
-            steps.dump_pairs_to_files(suffix),
+                evalue=float(p.evalue),
+                threads_per_worker=int(p.threads_per_blast)),
+            steps.parse_blast_results(int(p.threads) or None)] +
+            steps.pairs_steps(p.pairs_engine, suffix) + [
             steps.mcl(p.debug),
-            steps.step_save_orthogroups()])
+            steps.step_save_orthogroups(save_db=p.save_db, threads=int(p.threads) or None)])
 
         result = workflow.run(
             start_after, start_from,
             overwrite=True,
-            ask_before=p.ask_each_step)
+            ask_before=p.ask_each_step,
+            max_workers=int(p.step_workers),
+            use_cache=p.use_cache)
 
         if result == 0:
             log.info('Done.')
             log.info('Log is in ' + join(working_dir, log_fname))
+            log.info('Run report (time, memory and I/O per step) is in ' +
+                     join(working_dir, run_report.report_tsv_fname))
             if isfile(join(working_dir, config.orthogroups_file)):
                 log.info('Groups are in ' + join(working_dir, config.orthogroups_file))
                 if isfile(config.nice_orthogroups_file):
@@ -322,6 +317,8 @@ def main(args):
             else:
                 log.info('Groups in short format are in ' +
                          join(working_dir, config.short_orthogroups_file))
+            if p.save_db and isfile(config.orthogroups_db):
+                log.info('Groups are also in the database ' + join(working_dir, config.orthogroups_db))
 
             if isfile(log_fname):
                 with open(log_fname, 'a') as f:
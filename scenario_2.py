@@ -14,6 +14,7 @@ from Bio import SeqIO
 from src.fetch_annotations import fetch_annotations_for_ids
 from src.process_assembly import filter_assembly
 from src.make_proteomes import adjust_proteomes, make_proteomes
+from src.filter_proteomes import filter_proteomes
 from src import steps
 from src.utils import which, make_workflow_id, read_list, \
     set_up_config, get_starting_step, register_ctrl_c, \
@@ -24,8 +25,9 @@ from src.parse_args import arg_parse_error, check_file,\
 from src.logger import set_up_logging, add_file_handler
 from src.Workflow import Workflow, Step, cmdline
 from src import config
+from src import run_report
 from src.singletones import step_blast_singletones, new_proteomes_dir
-from src.config import log_fname, config_file
+from src.config import log_fname
 log = logging.getLogger(log_fname)
 
 script_path = dirname(realpath(__file__))
@@ -253,7 +255,9 @@ def step_prepare_input(p):
 
         return Step(
            'Preparing input',
-            run=run)
+            run=run,
+            req_files=[p.assemblies],
+            params=dict(assemblies=p.assemblies))
 
     elif p.proteomes:
         def run(start_from_here=False):
@@ -288,7 +292,9 @@ def step_prepare_input(p):
 
         return Step(
            'Preparing input',
-            run=run)
+            run=run,
+            req_files=[p.proteomes],
+            params=dict(proteomes=p.proteomes, prot_id_field=p.prot_id_field))
 
     elif p.ids_list:
         def run(start_from_here=False):
@@ -302,11 +308,16 @@ def step_prepare_input(p):
             ref_ids = read_list(p.ids_list)
             res = fetch_annotations_for_ids(new_annotations_dir, ref_ids)
             if res != 0: return res
-            res = make_proteomes(new_annotations_dir, new_proteomes_dir)
+            res = make_proteomes(new_annotations_dir, new_proteomes_dir, int(p.threads) or None)
             if res != 0: return res
             for fname in listdir(new_annotations_dir):
                 if fname[0] != '.':
-                    copy(join(new_annotations_dir, fname), config.annotations_dir)
+                    # linked from the annotation cache, so read-only: copying
+                    # the mode would make the next run fail to overwrite them
+                    annotation = join(config.annotations_dir, fname)
+                    if isfile(annotation):
+                        remove(annotation)
+                    copyfile(join(new_annotations_dir, fname), annotation)
             for fname in listdir(new_proteomes_dir):
                 if fname[0] != '.':
                     copy(join(new_proteomes_dir, fname), config.proteomes_dir)
@@ -315,22 +326,20 @@ def step_prepare_input(p):
 
         return Step(
            'Preparing input',
-            run=run)
+            run=run,
+            req_files=[p.ids_list],
+            params=dict(ids_list=p.ids_list))
 
 
 new_good_proteomes = join(config.intermediate_dir, 'new_good_proteins.fasta')
 new_bad_proteomes = join(config.intermediate_dir, 'new_bad_proteins.fasta')
 
 
-def filter_new_proteomes(new_proteomes_dir, min_length=10, max_percent_stop=20):
+def filter_new_proteomes(new_proteomes_dir, min_length=10, max_percent_stop=20, threads=None):
     def run(start_from_here=False):
-        return cmdline(
-            join(steps.orthomcl_bin_dir, 'orthomclFilterFasta.pl'),
-            parameters=[
-                new_proteomes_dir,
-                min_length, max_percent_stop,
-                new_good_proteomes,
-                new_bad_proteomes])
+        stats = filter_proteomes(new_proteomes_dir, min_length, max_percent_stop,
+                                 new_good_proteomes, new_bad_proteomes, threads)
+        return 0 if stats is not None else 1
 
     return Step(
        'Filtering new proteomes',
@@ -338,7 +347,8 @@ def filter_new_proteomes(new_proteomes_dir, min_length=10, max_percent_stop=20):
         req_files=[new_proteomes_dir],
         prod_files=[
             new_good_proteomes,
-            new_bad_proteomes])
+            new_bad_proteomes],
+        params=dict(min_length=min_length, max_percent_stop=max_percent_stop))
 
 
 def main(args):
@@ -355,11 +365,6 @@ def main(args):
 
         working_dir = p.out_dir
 
-        with open(config_file) as cf:
-            conf = dict(
-                l.strip().split('=', 1) for l
-                in cf.readlines() if l.strip() and l.strip()[0] != '#')
-
         start_from, start_after = get_starting_step(p.start_from, join(working_dir, log_fname))
 
         if (not start_from or start_from == 1) and p.out_dir != p.directory:
@@ -394,22 +399,22 @@ def main(args):
         log_fpath = set_up_logging(p.debug, p.out_dir, 'a')
         log.info('python ' + basename(__file__) + ' ' + ' '.join(args))
         log.info('')
-        check_and_install_tools(p.debug, conf.get('db_vendor', 'sqlite'), log_fpath)
+        check_and_install_tools(p.debug, p.settings.db_vendor == 'sqlite', log_fpath)
 
         log.info('Changing to %s' % working_dir)
         if not isdir(working_dir):
             makedirs(working_dir)
         chdir(working_dir)
 
-        set_up_config(working_dir)
+        set_up_config(working_dir, p.settings)
 
         # Building the workflow
         workflow = Workflow(working_dir, id=make_workflow_id(working_dir),
-                            cmdline_args=['python', __file__] + args)
+                            cmdline_args=['python', __file__] + args, settings=p.settings)
         log.info('Workflow id is "' + workflow.id + '"')
         log.info('')
 
-        if conf.get('db_vendor', 'sqlite') == 'sqlite':
+        if p.settings.db_vendor == 'sqlite':
             suffix = ''
         else:
             suffix = '_' + workflow.id
@@ -418,29 +423,31 @@ def main(args):
             step_prepare_input(p),
             steps.filter_proteomes(
                 min_length=int(p.min_length),
-                max_percent_stop=int(p.max_percent_stop)),
+                max_percent_stop=int(p.max_percent_stop),
+                threads=int(p.threads) or None),
             filter_new_proteomes(
                 new_proteomes_dir,
                 min_length=int(p.min_length),
-                max_percent_stop=int(p.max_percent_stop)),
-            steps.make_blast_db(),
+                max_percent_stop=int(p.max_percent_stop),
+                threads=int(p.threads) or None),
+            steps.make_blast_db(new_proteins=new_good_proteomes),
+            steps.make_blast_db(new_good_proteomes, config.new_blast_db,
+                                'Making blast database of new proteins'),
             steps.blast(
                 workflow.id,
-                p.threads or p.jobs or 30,
-                on_cluster=p.threads > 0,
+                int(p.threads) or int(p.jobs) or 30,
+                on_cluster=not int(p.threads),
                 new_good_proteomes=new_good_proteomes,
-                evalue=float(p.evalue)),
-            steps.parse_blast_results(),
-            steps.clean_database(suffix),
-            steps.install_schema(suffix),
-            steps.load_blast_results(suffix),
-            steps.find_pairs(suffix),
-            steps.dump_pairs_to_files(suffix),
+                evalue=float(p.evalue),
+                threads_per_worker=int(p.threads_per_blast)),
+            steps.parse_blast_results(int(p.threads) or None)] +
+            steps.pairs_steps(p.pairs_engine, suffix) + [
             steps.mcl(p.debug),
-            steps.step_save_orthogroups(new_proteomes_dir if not p.ids_list and p.blast_singletones else None)
+            steps.step_save_orthogroups(new_proteomes_dir if not p.ids_list and p.blast_singletones else None,
+                                        save_db=p.save_db, threads=int(p.threads) or None)
         ])
 
-        blastdb = p.blastdb or conf.get('blastdb', None)
+        blastdb = p.blastdb or p.settings.get('blastdb')
 
         if not p.ids_list:
             workflow.extend([step_blast_singletones(p.threads, p.blast_singletones, blastdb, p.debug, p.overwrite)])
@@ -448,11 +455,15 @@ def main(args):
         result = workflow.run(
             start_after, start_from,
             overwrite=True,
-            ask_before=p.ask_each_step)
+            ask_before=p.ask_each_step,
+            max_workers=int(p.step_workers),
+            use_cache=p.use_cache)
 
         if result == 0:
             log.info('Done.')
             log.info('Log is in ' + join(working_dir, log_fname))
+            log.info('Run report (time, memory and I/O per step) is in ' +
+                     join(working_dir, run_report.report_tsv_fname))
             if isfile(join(working_dir, config.orthogroups_file)):
                 log.info('Groups are in ' + join(working_dir, config.orthogroups_file))
                 if isfile(config.nice_orthogroups_file):
@@ -460,6 +471,8 @@ def main(args):
                              join(working_dir, config.nice_orthogroups_file))
             else:
                 log.info('Groups in short format are in ' + join(working_dir, config.short_orthogroups_file))
+            if p.save_db and isfile(config.orthogroups_db):
+                log.info('Groups are also in the database ' + join(working_dir, config.orthogroups_db))
 
         return result
 
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+import sys
+import logging
+from os.path import join, isfile
+
+from src.argparse import ArgumentParser
+from src.split_groups import Subset, parse_subset, split_groups, read_groups
+from src.logger import set_up_logging
+from src import config
+
+from src.config import log_fname
+log = logging.getLogger(log_fname)
+
+
+def parse_args(args):
+    op = ArgumentParser(description='Saving subsets of orthogroups')
+    op.add_argument('-o', '--out', '--dir', dest='out', required=True)
+    op.add_argument('-s', '--subset', dest='subsets', action='append', default=[])
+    op.add_argument('--by', dest='by', default='strain', choices=['strain', 'taxon'])
+    op.add_argument('--min-strains', dest='min_strains', type=int, default=2)
+    op.add_argument('-d', '--debug', dest='debug', action='store_true', default=False)
+
+    op.usage = '''Saving subsets of orthogroups, like the groups of one clade.
+
+usage: %s -o <output directory of scenario_1 or 2> -s name=prefix[,prefix...] [-s ...]
+
+    -o  Directory with orthogroups.tsv (or orthogroups.db made with --orthogroups-db).
+
+    -s  A subset: genes of strains starting with one of the prefixes are saved
+        to <name>.tsv in the output directory. Can be given many times; all subsets
+        are saved in one pass over the groups, e.g.
+        -s ecoli="Escherichia coli" -s kpneumo=Klebsiella
+
+    --by
+        "strain" (default) matches the prefixes against strain names,
+        "taxon" against strain ids (taxon codes).
+
+    --min-strains
+        Save a group only if its genes in the subset come from at least
+        this many strains (default: 2).
+    ''' % sys.argv[0]
+
+    p = op.parse_args(args)
+    if not p.subsets:
+        op.error('at least one subset is required')
+    try:
+        p.subsets = [parse_subset(s) for s in p.subsets]
+    except ValueError, e:
+        op.error(str(e))
+    if not isfile(join(p.out, config.orthogroups_file)) and \
+            not isfile(join(p.out, config.orthogroups_db)):
+        op.error('no %s or %s in %s' % (config.orthogroups_file, config.orthogroups_db, p.out))
+    return p
+
+
+def main(args):
+    p = parse_args(args)
+    set_up_logging(p.debug, p.out)
+
+    subsets = [Subset(name, prefixes, join(p.out, name + '.tsv'), p.by, p.min_strains)
+               for name, prefixes in p.subsets]
+    groups = read_groups(join(p.out, config.orthogroups_file), join(p.out, config.orthogroups_db))
+    split_groups(groups, subsets)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
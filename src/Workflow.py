@@ -1,11 +1,17 @@
 from genericpath import isfile, isdir
 from itertools import izip, count, ifilterfalse, ifilter
-from os import remove, getcwd
-from os.path import basename, exists
+from os import remove, getcwd, wait4, WIFSIGNALED, WTERMSIG, WEXITSTATUS
+from os.path import basename, exists, normpath, sep
 from shutil import rmtree
+from time import time
 import sqlite3
 import subprocess
+from threading import Thread
+from Queue import Queue, Empty
 from db_connection import DbCursor
+from db_catalog import Catalog
+from step_cache import StepCache
+import run_report
 from mysql.connector import errorcode
 import mysql
 
@@ -15,11 +21,12 @@ log = logging.getLogger(config.log_fname)
 
 
 class Workflow:
-    def __init__(self, working_dir, id, cmdline_args):
+    def __init__(self, working_dir, id, cmdline_args, settings=None):
         self.working_dir = working_dir
         self.id = id
         self.steps = []
         self.cmdline_args = cmdline_args
+        self.settings = settings or config.settings  # current while the steps run
 
     def add(self, step):
         self.steps.append(step)
@@ -27,7 +34,7 @@ class Workflow:
     def extend(self, steps):
         self.steps.extend(steps)
 
-    def run(self, start_after, start_from, overwrite, ask_before):
+    def run(self, start_after, start_from, overwrite, ask_before, max_workers=1, use_cache=True):
         if start_from is not None \
                 and isinstance(start_from, basestring):
             step_found = False
@@ -39,6 +46,7 @@ class Workflow:
                     log.error('  %d. %s' % (i, step.name))
                 log.error('')
 
+        steps_to_run = []
         for i, step in izip(count(1), filter(None, self.steps)):
             if start_after is not None \
                     and isinstance(start_after, basestring) \
@@ -59,27 +67,173 @@ class Workflow:
                 if not isinstance(start_from, int) or i < start_from:
                     continue
 
-            log.info(str(i) + '. ' + step.name)
             starting_from_here = i == start_after + 1 if start_after else i == start_from if start_from else None
-            res = step._run(i, overwrite, ask_before, starting_from_here)
+            steps_to_run.append((i, step, starting_from_here))
+
+        deps = step_dependencies([step for _, step, _ in steps_to_run])
+        cache = StepCache() if use_cache else None
+        fingerprints = dict()
+        reused = set()
+
+        def run_step(k, step_by_step):
+            with config.using_settings(self.settings):
+                return _run_step(k, step_by_step)
+
+        def _run_step(k, step_by_step):
+            i, step, starting_from_here = steps_to_run[k]
+            rec = run_report.start_step(i, step.name)
+            res = 1
+            try:
+                if cache is None:
+                    res = step._run(i, overwrite, step_by_step, starting_from_here)
+                    return res
+
+                fingerprint, inputs = cache.fingerprint(
+                    step, [fingerprints[d] for d in deps[k] if d in fingerprints])
+                fingerprints[k] = fingerprint
+                if not starting_from_here and \
+                        cache.is_fresh(step, fingerprint, all(d in reused for d in deps[k])):
+                    log.info('   Inputs have not changed since the previous run, keeping the results.')
+                    reused.add(k)
+                    res = 0
+                    return res
+
+                res = step._run(i, overwrite, step_by_step, starting_from_here)
+                if res == 0:
+                    cache.save(step, fingerprint, inputs)
+                return res
+            finally:
+                run_report.finish_step(rec, res, reused=k in reused)
+
+        run_report.reset()
+        try:
+            if ask_before or max_workers <= 1:
+                for k, (i, step, _) in enumerate(steps_to_run):
+                    log.info(str(i) + '. ' + step.name)
+                    res = run_step(k, ask_before)
+                    if res != 0:
+                        return self.__interrupted(i)
+
+                    log.info('   Done.')
+                    log.info('')
+                return 0
+
+            failed_i = self.__run_parallel(steps_to_run, deps, run_step, max_workers)
+            if failed_i is not None:
+                return self.__interrupted(failed_i)
+            return 0
+        finally:
+            run_report.save(self.working_dir)
+
+    def __run_parallel(self, steps_to_run, deps, run_step, max_workers):
+        """ Runs steps in threads as soon as the steps they depend on are done,
+            keeping at most max_workers of them at a time. Returns the number
+            of the first step that did not complete, or None.
+        """
+        log.debug('Step dependencies: ' + ', '.join(
+            str(steps_to_run[k][0]) + ' <- ' + str([steps_to_run[d][0] for d in sorted(deps[k])])
+            for k in range(len(steps_to_run))))
+
+        results = Queue()
+
+        def worker(k):
+            i, step, _ = steps_to_run[k]
+            try:
+                res = run_step(k, False)
+            except Exception:
+                log.exception('   Step ' + str(i) + '. ' + step.name + ' failed.')
+                res = 1
+            results.put((k, res))
+
+        pending = range(len(steps_to_run))
+        running = set()
+        done = set()
+        failed = False
+
+        while pending or running:
+            if not failed:
+                for k in list(pending):
+                    if len(running) >= max_workers:
+                        break
+                    if deps[k] <= done:
+                        pending.remove(k)
+                        running.add(k)
+                        log.info(str(steps_to_run[k][0]) + '. ' + steps_to_run[k][1].name)
+                        t = Thread(target=worker, args=(k,))
+                        t.daemon = True
+                        t.start()
+            if not running:
+                break
+
+            try:
+                k, res = results.get(timeout=1)
+            except Empty:
+                continue
+            running.remove(k)
+            i, step, _ = steps_to_run[k]
             if res != 0:
-                if '--start-from' in self.cmdline_args:
-                    inx = self.cmdline_args.index('--start-from')
-                    del self.cmdline_args[inx]
-                    del self.cmdline_args[inx]
+                log.error('   ' + str(i) + '. ' + step.name + ': returned ' + str(res))
+                failed = True
+            else:
+                done.add(k)
+                log.info('   Done: ' + str(i) + '. ' + step.name)
+                log.info('')
+
+        not_done = [steps_to_run[k][0] for k in range(len(steps_to_run)) if k not in done]
+        return min(not_done) if not_done else None
+
+    def __interrupted(self, i):
+        if '--start-from' in self.cmdline_args:
+            inx = self.cmdline_args.index('--start-from')
+            del self.cmdline_args[inx]
+            del self.cmdline_args[inx]
+
+        self.cmdline_args.append('--start-from')
+        self.cmdline_args.append(str(i))
+
+        log.warn('')
+        log.warn('   The pipeline is not complete. You can use intermediate results in ' + getcwd() +
+                 ', or restart from this point using the --start-from option:')
+        log.warn('   ' + ' '.join(self.cmdline_args))
+        return 1
+
+
+def _paths_overlap(a, b):
+    a, b = normpath(a), normpath(b)
+    return a == b or a.startswith(b + sep) or b.startswith(a + sep)
+
+
+def _any_overlap(paths_a, paths_b):
+    return any(_paths_overlap(a, b) for a in paths_a for b in paths_b)
 
-                self.cmdline_args.append('--start-from')
-                self.cmdline_args.append(str(i))
 
-                log.warn('')
-                log.warn('   The pipeline is not complete. You can use intermediate results in ' + getcwd() +
-                         ', or restart from this point using the --start-from option:')
-                log.warn('   ' + ' '.join(self.cmdline_args))
-                return 1
+def step_dependencies(steps):
+    """ For each step, returns a set of indices of earlier steps it has to wait for.
 
-            log.info('   Done.')
-            log.info('')
-        return 0
+        A step depends on an earlier one if it requires something the earlier
+        step produces, or if it overwrites something the earlier step reads or
+        writes. Steps that declare no products (their outputs are unknown) are
+        ordered against every other step, and steps touching the database are
+        ordered against each other, as SQLite can not take concurrent writers.
+    """
+    deps = []
+    for j, later in enumerate(steps):
+        later_files = later.req_files + later.prod_files
+        later_opaque = not later.prod_files and not later.prod_tables
+        later_uses_db = bool(later.req_tables or later.prod_tables)
+
+        deps_j = set()
+        for i, earlier in enumerate(steps[:j]):
+            earlier_opaque = not earlier.prod_files and not earlier.prod_tables
+            earlier_uses_db = bool(earlier.req_tables or earlier.prod_tables)
+
+            if later_opaque or earlier_opaque \
+                    or (later_uses_db and earlier_uses_db) \
+                    or _any_overlap(later_files, earlier.prod_files) \
+                    or _any_overlap(later.prod_files, earlier.req_files):
+                deps_j.add(i)
+        deps.append(deps_j)
+    return deps
 
 
 def cmdline(command, parameters=None, stdin=None,
@@ -87,6 +241,8 @@ def cmdline(command, parameters=None, stdin=None,
             ignore_output_lines_by_pattern=None,
             start_ignoring_from=None):
     parameters = parameters or []
+    # the step making the command, even if it is run from another thread
+    step = run_report.current_step()
 
     def callback():
         if isinstance(command, basestring):
@@ -121,6 +277,7 @@ def cmdline(command, parameters=None, stdin=None,
                 command_str += ' 2> ' + stderr
 
         log.info('   ' + command_str)
+        started = time()
         try:
             p = subprocess.Popen(command_list, env=env,
                 stdin=stdin_f, stdout=stdout_f, stderr=stderr_f)
@@ -167,7 +324,10 @@ def cmdline(command, parameters=None, stdin=None,
                     if stderr == 'log':
                         log.debug('   ' + line.strip())
 
-            ret_code = p.wait()
+            _, status, rusage = wait4(p.pid, 0)
+            ret_code = -WTERMSIG(status) if WIFSIGNALED(status) else WEXITSTATUS(status)
+            p.returncode = ret_code
+            run_report.add_command(command_str, time() - started, rusage, ret_code, step)
             if ret_code != 0:
                 log.error('')
                 log.error('Command returned ' + str(ret_code))
@@ -193,13 +353,17 @@ def cmdline(command, parameters=None, stdin=None,
 class Step:
     def __init__(self, name, run,
                  req_files=None, prod_files=None,
-                 req_tables=None, prod_tables=None):
+                 req_tables=None, prod_tables=None,
+                 params=None, tools=None):
         self.name = name
         self.run = run
         self.req_files = req_files or []
         self.req_tables = req_tables or []
         self.prod_files = prod_files or []
         self.prod_tables = prod_tables or []
+        self.params = params or {}
+        self.tools = tools or []  # paths, commands, or functions returning them
+        self.catalog = Catalog()
 
 
     #def __run(self):
@@ -211,46 +375,11 @@ class Step:
     def __check_existence(self, overwrite):
         missing_prod_files = list(ifilterfalse(exists, self.prod_files))
 
-        with open(config.config_file) as f:
-            conf = dict(l.strip().lower().split('=', 1) for l
-                        in f.readlines() if l.strip() and l.strip()[0] != '#')
-        db_vendor = conf['db_vendor']
-
-        missing_prod_tables = []
-        existing_prod_tables = []
+        missing_prod_tables = self.catalog.missing(self.prod_tables)
+        existing_prod_tables = [t for t in self.prod_tables if t not in missing_prod_tables]
         if self.prod_tables:
-            with DbCursor() as cursor:
-                for table in self.prod_tables:
-                    #if db_vendor == 'sqlite':
-                    #    try:
-                    #        cursor.execute("SELECT name FROM sqlite_master "
-                    #                       "WHERE type='table' AND name='%s';" % table)
-                    #        if cursor.fetchone():
-                    #            existing_prod_tables.append(table)
-                    #            log.debug('   %s exists' % table)
-                    #        else:
-                    #            missing_prod_tables.append(table)
-                    #            log.debug('   %s does not exist' % table)
-                    #            continue
-                    #    except sqlite3.OperationalError:
-                    #        missing_prod_tables.append(table)
-                    #        log.debug('   %s does not exist' % table)
-                    #    else:
-                    #        existing_prod_tables.append(table)
-                    #        log.debug('   %s exists' % table)
-                    #else:
-                    try:
-                        q = 'SELECT 1 FROM %s LIMIT 1;' % table
-                        log.debug(q)
-                        cursor.execute(q)
-                        res = cursor.fetchall()
-                        log.debug(res)
-                    except (mysql.connector.Error, sqlite3.OperationalError):
-                        missing_prod_tables.append(table)
-                        log.debug('   %s does not exist' % table)
-                    else:
-                        existing_prod_tables.append(table)
-                        log.debug('   %s exists' % table)
+            log.debug('   Existing tables: ' + ', '.join(existing_prod_tables))
+            log.debug('   Missing tables: ' + ', '.join(missing_prod_tables))
             log.debug('')
 
         if not overwrite:
@@ -274,39 +403,7 @@ class Step:
                       ', '.join(missing_req_files))
             return False, 1
 
-        with open(config.config_file) as f:
-            conf = dict(l.strip().lower().split('=', 1) for l
-                        in f.readlines() if l.strip() and l.strip()[0] != '#')
-        db_vendor = conf['db_vendor']
-
-        missing_req_tables = []
-        if self.req_tables:
-            with DbCursor() as cursor:
-                for table in self.req_tables:
-                    #if db_vendor == 'sqlite':
-                    #    try:
-                    #        q = "SELECT name FROM sqlite_master " + \
-                    #            "WHERE type='table' AND name='%s';" % table
-                    #        log.debug(q)
-                    #        cursor.execute(q)
-                    #        res = cursor.fetchall()
-                    #        log.debug(res)
-                    #        if not res:
-                    #            missing_req_tables.append(table)
-                    #            continue
-                    #    except sqlite3.OperationalError:
-                    #        missing_req_tables.append(table)
-                    #else:
-                    try:
-                        q = 'SELECT 1 FROM %s LIMIT 1;' % table
-                        log.debug(q)
-                        cursor.execute(q)
-                        res = cursor.fetchall()
-                        log.debug(res)
-                    except (mysql.connector.Error, sqlite3.OperationalError):
-                        log.exception('aaa')
-                        missing_req_tables.append(table)
-
+        missing_req_tables = self.catalog.missing(self.req_tables)
         if missing_req_tables:
             log.error('   ' + self.name + ' requires tables ' +
                       ', '.join(missing_req_tables))
@@ -332,6 +429,7 @@ class Step:
                         log.critical(err)
                     except mysql.connector.Error, err:
                         log.critical(err)
+            self.catalog.invalidate()
         return True, 0
 
 
@@ -349,4 +447,7 @@ class Step:
         if not ok:
             return code
 
-        return self.run(starting_from_here=starting_from_here)
\ No newline at end of file
+        try:
+            return self.run(starting_from_here=starting_from_here)
+        finally:
+            self.catalog.invalidate()  # the step may have created tables
\ No newline at end of file
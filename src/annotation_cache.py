@@ -0,0 +1,175 @@
+""" GenBank records shared by all working directories.
+
+    Records are stored once under their sha1 and looked up by
+    accession.version; fetching an annotation that is already in the cache
+    only links the stored file into the annotations directory. When the
+    cache grows over its size limit, the least recently used records are
+    removed.
+
+    The location is taken from the ORTHOFINDER_ANNOTATION_CACHE environment
+    variable or the annotation_cache_dir option in config.txt, the size limit
+    (in gigabytes) from annotation_cache_size. Setting the location to "off"
+    disables the cache.
+"""
+import hashlib
+import sqlite3
+import stat
+from os import makedirs, rename, remove, link, chmod, environ, close
+from os.path import join, isdir, isfile, expanduser
+from shutil import copyfile
+from tempfile import mkstemp
+from time import time
+
+import config
+import logging
+log = logging.getLogger(config.log_fname)
+
+
+DEFAULT_DIR = '~/.orthofinder/annotation_cache'
+DEFAULT_SIZE_GB = 5
+
+
+def _makedirs(path):
+    try:
+        makedirs(path)
+    except OSError:
+        if not isdir(path):
+            raise
+
+
+def accession_version(gb_fpath):
+    """ Reads the VERSION line of the first record, like
+        "VERSION     NC_000913.3  GI:556503834".
+    """
+    with open(gb_fpath) as f:
+        for line in f:
+            if line.startswith('VERSION'):
+                fields = line.split()
+                return fields[1] if len(fields) > 1 else None
+            if line.startswith('FEATURES') or line.startswith('ORIGIN'):
+                return None
+    return None
+
+
+def link_or_copy(src, dst):
+    if isfile(dst):
+        remove(dst)
+    try:
+        link(src, dst)
+    except OSError:  # another file system
+        copyfile(src, dst)
+
+
+class AnnotationCache:
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.objects_dir = join(cache_dir, 'objects')
+        self.max_bytes = max_bytes
+        _makedirs(self.objects_dir)
+
+        self.conn = sqlite3.connect(join(cache_dir, 'index.db'), timeout=60)
+        self.conn.text_factory = str
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS records '
+                              '(accession TEXT PRIMARY KEY, digest TEXT, size INTEGER, last_used REAL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS records_last_used_ix ON records(last_used)')
+
+    def __object_fpath(self, digest):
+        return join(self.objects_dir, digest[:2], digest)
+
+    def get(self, accession, dst_fpath):
+        """ Links the record into dst_fpath. Returns False if it is not cached.
+        """
+        row = self.conn.execute('SELECT digest FROM records WHERE accession = ?',
+                                (accession,)).fetchone()
+        if not row or not isfile(self.__object_fpath(row[0])):
+            return False
+        link_or_copy(self.__object_fpath(row[0]), dst_fpath)
+        with self.conn:
+            self.conn.execute('UPDATE records SET last_used = ? WHERE accession = ?',
+                              (time(), accession))
+        return True
+
+    def put(self, gb_fpath, accession=None):
+        """ Stores a fetched record under its accession.version
+            (read from the file if not given).
+        """
+        accession = accession or accession_version(gb_fpath)
+        if not accession:
+            log.debug('   No VERSION in ' + gb_fpath + ', not caching it.')
+            return None
+
+        sha1 = hashlib.sha1()
+        size = 0
+        with open(gb_fpath, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), ''):
+                sha1.update(chunk)
+                size += len(chunk)
+        digest = sha1.hexdigest()
+
+        object_fpath = self.__object_fpath(digest)
+        if not isfile(object_fpath):
+            _makedirs(join(self.objects_dir, digest[:2]))
+            # threads of one process may store the same record at once
+            fd, tmp_fpath = mkstemp(prefix=digest + '.', suffix='.tmp',
+                                    dir=join(self.objects_dir, digest[:2]))
+            close(fd)
+            copyfile(gb_fpath, tmp_fpath)
+            # Linked into working directories, so must not be changed there
+            chmod(tmp_fpath, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            rename(tmp_fpath, object_fpath)
+
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)',
+                              (accession, digest, size, time()))
+        self.evict()
+        return accession
+
+    def evict(self):
+        """ Removes the least recently used records until the objects fit into max_bytes.
+        """
+        with self.conn:
+            sizes = dict(self.conn.execute('SELECT digest, size FROM records'))
+            total = sum(sizes.itervalues())
+            if total <= self.max_bytes:
+                return
+            rows = self.conn.execute('SELECT accession, digest FROM records '
+                                     'ORDER BY last_used').fetchall()
+            refs = dict()
+            for _, digest in rows:
+                refs[digest] = refs.get(digest, 0) + 1
+
+            for accession, digest in rows[:-1]:  # the newest always stays
+                if total <= self.max_bytes:
+                    break
+                self.conn.execute('DELETE FROM records WHERE accession = ?', (accession,))
+                refs[digest] -= 1
+                if refs[digest] == 0:
+                    total -= sizes[digest]
+                    if isfile(self.__object_fpath(digest)):
+                        remove(self.__object_fpath(digest))
+                log.debug('   Removed ' + accession + ' from the annotation cache.')
+
+    def close(self):
+        self.conn.close()
+
+
+def open_cache():
+    """ The shared cache, or None if it is disabled or cannot be used.
+    """
+    cache_dir = environ.get('ORTHOFINDER_ANNOTATION_CACHE') or \
+        config.current_settings().get('annotation_cache_dir') or DEFAULT_DIR
+    if cache_dir.lower() == 'off':
+        return None
+    try:
+        size_gb = float(config.current_settings().get('annotation_cache_size', DEFAULT_SIZE_GB))
+    except ValueError:
+        log.warn('   annotation_cache_size in config.txt must be a number of gigabytes, '
+                 'using %d.' % DEFAULT_SIZE_GB)
+        size_gb = DEFAULT_SIZE_GB
+
+    try:
+        return AnnotationCache(expanduser(cache_dir), int(size_gb * 1024 ** 3))
+    except (OSError, IOError, sqlite3.Error), e:
+        log.warn('   Cannot use the annotation cache in %s: %s' % (cache_dir, e))
+        return None
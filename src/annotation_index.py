@@ -0,0 +1,118 @@
+""" Genes of the GenBank files, saved when the files are converted into
+    proteomes, so that orthogroups are annotated without parsing them again.
+    Files are identified by the sha1 of their content, so a copy of a file
+    (like annotations added by scenario 2) is found as well; the sha1 of a
+    path is recomputed only when its size or mtime change. Genes are looked
+    up one by one, so they never have to be all in memory.
+"""
+import hashlib
+import sqlite3
+from os import makedirs, stat
+from os.path import dirname, isdir, realpath
+
+import config
+import logging
+log = logging.getLogger(config.log_fname)
+
+
+def file_digest(fpath):
+    sha1 = hashlib.sha1()
+    with open(fpath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), ''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def reference_genes(rec):
+    """ Returns the record id and, for every CDS, [strain, strain_id,
+        protein_id, locus_tag, gene, product, description].
+    """
+    strain_id = rec.id
+    strain = rec.annotations['source'] or rec.name
+    description = rec.description
+
+    genes = []
+    for feature in rec.features:
+        if feature.type == 'CDS':
+            qs = feature.qualifiers
+            prot_id = qs.get('protein_id', ['NA'])[0]
+            gene_id = qs.get('gene', ['NA'])[0]
+            product = qs.get('product', ['NA'])[0]
+            locus_tag = qs.get('locus_tag', ['NA'])[0]
+            genes.append([strain, strain_id, prot_id, locus_tag, gene_id, product, description])
+    return strain_id, genes
+
+
+class AnnotationIndex:
+    def __init__(self, fpath=config.annotation_index):
+        if dirname(fpath) and not isdir(dirname(fpath)):
+            makedirs(dirname(fpath))
+        self.conn = sqlite3.connect(fpath, timeout=60)
+        self.conn.text_factory = str
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS files '
+                              '(digest TEXT PRIMARY KEY, strain_id TEXT)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS genes '
+                              '(digest TEXT, strain TEXT, strain_id TEXT, protein_id TEXT, '
+                              'locus_tag TEXT, gene TEXT, product TEXT, description TEXT)')
+            self.conn.execute('DROP INDEX IF EXISTS genes_digest_ix')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS genes_digest_protein_ix ON genes(digest, protein_id)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS paths '
+                              '(path TEXT PRIMARY KEY, size INTEGER, mtime REAL, digest TEXT)')
+
+    def digest(self, fpath):
+        """ file_digest(fpath), computed again only if the file has changed.
+        """
+        st = stat(fpath)
+        row = self.conn.execute('SELECT size, mtime, digest FROM paths WHERE path = ?',
+                                (realpath(fpath),)).fetchone()
+        if row and row[0] == st.st_size and row[1] == st.st_mtime:
+            return row[2]
+        digest = file_digest(fpath)
+        self.__remember(fpath, digest)
+        return digest
+
+    def __remember(self, fpath, digest):
+        st = stat(fpath)
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO paths VALUES (?, ?, ?, ?)',
+                              (realpath(fpath), st.st_size, st.st_mtime, digest))
+
+    def strain_id(self, digest):
+        """ Returns None if the file is not indexed.
+        """
+        row = self.conn.execute('SELECT strain_id FROM files WHERE digest = ?', (digest,)).fetchone()
+        return row[0] if row else None
+
+    def gene(self, digest, protein_id):
+        """ The last CDS with the protein id in the file, or None.
+        """
+        row = self.conn.execute(
+            'SELECT strain, strain_id, protein_id, locus_tag, gene, product, description '
+            'FROM genes WHERE digest = ? AND protein_id = ? ORDER BY rowid DESC LIMIT 1',
+            (digest, protein_id)).fetchone()
+        return list(row) if row else None
+
+    def max_lengths(self, digests):
+        """ The longest value in bytes of every column but the description,
+            over the genes of the files.
+        """
+        lengths = [0] * 6
+        columns = ', '.join('MAX(LENGTH(CAST(%s AS BLOB)))' % c for c in
+                            ['strain', 'strain_id', 'protein_id', 'locus_tag', 'gene', 'product'])
+        for digest in set(digests):
+            row = self.conn.execute('SELECT %s FROM genes WHERE digest = ?' % columns, (digest,)).fetchone()
+            lengths = map(max, zip(lengths, [l or 0 for l in row]))
+        return lengths
+
+    def put(self, digest, strain_id, genes, fpath=None):
+        if fpath:
+            self.__remember(fpath, digest)
+        with self.conn:
+            self.conn.execute('DELETE FROM genes WHERE digest = ?', (digest,))
+            self.conn.executemany('INSERT INTO genes VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                  ([digest] + g for g in genes))
+            self.conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?)', (digest, strain_id))
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,331 @@
+""" BLAST databases shared by all working directories.
+
+    A database volume is made once for every set of proteins and version of
+    makeblastdb and stored under the sha1 of both; making the same database
+    again only links the stored volume into intermediate/blastdb_volumes.
+    The database of a working directory is an alias (<blast_db>.pal) of its
+    volumes, so that after adding proteomes the stored volume of the old
+    proteins is searched together with a small volume of the new ones
+    instead of making the whole database again.
+
+    The location is taken from the ORTHOFINDER_BLAST_DB_CACHE environment
+    variable or the blast_db_cache_dir option in config.txt, the size limit
+    (in gigabytes) from blast_db_cache_size. With the location set to "off"
+    the volumes are stored in the working directory only.
+"""
+import hashlib
+import sqlite3
+import threading
+from os import makedirs, rename, remove, link, symlink, listdir, environ
+from os.path import join, isdir, isfile, lexists, expanduser, \
+    dirname, basename, realpath, getsize, splitext
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+from Workflow import cmdline
+from step_cache import tool_version
+
+import config
+import logging
+log = logging.getLogger(config.log_fname)
+
+
+DEFAULT_DIR = '~/.orthofinder/blast_db_cache'
+DEFAULT_SIZE_GB = 20
+VOLUMES_DIRNAME = 'blastdb_volumes'
+MAKEBLASTDB_VERSION = ['makeblastdb', '-version']
+
+# steps making databases in one working directory can run at the same time
+_lock = threading.Lock()
+
+
+def _makedirs(path):
+    try:
+        makedirs(path)
+    except OSError:
+        if not isdir(path):
+            raise
+
+
+def _link_or_symlink(src, dst):
+    if lexists(dst):
+        remove(dst)
+    try:
+        link(src, dst)
+    except OSError:  # another file system
+        symlink(realpath(src), dst)
+
+
+def _records(fasta):
+    """ Yields (taxon, text) of every record of a fasta made by filter_proteomes.
+    """
+    record = []
+    with open(fasta, 'rb') as f:
+        for line in f:
+            if line.startswith('>') and record:
+                yield record[0][1:].split('|', 1)[0], ''.join(record)
+                record = []
+            record.append(line)
+    if record:
+        yield record[0][1:].split('|', 1)[0], ''.join(record)
+
+
+def _records_digest(digests, version):
+    """ Identifies a set of records whatever their order.
+    """
+    sha1 = hashlib.sha1(version)
+    for d in sorted(digests):
+        sha1.update(d)
+    return sha1.hexdigest()
+
+
+class _Digests:
+    """ The key of a fasta (sha1 of its content and the makeblastdb version)
+        and the digests of its records, split by the given taxa.
+    """
+    def __init__(self, fasta, version, taxa=()):
+        sha1 = hashlib.sha1(version)
+        self.taxa_records = []
+        self.other_records = []
+        for taxon, text in _records(fasta):
+            sha1.update(text)
+            digests = self.taxa_records if taxon in taxa else self.other_records
+            digests.append(hashlib.sha1(text).digest())
+        self.key = sha1.hexdigest()
+        self.version = version
+
+    def records(self):
+        return _records_digest(self.taxa_records + self.other_records, self.version)
+
+
+class BlastDbCache:
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.volumes_dir = join(cache_dir, 'volumes')
+        self.max_bytes = max_bytes
+        _makedirs(self.volumes_dir)
+
+        self.conn = sqlite3.connect(join(cache_dir, 'index.db'), timeout=60)
+        self.conn.text_factory = str
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS volumes '
+                              '(key TEXT PRIMARY KEY, records TEXT, size INTEGER, last_used REAL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS volumes_records_ix ON volumes(records)')
+
+    def __volume_dir(self, key):
+        return join(self.volumes_dir, key)
+
+    def files(self, key):
+        """ Files of the stored volume, or None if it is not cached.
+        """
+        volume_dir = self.__volume_dir(key)
+        if not isdir(volume_dir):
+            return None
+        with self.conn:
+            if not self.conn.execute('UPDATE volumes SET last_used = ? WHERE key = ?',
+                                     (time(), key)).rowcount:
+                return None
+        return [join(volume_dir, fname) for fname in sorted(listdir(volume_dir))]
+
+    def find(self, records):
+        """ The key of a stored volume with the same records, in any order.
+        """
+        for key, in self.conn.execute('SELECT key FROM volumes WHERE records = ? '
+                                      'ORDER BY last_used DESC', (records,)).fetchall():
+            if self.files(key):
+                return key
+        return None
+
+    def make(self, fasta, digests, keep=()):
+        """ Runs makeblastdb unless the volume is already stored. Returns 0 on success.
+            The volumes in keep are not evicted to make room for the new one.
+        """
+        if self.files(digests.key):
+            log.info('   Using the stored database of ' + fasta)
+            return 0
+
+        tmp_dir = mkdtemp(prefix=digests.key + '.', suffix='.tmp', dir=self.volumes_dir)
+        res = cmdline(
+            'makeblastdb',
+            parameters=[
+                '-in', realpath(fasta),
+                '-input_type', 'fasta',
+                '-out', join(realpath(tmp_dir), digests.key),
+                '-dbtype', 'prot'],
+            stdout='log',
+            stderr='log')()
+        if res != 0:
+            rmtree(tmp_dir)
+            return res
+
+        size = sum(getsize(join(tmp_dir, fname)) for fname in listdir(tmp_dir))
+        try:
+            rename(tmp_dir, self.__volume_dir(digests.key))
+        except OSError:
+            if not isdir(self.__volume_dir(digests.key)):
+                raise
+            rmtree(tmp_dir)  # made by another run meanwhile
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO volumes VALUES (?, ?, ?, ?)',
+                              (digests.key, digests.records(), size, time()))
+        self.evict(keep=[digests.key] + list(keep))
+        return 0
+
+    def evict(self, keep=()):
+        """ Removes the least recently used volumes until they fit into max_bytes.
+            Working directories keep their (hard) links to removed volumes.
+        """
+        if self.max_bytes is None:
+            return
+        with self.conn:
+            rows = self.conn.execute('SELECT key, size FROM volumes ORDER BY last_used').fetchall()
+            total = sum(size for _, size in rows)
+            for key, size in rows:
+                if total <= self.max_bytes:
+                    break
+                if key in keep:
+                    continue
+                self.conn.execute('DELETE FROM volumes WHERE key = ?', (key,))
+                if isdir(self.__volume_dir(key)):
+                    rmtree(self.__volume_dir(key))
+                total -= size
+                log.debug('   Removed ' + key + ' from the blast database cache.')
+
+    def close(self):
+        self.conn.close()
+
+
+def open_cache():
+    """ The shared cache, or the one of the working directory if it is disabled
+        or cannot be used.
+    """
+    local_cache_dir = join(config.intermediate_dir, 'blastdb_cache')
+    cache_dir = environ.get('ORTHOFINDER_BLAST_DB_CACHE') or \
+        config.current_settings().get('blast_db_cache_dir') or DEFAULT_DIR
+    if cache_dir.lower() == 'off':
+        return BlastDbCache(local_cache_dir)
+    try:
+        size_gb = float(config.current_settings().get('blast_db_cache_size', DEFAULT_SIZE_GB))
+    except ValueError:
+        log.warn('   blast_db_cache_size in config.txt must be a number of gigabytes, '
+                 'using %d.' % DEFAULT_SIZE_GB)
+        size_gb = DEFAULT_SIZE_GB
+
+    try:
+        return BlastDbCache(expanduser(cache_dir), int(size_gb * 1024 ** 3))
+    except (OSError, IOError, sqlite3.Error), e:
+        log.warn('   Cannot use the blast database cache in %s: %s' % (cache_dir, e))
+        return BlastDbCache(local_cache_dir)
+
+
+def _extended(cache, proteins, new_proteins, version, new_digests):
+    """ The key of the stored volume of the proteins that are not in
+        new_proteins, if new_proteins make the rest of proteins.
+    """
+    taxa = set(taxon for taxon, _ in _records(new_proteins))
+    digests = _Digests(proteins, version, taxa)
+    if sorted(digests.taxa_records) != sorted(new_digests.taxa_records + new_digests.other_records):
+        log.debug('   ' + new_proteins + ' differs from the new proteins in ' + proteins)
+        return None
+    return cache.find(_records_digest(digests.other_records, version))
+
+
+def _alias_volumes(pal_fpath):
+    """ Names of the volumes an alias made by _link_volumes refers to.
+    """
+    volumes = []
+    if isfile(pal_fpath):
+        with open(pal_fpath) as f:
+            for line in f:
+                if line.startswith('DBLIST'):
+                    volumes.extend(basename(v) for v in line.split()[1:])
+    return volumes
+
+
+def _link_volumes(cache, keys, blast_db):
+    """ Links the volumes next to blast_db and writes the alias <blast_db>.pal.
+        Returns False, leaving blast_db as it is, if a volume is not stored.
+    """
+    volumes_files = []
+    for key in keys:
+        files = cache.files(key)
+        if not files:
+            log.debug('   ' + key + ' is not in the blast database cache anymore.')
+            return False
+        volumes_files.extend(files)
+
+    volumes_dir = join(dirname(blast_db), VOLUMES_DIRNAME)
+    _makedirs(volumes_dir)
+    for fpath in volumes_files:
+        _link_or_symlink(fpath, join(volumes_dir, basename(fpath)))
+
+    # an old single-volume database would be found before the alias
+    for fname in listdir(dirname(blast_db) or '.'):
+        name, ext = splitext(fname)
+        if name == basename(blast_db) and len(ext) == 4 and ext.startswith('.p') and ext != '.pal':
+            remove(join(dirname(blast_db), fname))
+
+    with open(blast_db + '.pal.tmp', 'w') as f:
+        f.write('TITLE ' + basename(blast_db) + '\n')
+        f.write('DBLIST ' + ' '.join(join(VOLUMES_DIRNAME, key) for key in keys) + '\n')
+    rename(blast_db + '.pal.tmp', blast_db + '.pal')
+    return True
+
+
+def _remove_unused_volumes(intermediate_dir, volumes):
+    """ Removes those of the volumes that no alias in intermediate_dir refers to.
+    """
+    used = set()
+    for fname in listdir(intermediate_dir):
+        if fname.endswith('.pal'):
+            used.update(_alias_volumes(join(intermediate_dir, fname)))
+    volumes_dir = join(intermediate_dir, VOLUMES_DIRNAME)
+    for fname in listdir(volumes_dir):
+        volume = fname.split('.', 1)[0]
+        if volume in volumes and volume not in used:
+            remove(join(volumes_dir, fname))
+
+
+def make_blast_db(proteins, blast_db, new_proteins=None):
+    """ Makes (or links from the cache) the database of proteins. If proteins
+        are old proteins with new_proteins added, the database of the old ones
+        is reused when it is stored. Returns 0 on success.
+    """
+    version = tool_version(MAKEBLASTDB_VERSION)
+    with _lock:
+        cache = open_cache()
+        try:
+            return _make_blast_db(cache, version, proteins, blast_db, new_proteins)
+        finally:
+            cache.close()
+
+
+def _make_blast_db(cache, version, proteins, blast_db, new_proteins):
+    previous = _alias_volumes(blast_db + '.pal')
+    linked = False
+    if new_proteins:
+        new_digests = _Digests(new_proteins, version)
+        old_key = _extended(cache, proteins, new_proteins, version, new_digests)
+        if old_key:
+            log.info('   Adding the database of ' + new_proteins +
+                     ' to the stored database of the old proteins.')
+            res = cache.make(new_proteins, new_digests, keep=[old_key])
+            if res != 0:
+                return res
+            linked = _link_volumes(cache, [old_key, new_digests.key], blast_db)
+            if not linked:
+                log.info('   Making the whole database of ' + proteins + ' instead.')
+
+    if not linked:
+        digests = _Digests(proteins, version)
+        res = cache.make(proteins, digests)
+        if res != 0:
+            return res
+        if not _link_volumes(cache, [digests.key], blast_db):
+            log.error('   The database of ' + proteins + ' has been removed from '
+                      'the blast database cache by another run.')
+            return 1
+
+    _remove_unused_volumes(dirname(blast_db) or '.', previous)
+    return 0
@@ -0,0 +1,241 @@
+""" A port of orthomclBlastParser.pl: turns tabular BLAST output into
+    SimilarSequences rows (query_id, subject_id, query_taxon, subject_taxon,
+    evalue_mant, evalue_exp, percent_ident, percent_match), producing the same
+    bytes as the Perl script.
+"""
+import re
+from array import array
+from multiprocessing import Pool, cpu_count
+from os import listdir
+from os.path import join, getsize
+
+import config
+import logging
+log = logging.getLogger(config.log_fname)
+
+
+CHUNK_SIZE = 16 * 1024 * 1024
+
+_gene_re = re.compile(r'>(\S+)')
+_blank_re = re.compile(r'^\s*$')
+
+# Set before the worker pool is forked, so the workers share it
+_index = None
+
+
+class GeneIndex:
+    """ Protein lengths and taxa for every gene in the proteomes directory,
+        kept in flat arrays: gene id -> position -> length, taxon number.
+    """
+    def __init__(self):
+        self.positions = dict()
+        self.lengths = array('l')
+        self.taxon_nums = array('l')
+        self.taxa = []
+
+    def add(self, gene, taxon_num, length):
+        pos = self.positions.get(gene)
+        if pos is None:
+            self.positions[gene] = len(self.lengths)
+            self.lengths.append(length)
+            self.taxon_nums.append(taxon_num)
+        else:
+            self.lengths[pos] = length
+            self.taxon_nums[pos] = taxon_num
+
+    def get(self, gene):
+        pos = self.positions.get(gene)
+        if pos is None:
+            return None, None
+        return self.taxa[self.taxon_nums[pos]], self.lengths[pos]
+
+
+def taxon_from_fasta_fname(fname):
+    m = re.search(r'(\S+).fasta', fname) or re.search(r'(\S+).fa', fname)
+    if not m:
+        raise ValueError("'" + fname + "' is not in 'taxon.fasta' format")
+    return m.group(1)
+
+
+def read_gene_index(proteomes_dir):
+    index = GeneIndex()
+    for fname in listdir(proteomes_dir):
+        if fname.startswith('.'):
+            continue
+        log.debug('   Acquiring genes from ' + fname)
+        index.taxa.append(taxon_from_fasta_fname(fname))
+        taxon_num = len(index.taxa) - 1
+
+        gene, length = None, 0
+        with open(join(proteomes_dir, fname), 'rb') as f:
+            for line in f:
+                if line.endswith('\n'):
+                    line = line[:-1]
+                if _blank_re.match(line):
+                    continue
+                m = _gene_re.search(line)
+                if m:
+                    if gene:
+                        index.add(gene, taxon_num, length)
+                    gene, length = m.group(1), 0
+                else:
+                    length += len(line)
+        if gene:
+            index.add(gene, taxon_num, length)
+    return index
+
+
+def format_evalue(evalue):
+    if evalue.startswith('e'):
+        evalue = '1' + evalue
+    mant, exp = ('%.3e' % float(evalue)).split('e')
+    mant = re.sub(r'\.0+$', '', '%.2f' % float(mant))
+    exp = exp.replace('+', '', 1)
+    if exp == '00':
+        exp = '0'
+    return mant, exp
+
+
+def _non_overlapping_match_length(hspspans):
+    hsps = sorted(hspspans, key=lambda h: h[0])
+    if not hsps:
+        return 0
+    start, end = sorted(hsps[0])
+    length = 0
+    for h in hsps[1:]:
+        hsp_start, hsp_end = sorted(h)
+        if hsp_end <= end:
+            continue
+        if hsp_start <= end:
+            end = hsp_end
+        else:
+            length += end - start + 1
+            start, end = hsp_start, hsp_end
+    return length + end - start + 1
+
+
+def _format_subject(s):
+    percent_ident = int(s['total_identities'] / s['total_length'] * 10 + .5) / 10.0
+    shorter_length = s['query_length'] if s['query_shorter'] else s['subject_length']
+    percent_match = int(float(_non_overlapping_match_length(s['hspspans'])) /
+                        shorter_length * 1000 + .5) / 10.0
+    return '\t'.join([
+        s['query_id'], s['subject_id'], s['query_taxon'], s['subject_taxon'],
+        s['evalue_mant'], s['evalue_exp'],
+        '%.15g' % percent_ident, '%.15g' % percent_match]) + '\n'
+
+
+def parse_lines(lines, index):
+    """ Parses BLAST lines, in which HSPs for the same query and subject
+        follow each other, and returns the output rows as one string.
+    """
+    out = []
+    subject = None
+
+    for line in lines:
+        fields = line.split()
+        if not fields:
+            continue
+        query_id, subject_id, percent_identity, length = fields[:4]
+        query_start, query_end, subject_start, subject_end, evalue = fields[6:11]
+
+        if subject is None or query_id != subject['query_id'] or subject_id != subject['subject_id']:
+            if subject:
+                out.append(_format_subject(subject))
+
+            query_taxon, query_length = index.get(query_id)
+            subject_taxon, subject_length = index.get(subject_id)
+            if not subject_taxon:
+                raise ValueError("couldn't find taxon for gene '" + subject_id + "'")
+            if not query_taxon:
+                raise ValueError("couldn't find taxon for gene '" + query_id + "'")
+
+            evalue_mant, evalue_exp = format_evalue(evalue)
+            subject = dict(
+                query_id=query_id, subject_id=subject_id,
+                query_taxon=query_taxon, subject_taxon=subject_taxon,
+                query_length=query_length, subject_length=subject_length,
+                query_shorter=query_length < subject_length,
+                evalue_mant=evalue_mant, evalue_exp=evalue_exp,
+                hspspans=[], total_identities=0.0, total_length=0)
+
+        if subject['query_shorter']:
+            subject['hspspans'].append((int(query_start), int(query_end)))
+        else:
+            subject['hspspans'].append((int(subject_start), int(subject_end)))
+        subject['total_identities'] += float(percent_identity) * int(length)
+        subject['total_length'] += int(length)
+
+    if subject:
+        out.append(_format_subject(subject))
+    return ''.join(out)
+
+
+def chunk_offsets(blast_out, chunk_size=CHUNK_SIZE):
+    """ Splits the file into (start, end) byte ranges of about chunk_size,
+        cutting only where the query changes.
+    """
+    size = getsize(blast_out)
+    start = 0
+    with open(blast_out, 'rb') as f:
+        while start < size:
+            if start + chunk_size >= size:
+                yield start, size
+                return
+
+            f.seek(start + chunk_size)
+            f.readline()
+            end = f.tell()
+            line = f.readline()
+            query = line.split(None, 1)[0] if line.strip() else None
+            while line:
+                fields = line.split(None, 1)
+                if fields and fields[0] != query:
+                    break
+                end = f.tell()
+                line = f.readline()
+            yield start, end
+            start = end
+
+
+def _parse_chunk(args):
+    blast_out, start, end = args
+    with open(blast_out, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return parse_lines(data.split('\n'), _index)
+
+
+def iter_similar_sequences(blast_out, proteomes_dir, processes=1, chunk_size=CHUNK_SIZE):
+    """ Yields blocks of SimilarSequences rows in the order of the BLAST output.
+    """
+    global _index
+    _index = read_gene_index(proteomes_dir)
+    log.debug('   Read %d genes from %d proteomes.' % (len(_index.lengths), len(_index.taxa)))
+
+    chunks = ((blast_out, start, end) for start, end in chunk_offsets(blast_out, chunk_size))
+
+    if processes <= 1:
+        for chunk in chunks:
+            yield _parse_chunk(chunk)
+    else:
+        pool = Pool(processes)
+        try:
+            for block in pool.imap(_parse_chunk, chunks):
+                yield block
+        finally:
+            pool.terminate()
+
+
+def parse_blast_results(blast_out, proteomes_dir, out_fpath, processes=None):
+    processes = processes or cpu_count()
+    log.info('   Parsing ' + blast_out + ' with ' + str(processes) + ' processes.')
+    try:
+        with open(out_fpath, 'wb') as out_f:
+            for block in iter_similar_sequences(blast_out, proteomes_dir, processes):
+                out_f.write(block)
+    except (ValueError, ZeroDivisionError), e:
+        log.error('   Error parsing ' + blast_out + ': ' + str(e))
+        return 1
+    log.info('   Saved to ' + out_fpath)
+    return 0
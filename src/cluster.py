@@ -0,0 +1,262 @@
+""" Submitting jobs to a cluster and following them until they finish.
+
+    A scheduler submits runner scripts and reports the state of many jobs
+    at once; JobTracker polls it, logs progress, resubmits failed jobs and
+    starts a second copy of jobs that run much longer than the others.
+"""
+import os
+import signal
+import subprocess
+from os.path import realpath
+from time import time, sleep
+
+import config
+import logging
+log = logging.getLogger(config.log_fname)
+
+
+QUEUED, RUNNING, FINISHED, ERROR = 'queued', 'running', 'finished', 'error'
+
+
+def _call(command):
+    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    return p.returncode, out, err
+
+
+class Job:
+    def __init__(self, name, runner_fpath, log_fpath, is_complete=None, threads=1):
+        """ is_complete tells if the job has produced its results;
+            if not given, the exit status reported by the scheduler is used.
+        """
+        self.name = name
+        self.runner_fpath = runner_fpath
+        self.log_fpath = log_fpath
+        self.is_complete = is_complete
+        self.threads = threads
+
+        self.job_ids = []  # all running copies, the first is the original
+        self.attempts = 0
+        self.submitted_at = None
+        self.finished_at = None
+        self.done = False
+        self.failed = False
+
+    def runtime(self):
+        return (self.finished_at or time()) - self.submitted_at
+
+
+class SgeScheduler:
+    # qacct may have no record of a job for a while after it left qstat
+    accounting_delay = 120
+
+    def __init__(self, queue='batch.q'):
+        self.queue = queue
+        self.unaccounted = dict()  # job id -> when it was first not found by qacct
+
+    def submit(self, job):
+        command = ['qsub', '-terse',
+                   '-pe', 'pe_smp', str(job.threads),
+                   '-S', '/bin/bash', '-cwd', '-j', 'y',
+                   '-q', self.queue,
+                   '-N', job.name,
+                   '-o', realpath(job.log_fpath),
+                   realpath(job.runner_fpath)]
+        log.debug('   ' + ' '.join(command))
+        code, out, err = _call(command)
+        if code != 0:
+            log.error('   qsub returned ' + str(code) + ': ' + err.strip())
+            return None
+        return out.strip().split('.')[0]
+
+    def states(self, job_ids):
+        """ One qstat call for all jobs; the ones that left the queue are
+            looked up with qacct. Returns {job id: (state, exit status)}.
+            Jobs that left the queue are reported running until qacct has
+            their record, or for accounting_delay seconds at most.
+        """
+        code, out, err = _call(['qstat'])
+        if code != 0:
+            log.warn('   qstat returned ' + str(code) + ': ' + err.strip())
+            return dict()
+
+        listed = dict()
+        for line in out.split('\n')[2:]:
+            fields = line.split()
+            if len(fields) >= 5:
+                listed[fields[0]] = fields[4]
+
+        states = dict()
+        for job_id in job_ids:
+            if job_id in listed:
+                code = listed[job_id]
+                if 'E' in code:
+                    states[job_id] = (ERROR, None)
+                elif 'r' in code or 't' in code:
+                    states[job_id] = (RUNNING, None)
+                else:
+                    states[job_id] = (QUEUED, None)
+            else:
+                states[job_id] = self.__finished_state(job_id)
+        return states
+
+    def __finished_state(self, job_id):
+        exit_status = self.__exit_status(job_id)
+        if exit_status is None:
+            first_missed = self.unaccounted.setdefault(job_id, time())
+            if time() - first_missed < self.accounting_delay:
+                return RUNNING, None
+            log.debug('   No accounting record of job ' + job_id)
+        self.unaccounted.pop(job_id, None)
+        return FINISHED, exit_status
+
+    def __exit_status(self, job_id):
+        code, out, _ = _call(['qacct', '-j', job_id])
+        if code != 0:
+            return None  # accounting is not written yet
+        failed, exit_status = '0', None
+        for line in out.split('\n'):
+            fields = line.split(None, 1)
+            if len(fields) == 2 and fields[0] == 'failed':
+                failed = fields[1].strip()
+            if len(fields) == 2 and fields[0] == 'exit_status':
+                exit_status = int(fields[1].split()[0])
+        if failed.split()[0] != '0':
+            return exit_status or 1
+        return exit_status
+
+    def cancel(self, job_id):
+        _call(['qdel', job_id])
+
+
+class LocalScheduler:
+    """ Runs the jobs as local processes; stands in for a cluster in tests
+        and on machines without one.
+    """
+    def __init__(self):
+        self.processes = dict()
+
+    def submit(self, job):
+        job_id = str(len(self.processes) + 1)
+        with open(job.log_fpath, 'w') as log_f:
+            env = dict(os.environ, JOB_ID=job_id)
+            self.processes[job_id] = subprocess.Popen(
+                ['bash', realpath(job.runner_fpath)],
+                stdout=log_f, stderr=subprocess.STDOUT, env=env,
+                preexec_fn=os.setsid)
+        return job_id
+
+    def states(self, job_ids):
+        states = dict()
+        for job_id in job_ids:
+            code = self.processes[job_id].poll()
+            states[job_id] = (RUNNING, None) if code is None else (FINISHED, code)
+        return states
+
+    def cancel(self, job_id):
+        p = self.processes[job_id]
+        if p.poll() is None:
+            os.killpg(p.pid, signal.SIGTERM)
+            p.wait()
+
+
+class JobTracker:
+    def __init__(self, scheduler, poll_interval=10, max_attempts=3,
+                 straggler_factor=3.0):
+        self.scheduler = scheduler
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.straggler_factor = straggler_factor
+
+    def __submit(self, job):
+        job_id = self.scheduler.submit(job)
+        if job_id is None:
+            return False
+        job.job_ids.append(job_id)
+        job.attempts += 1
+        if job.submitted_at is None:
+            job.submitted_at = time()
+        log.debug('   Submitted ' + job.name + ' as job ' + job_id)
+        return True
+
+    def __is_straggler(self, job, jobs):
+        runtimes = sorted(j.runtime() for j in jobs if j.done)
+        if len(job.job_ids) > 1 or len(runtimes) < max(1, len(jobs) / 2):
+            return False
+        median = runtimes[len(runtimes) / 2]
+        return job.runtime() > self.straggler_factor * max(median, self.poll_interval)
+
+    def run(self, jobs):
+        """ Submits the jobs and waits for them. Returns 0 if all of them
+            completed, 1 otherwise.
+        """
+        for job in jobs:
+            if not self.__submit(job):
+                return 1
+
+        total = len(jobs)
+        reported = None
+        while True:
+            active = [j for j in jobs if not j.done and not j.failed]
+            if not active:
+                break
+
+            states = self.scheduler.states([i for j in active for i in j.job_ids])
+            for job in active:
+                job_states = [states.get(i, (QUEUED, None)) for i in job.job_ids]
+
+                finished = [(i, code) for i, (state, code) in zip(job.job_ids, job_states)
+                            if state == FINISHED]
+                succeeded = [i for i, code in finished
+                             if (job.is_complete() if job.is_complete else code == 0)]
+                if succeeded:
+                    job.done = True
+                    job.finished_at = time()
+                    for other_id in job.job_ids:
+                        if other_id not in dict(finished):
+                            self.scheduler.cancel(other_id)
+                    log.info('   ' + job.name + ' done in %.0f seconds' % job.runtime())
+                    continue
+
+                for i, (state, code) in zip(list(job.job_ids), job_states):
+                    if state == ERROR or state == FINISHED:
+                        log.warn('   ' + job.name + ' (job ' + i + ') failed' +
+                                 (' with exit status ' + str(code) if code else '') +
+                                 ', see ' + job.log_fpath)
+                        if state == ERROR:
+                            self.scheduler.cancel(i)
+                        job.job_ids.remove(i)
+
+                if not job.job_ids:
+                    if job.attempts >= self.max_attempts:
+                        log.error('   ' + job.name + ' failed ' + str(job.attempts) + ' times, giving up.')
+                        job.failed = True
+                        job.finished_at = time()
+                    else:
+                        log.info('   Resubmitting ' + job.name + ' (attempt %d of %d)' % (
+                                 job.attempts + 1, self.max_attempts))
+                        if not self.__submit(job):
+                            job.failed = True
+
+                elif self.__is_straggler(job, jobs):
+                    log.info('   ' + job.name + ' has been running for %.0f seconds, '
+                             'submitting a second copy.' % job.runtime())
+                    self.__submit(job)
+
+            if any(j.failed for j in jobs):
+                for job in jobs:
+                    if not job.done:
+                        for i in job.job_ids:
+                            self.scheduler.cancel(i)
+                return 1
+
+            progress = (sum(1 for j in jobs if j.done),
+                        sum(1 for j in jobs if not j.done for i in j.job_ids
+                            if states.get(i, (QUEUED, None))[0] == RUNNING))
+            if progress != reported:
+                log.info('   %d of %d jobs done, %d running.' % (progress[0], total, progress[1]))
+                reported = progress
+
+            if any(not j.done for j in jobs):
+                sleep(self.poll_interval)
+        return 0
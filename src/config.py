@@ -1,3 +1,5 @@
+import threading
+from os import environ
 from os.path import dirname, realpath, join, basename
 
 BLAST_DBSIZE = 100000
@@ -7,14 +9,122 @@ config_file = join(dirname(realpath(__file__)), '../config.txt')
 src_dir = dirname(realpath(__file__))
 orthomcl_sqlite_bin_dir = join(dirname(realpath(__file__)), 'orthomcl_software/bin')
 orthomcl_mysql_bin_dir = join(dirname(realpath(__file__)), 'orthomcl_software_mysql/bin')
-orthomcl_bin_dir = orthomcl_sqlite_bin_dir
-with open(config_file) as f:
-    conf = dict(l.strip().lower().split('=', 1)
-                for l in f.readlines() if l.strip() and l.strip()[0] != '#')
-    if conf['db_vendor'] == 'sqlite':
-        orthomcl_bin_dir = orthomcl_sqlite_bin_dir
-    else:
-        orthomcl_bin_dir = orthomcl_mysql_bin_dir
+
+
+class Settings:
+    """ Options of config.txt, read once and validated. Keys are lower case,
+        values are kept as written, except for db_vendor. Read-only: replace()
+        makes a copy with some options changed, like from the command line.
+    """
+    def __init__(self, options):
+        options = dict((k.strip().lower(), str(v).strip()) for k, v in options.items())
+        if 'db_vendor' in options:
+            options['db_vendor'] = options['db_vendor'].lower()
+        _validate(options)
+        self.__dict__['_options'] = options
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Settings are read-only, use replace()')
+
+    def __getitem__(self, key):
+        return self._options[key]
+
+    def __contains__(self, key):
+        return key in self._options
+
+    def get(self, key, default=None):
+        return self._options.get(key, default)
+
+    def items(self):
+        return self._options.items()
+
+    def replace(self, **options):
+        merged = dict(self._options)
+        merged.update((k.strip().lower(), v) for k, v in options.items())
+        return Settings(merged)
+
+    @property
+    def db_vendor(self):
+        return self._options['db_vendor']
+
+    @property
+    def memory(self):
+        return int(self._options.get('memory', 4))
+
+    @property
+    def orthomcl_bin_dir(self):
+        return orthomcl_sqlite_bin_dir if self.db_vendor == 'sqlite' else orthomcl_mysql_bin_dir
+
+    def __repr__(self):
+        return 'Settings(%s)' % ', '.join(
+            '%s=%s' % (k, '***' if k == 'db_password' else v) for k, v in sorted(self._options.items()))
+
+
+def _validate(options):
+    if options.get('db_vendor') not in ('sqlite', 'mysql'):
+        raise ValueError('db_vendor must be sqlite or mysql, not "%s"' % options.get('db_vendor'))
+    if options['db_vendor'] == 'mysql':
+        missing = [k for k in ('db_server', 'db_port', 'db_login', 'db_password') if k not in options]
+        if missing:
+            raise ValueError('db_vendor=mysql requires ' + ', '.join(missing))
+    for key in ('memory', 'db_port'):
+        if key in options and not options[key].isdigit():
+            raise ValueError('%s must be a number, not "%s"' % (key, options[key]))
+
+
+# options that are commented out in config.txt by default
+optional_options = ['annotation_cache_dir', 'annotation_cache_size', 'blast_db_cache_dir',
+                    'blast_db_cache_size', 'ncbi_api_key', 'db_pool_size', 'db_connect_attempts',
+                    'blastdb', 'memory']
+
+
+def parse_options(lines):
+    """ key=value lines; empty lines and lines starting with # are skipped.
+    """
+    return dict(l.strip().split('=', 1) for l in lines if l.strip() and l.strip()[0] != '#')
+
+
+def load_settings(fpath=config_file, env=environ):
+    """ config.txt with the options overridden by ORTHOFINDER_<OPTION>
+        environment variables, like ORTHOFINDER_DB_VENDOR=mysql.
+    """
+    with open(fpath) as f:
+        options = dict((k.strip().lower(), v) for k, v in parse_options(f).items())
+    for name, value in env.items():
+        key = name[len('ORTHOFINDER_'):].lower()
+        if name.startswith('ORTHOFINDER_') and (key in options or key in optional_options):
+            options[key] = value
+    return Settings(options)
+
+
+settings = load_settings()
+conf = settings  # the name used before Settings
+
+_active = threading.local()
+
+
+def current_settings():
+    """ The settings of the workflow running in this thread (see
+        using_settings), or the ones of config.txt.
+    """
+    return getattr(_active, 'settings', None) or settings
+
+
+class using_settings:
+    """ Makes settings current in this thread for the with-block.
+    """
+    def __init__(self, settings):
+        self.settings = settings
+
+    def __enter__(self):
+        self.previous = getattr(_active, 'settings', None)
+        _active.settings = self.settings
+        return self.settings
+
+    def __exit__(self, type, value, traceback):
+        _active.settings = self.previous
+
+
 mcl_dir = join(dirname(realpath(__file__)), 'mcl_software')
 mysql_linux_tar = join(dirname(realpath(__file__)), 'mysql-5.6.15-linux-glibc2.5-x86_64.tar.gz')
 mysql_osx_tar = join(dirname(realpath(__file__)), 'mysql-5.6.15-osx10.7-x86_64.tar.gz')
@@ -34,9 +144,13 @@ sql_log                   = 'intermediate/log.sql'
 good_proteins             = 'intermediate/good_proteins.fasta'
 poor_proteins             = 'intermediate/poor_proteins.fasta'
 blast_db                  = 'intermediate/blastdb'
+new_blast_db              = 'intermediate/new_blastdb'
 blast_out                 = 'intermediate/blasted.tsv'
 similar_sequences         = 'intermediate/similar_sequences.txt'
 pairs_log                 = 'intermediate/orthomclpairs.log'
+step_manifests_dir        = 'intermediate/manifests'
+fetched_proteins_cache    = 'intermediate/fetched_proteins.db'
+annotation_index          = 'intermediate/annotations.db'
 mcl_input                 = 'intermediate/mcl_input'
 mcl_output                = 'intermediate/mcl_output'
 pairs_dir                 = 'intermediate/pairs'
@@ -48,8 +162,9 @@ singletons_file           = 'singletons.txt'
 orthogroups_file          = 'orthogroups.tsv'
 nice_orthogroups_file     = 'orthogroups_nice.txt'
 short_orthogroups_file    = 'orthogroups_short.tsv'
+orthogroups_db            = 'orthogroups.db'
 assembly_singletones_file = 'assembly_singletones.txt'
-singletone_dir            = 'new_singletones'
+singletones_fasta         = 'new_singletones.fasta'
 
 
 orthomcl_config_fname = 'orthomcl.config'
@@ -0,0 +1,42 @@
+""" Which tables exist in the OrthoMCL database, read from the catalog
+    (sqlite_master or information_schema.tables) in one query instead of
+    probing every table with a SELECT.
+"""
+from db_connection import DbCursor
+
+import config
+import logging
+log = logging.getLogger(config.log_fname)
+
+
+class Catalog:
+    """ Keeps the names of the tables until invalidate() is called, as a step
+        does when it has created or dropped tables.
+    """
+    def __init__(self, settings=None):
+        self.settings = settings
+        self.__tables = None
+
+    def __load(self):
+        db = DbCursor(settings=self.settings)
+        with db as cursor:
+            if db.db_vendor == 'mysql':
+                cursor.execute('SELECT table_name FROM information_schema.tables '
+                               'WHERE table_schema = DATABASE()')
+            else:
+                cursor.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view')")
+            # names are compared as SQLite and MySQL with lower_case_table_names do
+            tables = set(str(r[0]).lower() for r in cursor.fetchall())
+        log.debug('   %d tables in the database' % len(tables))
+        return tables
+
+    def exists(self, table):
+        if self.__tables is None:
+            self.__tables = self.__load()
+        return table.lower() in self.__tables
+
+    def missing(self, tables):
+        return [t for t in tables if not self.exists(t)]
+
+    def invalidate(self):
+        self.__tables = None
@@ -1,10 +1,23 @@
-from os import system
-import subprocess
-import traceback
+""" Connections to the OrthoMCL database, shared by the whole process.
+
+    MySQL connections are taken from a pool (checked with a ping and
+    reconnected when taken), SQLite uses one persistent connection with
+    tuned PRAGMAs that is opened again if the database file is replaced.
+    When the server cannot be reached, connecting is retried with growing
+    delays (db_connect_attempts in config.txt, 6 by default), so that
+    unattended runs wait for a restarting server instead of a keypress.
+
+    The options are taken from the settings given to DbCursor, by default the
+    ones of the running workflow (config.current_settings()); every MySQL
+    server gets its own pool.
+"""
+import atexit
+import os
+import threading
 import sqlite3
+import time
 import mysql.connector
-from mysql.connector import errorcode
-from os.path import join, dirname, realpath
+from mysql.connector import errorcode, pooling
 
 import config
 import logging
@@ -14,103 +27,180 @@ import sys
 sys.path = [config.src_dir] + sys.path
 
 
-class DbCursor:
-    def __init__(self, data_fpath=config.sqlite_file, step=''):
-        with open(config.config_file) as f:
-            conf = dict(l.strip().lower().split('=', 1) for l
-                        in f.readlines() if l.strip() and l.strip()[0] != '#')
+DEFAULT_POOL_SIZE = 4
+DEFAULT_CONNECT_ATTEMPTS = 6
+FIRST_DELAY = 1.0  # seconds, doubled after every failed attempt
+
+_sqlite_pragmas = [
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -65536',  # 64 MB
+]
+
+
+def _int_option(settings, name, default):
+    try:
+        return int(settings.get(name, default))
+    except ValueError:
+        log.warn('   %s in config.txt must be a number, using %d.' % (name, default))
+        return default
+
+
+def _with_retries(settings, connect, step=''):
+    """ Calls connect() until it succeeds, waiting FIRST_DELAY, 2 * FIRST_DELAY, ...
+        seconds between the attempts. Raises the last error.
+    """
+    attempts = max(1, _int_option(settings, 'db_connect_attempts', DEFAULT_CONNECT_ATTEMPTS))
+    delay = FIRST_DELAY
+    for attempt in range(1, attempts + 1):
+        try:
+            return connect()
+        except mysql.connector.Error, err:
+            if attempt == 1:
+                log.warn('   Could not connect to the database: ' + str(err))
+                log.info('   ' + _mysql_address(settings))
+            if attempt == attempts:
+                log.error('   Giving up after %d attempts. Start the server and run again'
+                          '%s.' % (attempts, (' with --start-from "' + step + '"') if step else ''))
+                raise
+            log.info('   Retrying in %d seconds (attempt %d of %d).' % (delay, attempt + 1, attempts))
+            time.sleep(delay)
+            delay *= 2
+
+
+class _Connections:
+    """ The pools and the SQLite connections of one process. SQLite connections
+        can not be used from another thread, so there is one per thread.
+    """
+    def __init__(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.pools = dict()
+        self.local = threading.local()
+
+    def mysql_connection(self, settings, step=''):
+        key = tuple(sorted(_mysql_config(settings).items()))
+        with self.lock:
+            if key not in self.pools:
+                self.pools[key] = _with_retries(
+                    settings, lambda: self.__make_pool(settings, len(self.pools)), step)
+            pool = self.pools[key]
+        try:
+            return _with_retries(settings, pool.get_connection, step)
+        except mysql.connector.errors.PoolError:
+            # more nested cursors than pooled connections
+            log.debug('   The connection pool is exhausted, opening another connection.')
+            return _with_retries(
+                settings, lambda: mysql.connector.connect(**_mysql_config(settings)), step)
+
+    def __make_pool(self, settings, number):
+        return pooling.MySQLConnectionPool(
+            pool_name='orthomcl_%d_%d' % (self.pid, number),
+            pool_size=min(max(1, _int_option(settings, 'db_pool_size', DEFAULT_POOL_SIZE)),
+                          pooling.CNX_POOL_MAXSIZE),
+            **_mysql_config(settings))
+
+    def sqlite_connection(self, fpath):
+        conns = getattr(self.local, 'sqlite', None)
+        if conns is None:
+            conns = self.local.sqlite = dict()
+
+        conn, inode = conns.get(fpath, (None, None))
+        if conn is not None and _inode(fpath) != inode:
+            log.debug('   ' + fpath + ' has been replaced, connecting again.')
+            conn.close()
+            conn = None
+        if conn is None:
+            conn = sqlite3.connect(fpath, isolation_level=None, timeout=60)
+            for pragma in _sqlite_pragmas:
+                conn.execute(pragma)
+            conns[fpath] = conn, _inode(fpath)
+        return conn
+
+    def close(self):
+        for conn, _ in getattr(self.local, 'sqlite', dict()).values():
+            conn.close()
+        self.local.sqlite = dict()
+
+
+_connections = None
+_connections_lock = threading.Lock()
+
+
+def connections():
+    """ The connections of this process; a forked process makes its own.
+    """
+    global _connections
+    with _connections_lock:
+        if _connections is None or _connections.pid != os.getpid():
+            _connections = _Connections()
+        return _connections
+
+
+def close_connections():
+    with _connections_lock:
+        if _connections is not None and _connections.pid == os.getpid():
+            _connections.close()
+
+
+atexit.register(close_connections)
+
+
+def _inode(fpath):
+    try:
+        return os.stat(fpath).st_ino
+    except OSError:
+        return None
+
+
+def _mysql_config(settings):
+    return dict(
+        user=settings['db_login'],
+        password=settings['db_password'],
+        host=settings['db_server'],
+        port=int(settings['db_port']),
+        database='orthomcl',
+        buffered=True,
+        autocommit=True)
+
+
+def _mysql_address(settings):
+    return ('The connection address: %s, port: %s, login: %s, database: %s. '
+            'Please, review the connection options in the config.txt file in the root directory. '
+            'If the server is not running, start it with "mysqld --port=%s &" or "mysqld_safe --port=%s &".' % (
+                settings['db_server'], settings['db_port'], settings['db_login'], 'orthomcl',
+                settings['db_port'], settings['db_port']))
 
-        self.db_vendor = conf['db_vendor']
 
-        if self.db_vendor == 'mysql':
-            self.db_login = conf['db_login']
-            self.db_passw = conf['db_password']
-            self.db_port = conf['db_port']
-            self.db_server = conf['db_server']
-        else:
-            self.data_fpath = config.sqlite_file
+class DbCursor:
+    def __init__(self, data_fpath=config.sqlite_file, step='', settings=None):
+        self.settings = settings or config.current_settings()
+        self.db_vendor = self.settings.db_vendor
+        self.data_fpath = data_fpath
 
         self.conn = None
         self.cursor = None
 
         self.step = step
 
-    def __connect(self):
-        if self.db_vendor == 'mysql':
-            try:
-                self.conn = mysql.connector.connect(
-                    user=self.db_login,
-                    password=self.db_passw,
-                    host=self.db_server,
-                    port=self.db_port,
-                    database='orthomcl',
-                    buffered=True)
-            except:
-                log.exception('Error connecting to the database.')
-                raise
-            self.conn.autocommit = True
-        elif self.db_vendor == 'sqlite':
-            self.conn = sqlite3.connect(self.data_fpath)
-        else:
-            log.error('Error database vendor. Options are mysql and sqlite.')
-            raise
-
     def __enter__(self):
         if self.db_vendor == 'mysql':
-            connected = False
-            while not connected:
-                try:
-                    self.__connect()
-                    connected = True
-
-                except mysql.connector.Error, err:
-                    #log.info('   MySql server must not be running, trying to start.')
-                    with open(config.config_file) as cf:
-                        conf = dict(l.strip().split('=', 1) for l
-                                    in cf.readlines() if l.strip() and l.strip()[0] != '#')
-
-                    log.warn('   ' + str(traceback.format_exc(limit=0)))
-
-                    cmd1 = 'mysqld --port=%s &' % conf['db_port']
-                    cmd2 = 'mysqld_safe --port=%s &' % conf['db_port']
-                    log.info('   Could not connect to MySql server. '
-                             'The connection address: %s, port: %s, login: %s, password: %s, database: %s. '
-                             'Please, review the connection options in the config.txt file in the root directory.' %
-                             (self.db_server, self.db_port, self.db_login, self.db_passw, 'orthomcl'))
-                    log.info('   If the server is not running, '
-                             'please, start it at another terminal with "%s" or "%s"' % (cmd1, cmd2))
-                    try:
-                        raw_input('   After that, press any key to proceed to the next step, or type Ctrl-C to quit. '
-                                  '(Notice that you can start from this step using --start-from%s): '
-                                  % (' "' + self.step + '"' if self.step else ''))
-                    except KeyboardInterrupt:
-                        print ''
-                        exit(1)
-                    #log.info('   ' + cmd)
-                    #result = subprocess.call(cmd.split())
-                    #print result
-                    #if result == 0:
-                    #    self.__connect()
-
-                except sqlite3.OperationalError, err:
-                    log.exception('SQLite DB error. Please, send the log file to vlad.saveliev@me.com.')
-                    return 1
-
+            self.conn = connections().mysql_connection(self.settings, self.step)
         else:
-            self.__connect()
+            self.conn = connections().sqlite_connection(self.data_fpath)
 
         self.cursor = self.conn.cursor()
         return self.cursor
 
     def __exit__(self, type, err, traceback):
         self.cursor.close()
-        self.conn.close()
-
         if self.db_vendor == 'mysql':
+            self.conn.close()  # back to the pool
+
             if isinstance(err, mysql.connector.Error):
-                if err.errno == mysql.connector.errorcode.ER_ACCESS_DENIED_ERROR:
+                if err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
                     log.error('Either incorrect user name or password')
-                elif err.errno == mysql.connector.errorcode.ER_BAD_DB_ERROR:
+                elif err.errno == errorcode.ER_BAD_DB_ERROR:
                     log.error('Database orthomcl does not exist')
                 else:
-                    log.error(err)
\ No newline at end of file
+                    log.error(err)
@@ -0,0 +1,174 @@
+""" Entrez requests shared by all processes and threads: at most
+    requests_per_second() requests a second, retried with a growing delay.
+    An NCBI API key (the NCBI_API_KEY environment variable or ncbi_api_key
+    in the settings of the running workflow) raises the limit.
+    Fetched protein sequences are kept in an SQLite cache, so that reruns
+    do not fetch them again.
+"""
+import multiprocessing
+import sqlite3
+from os import makedirs, environ
+from os.path import dirname, isdir
+from StringIO import StringIO
+from time import time, sleep
+from urllib2 import URLError, HTTPError
+from Bio import Entrez, SeqIO
+
+import config
+import logging
+log = logging.getLogger(config.log_fname)
+
+
+Entrez.email = 'vladislav.sav@gmail.com'
+
+MAX_ATTEMPTS = 4
+PROTEINS_PER_REQUEST = 200
+
+# Created on import, so processes forked later share them
+_lock = multiprocessing.Lock()
+_last_request = multiprocessing.Value('d', 0.0, lock=False)
+
+
+def api_key(settings=None):
+    settings = settings or config.current_settings()
+    return environ.get('NCBI_API_KEY') or settings.get('ncbi_api_key') or None
+
+
+def requests_per_second(settings=None):
+    return 10 if api_key(settings) else 3  # NCBI's limits
+
+
+def _wait_turn(rate):
+    with _lock:
+        delay = _last_request.value + 1.0 / rate - time()
+        if delay > 0:
+            sleep(delay)
+        _last_request.value = time()
+
+
+def _is_permanent(e):
+    """ Bad ids and the like: repeating the request would not help.
+    """
+    return isinstance(e, HTTPError) and 400 <= e.code < 500 and e.code != 429
+
+
+def _request(entrez_function, read=None, **kwargs):
+    """ Calls read(handle) on the response, handle.read() by default.
+    """
+    settings = config.current_settings()
+    key = api_key(settings)
+    if key:
+        kwargs.setdefault('api_key', key)
+    rate = requests_per_second(settings)
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        _wait_turn(rate)
+        try:
+            handle = entrez_function(**kwargs)
+            try:
+                return read(handle) if read else handle.read()
+            finally:
+                handle.close()
+        except (URLError, IOError), e:
+            if attempt == MAX_ATTEMPTS or _is_permanent(e):
+                raise
+            log.warn('   Entrez request failed (%s), retrying in %d seconds.' % (e, 2 ** attempt))
+            sleep(2 ** attempt)
+
+
+def efetch(**kwargs):
+    """ Entrez.efetch returning the text of the response.
+    """
+    return _request(Entrez.efetch, **kwargs)
+
+
+def efetch_stream(read, **kwargs):
+    """ Entrez.efetch passing the response to read(handle) as it arrives;
+        on a retry, read is called again with a new response.
+    """
+    return _request(Entrez.efetch, read=read, **kwargs)
+
+
+def accession_versions(ids, db='nuccore'):
+    """ Returns {id: accession.version} for GI numbers or accessions without
+        a version, with one esummary request per PROTEINS_PER_REQUEST ids.
+    """
+    versions = dict()
+    for start in range(0, len(ids), PROTEINS_PER_REQUEST):
+        batch = ids[start:start + PROTEINS_PER_REQUEST]
+        for summary in _request(Entrez.esummary, read=Entrez.read, db=db, id=','.join(batch)):
+            acc_ver = str(summary.get('AccessionVersion', ''))
+            for candidate in [str(summary.get('Id', '')), acc_ver.split('.')[0], acc_ver]:
+                if candidate in batch:
+                    versions[candidate] = acc_ver
+    return versions
+
+
+class ProteinCache:
+    def __init__(self, fpath=config.fetched_proteins_cache):
+        if dirname(fpath) and not isdir(dirname(fpath)):
+            try:
+                makedirs(dirname(fpath))
+            except OSError:
+                if not isdir(dirname(fpath)):
+                    raise
+        self.conn = sqlite3.connect(fpath, timeout=60)
+        self.conn.text_factory = str
+        self.conn.execute('CREATE TABLE IF NOT EXISTS proteins '
+                          '(protein_id TEXT PRIMARY KEY, sequence TEXT)')
+        self.conn.commit()
+
+    def get(self, protein_ids):
+        found = dict()
+        for protein_id in protein_ids:
+            row = self.conn.execute('SELECT sequence FROM proteins WHERE protein_id = ?',
+                                    (protein_id,)).fetchone()
+            if row:
+                found[protein_id] = row[0]
+        return found
+
+    def put(self, sequences):
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO proteins VALUES (?, ?)', sequences.items())
+
+    def close(self):
+        self.conn.close()
+
+
+def _requested_id(rec_id, protein_ids, by_accession):
+    """ NCBI may name a protein "NP_1.1", "ref|NP_1.1|" or drop the version.
+    """
+    for candidate in [rec_id] + rec_id.split('|'):
+        if candidate in protein_ids:
+            return candidate
+        if candidate.split('.')[0] in by_accession:
+            return by_accession[candidate.split('.')[0]]
+    return None
+
+
+def fetch_proteins(protein_ids, cache_fpath=config.fetched_proteins_cache,
+                   batch_size=PROTEINS_PER_REQUEST):
+    """ Returns {protein id: sequence} for the ids found in the cache or at
+        NCBI, fetching the others in batches of batch_size.
+    """
+    cache = ProteinCache(cache_fpath)
+    try:
+        sequences = cache.get(protein_ids)
+        missing = [i for i in protein_ids if i not in sequences]
+        if sequences:
+            log.debug('   %d of %d proteins found in the cache.' % (len(sequences), len(protein_ids)))
+
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start:start + batch_size]
+            by_accession = dict((i.split('.')[0], i) for i in batch)
+
+            text = efetch(db='protein', id=','.join(batch), retmode='text', rettype='fasta')
+            fetched = dict()
+            for rec in SeqIO.parse(StringIO(text), 'fasta'):
+                protein_id = _requested_id(rec.id, set(batch), by_accession)
+                if protein_id and str(rec.seq):
+                    fetched[protein_id] = str(rec.seq)
+            cache.put(fetched)
+            sequences.update(fetched)
+    finally:
+        cache.close()
+    return sequences
@@ -1,11 +1,14 @@
 from genericpath import isfile
-from itertools import chain
-from os import mkdir, remove
+from itertools import chain, islice, imap
+from multiprocessing.pool import ThreadPool
+from os import mkdir, remove, rename
 from os.path import join, isdir, basename
 from ftplib import FTP
 import urllib2
 from utils import read_list
 from ftp_proxy import setup_http_proxy
+from annotation_cache import open_cache
+from entrez_fetch import accession_versions, efetch_stream, requests_per_second
 from Bio import Entrez, SeqIO
 Entrez.email = 'vladislav.sav@gmail.com'
 
@@ -52,47 +55,225 @@ def fetch_annotations_for_species_from_ftp(save_dir, species_names, proxy=None,
     return 0
 
 
-def __range_of_ref_ids(rng):
+ANNOTATIONS_PER_REQUEST = 10  # complete genomes with sequence, a few MB each
+
+
+def __is_valid_range(rng):
     if ':' not in rng:
-        return [rng]
+        return True
+
+    if '.' in rng:
+        log.error('   Incorrect ids range: ids must not contain dots: ' + rng)
+        return False
 
-    else:
-        ids = []
-        start, end = rng.split(':')
+    start, end = rng.split(':')
+    if [c for c in start if not c.isdigit()] != [c for c in end if not c.isdigit()]:
+        log.error('   Incorrect ids range, non-digit parts must be equal: ' + rng)
+        return False
 
-        start_digits, start_chars, end_digits, end_chars = [], [], [], []
+    return True
 
-        if '.' in rng:
-            log.error('   Incorrect ids range: ids must not contain dots: ' + rng)
-            return [None]
 
-        for c in start:
-            if c.isdigit():
-                start_digits += c
-            else:
-                start_chars += c
+def __range_of_ref_ids(rng):
+    """ Yields the ids of a range like NC_000001:NC_000100, or the id itself.
+    """
+    if ':' not in rng:
+        yield rng
+        return
+
+    start, end = rng.split(':')
+    chars = ''.join(c for c in start if not c.isdigit())
+    start_digits = ''.join(c for c in start if c.isdigit())
+    end_digits = ''.join(c for c in end if c.isdigit())
+
+    for i in xrange(int(start_digits), int(end_digits) + 1):
+        yield chars + str(i).zfill(len(start_digits))
+
+
+def _batches(ids, size):
+    ids = iter(ids)
+    while True:
+        batch = list(islice(ids, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _resolve_versions(ids, cache):
+    """ accession.version of every id, to look it up in the annotation cache.
+    """
+    if cache is None:
+        return dict()
+    versions = dict((i, i) for i in ids if '.' in i)
+    unversioned = [i for i in ids if '.' not in i]
+    if unversioned:
+        try:
+            versions.update(accession_versions(unversioned))
+        except (urllib2.URLError, IOError, RuntimeError), e:
+            log.warn('   Cannot get versions of the ids (%s), fetching them all.' % e)
+    return versions
 
-        for c in end:
-            if c.isdigit():
-                end_digits += c
-            else:
-                end_chars += c
 
-        if start_chars != end_chars:
-            log.error('   Incorrect ids range, non-digit parts must be equal: ' + rng)
-            return [None]
+def _from_cache(cache, versions, ref_id, gb_fpath):
+    """ Links the cached record into gb_fpath and returns its accession.version.
+    """
+    if cache and versions.get(ref_id) and cache.get(versions[ref_id], gb_fpath):
+        return versions[ref_id]
+    return None
 
-        for i in range(int(''.join(start_digits)), int(''.join(end_digits)) + 1):
-            ids.append(''.join(start_chars) +
-                       ''.join(['0'] * (len(start_digits) - len(str(i)))) +
-                       str(i))
 
-        return ids
+def _to_cache(cache, gb_fpath):
+    if cache:
+        try:
+            cache.put(gb_fpath)
+        except (OSError, IOError), e:
+            log.warn('   Cannot save %s to the annotation cache: %s' % (gb_fpath, e))
+
+
+class GenbankSummary:
+    """ What is reported about a GenBank record, gathered from its lines
+        as they are written, without parsing the record.
+    """
+    def __init__(self):
+        self.names = []  # LOCUS name, accession.version, accession, GI
+        self.description = ''
+        self.genes = 0
+        self.cds = 0
+        self.__section = None
+
+    def feed(self, line):
+        if line[:1] not in ' \n':
+            self.__section = line[:12].strip()
+            value = line[12:].strip()
+            if self.__section == 'LOCUS' and value:
+                self.names.append(value.split()[0])
+            elif self.__section == 'DEFINITION':
+                self.description = value
+            elif self.__section == 'VERSION':
+                for field in value.split():
+                    if field.startswith('GI:'):
+                        self.names.append(field[3:])
+                    else:
+                        self.names.extend([field, field.split('.')[0]])
+
+        elif self.__section == 'DEFINITION':
+            self.description += ' ' + line.strip()
+
+        elif self.__section == 'FEATURES' and line[5:6].strip():
+            key = line[5:21].strip()
+            if key == 'gene':
+                self.genes += 1
+            elif key == 'CDS':
+                self.cds += 1
+
+
+def _summary_of(gb_fpath):
+    summary = GenbankSummary()
+    with open(gb_fpath) as f:
+        for line in f:
+            summary.feed(line)
+            if line.startswith('//'):
+                break
+    return summary
+
+
+def _write_records(handle, ref_ids, annotations_dir):
+    """ Writes every record of the response to <ref id>.gb while reading it.
+        Returns {ref id: GenbankSummary}.
+    """
+    found = dict()
+    remaining = list(ref_ids)
+    tmp_fpath = join(annotations_dir, '.' + ref_ids[0] + '.gb.tmp')
+    out, summary = None, None
+    try:
+        for line in iter(handle.readline, ''):
+            if out is None:
+                if not line.strip():
+                    continue
+                out = open(tmp_fpath, 'w')
+                summary = GenbankSummary()
+            out.write(line)
+            summary.feed(line)
+
+            if line.startswith('//'):
+                out.close()
+                out = None
+                # Records come in the order of ids, but the names are more reliable
+                matching = [i for i in remaining if i in summary.names] or remaining[:1]
+                if not matching:
+                    log.warn('   Unexpected record ' + ' '.join(summary.names[:1]) + ' in the response.')
+                    remove(tmp_fpath)
+                    continue
+                remaining.remove(matching[0])
+                rename(tmp_fpath, join(annotations_dir, matching[0] + '.gb'))
+                found[matching[0]] = summary
+    finally:
+        if out:
+            out.close()
+        if isfile(tmp_fpath):
+            remove(tmp_fpath)
+    return found
+
+
+def _download(ref_ids, annotations_dir):
+    """ Returns {ref id: GenbankSummary} and {ref id: HTTPError}. A bad id
+        fails the whole request, so then the ids are requested one by one.
+    """
+    try:
+        return efetch_stream(lambda handle: _write_records(handle, ref_ids, annotations_dir),
+                             db='nucleotide', id=','.join(ref_ids),
+                             retmode='text', rettype='gbwithparts'), dict()
+    except urllib2.HTTPError, e:
+        if len(ref_ids) == 1:
+            return dict(), {ref_ids[0]: e}
+
+    summaries, errors = dict(), dict()
+    for ref_id in ref_ids:
+        found, failed = _download([ref_id], annotations_dir)
+        summaries.update(found)
+        errors.update(failed)
+    return summaries, errors
+
+
+def _fetch_batch((ref_ids, annotations_dir, settings)):
+    """ Runs in a thread of the pool. Returns [(ref id, gb file, GenbankSummary
+        or None, accession.version if taken from the cache, error)].
+    """
+    with config.using_settings(settings):
+        return _fetch(ref_ids, annotations_dir)
+
+
+def _fetch(ref_ids, annotations_dir):
+    cache = open_cache()
+    try:
+        versions = _resolve_versions(ref_ids, cache)
+        summaries, errors, cached = dict(), dict(), dict()
+        for ref_id in ref_ids:
+            gb_fpath = join(annotations_dir, ref_id + '.gb')
+            cached[ref_id] = _from_cache(cache, versions, ref_id, gb_fpath)
+            if cached[ref_id]:
+                summaries[ref_id] = _summary_of(gb_fpath)
+
+        to_download = [i for i in ref_ids if not cached[i]]
+        if to_download:
+            downloaded, errors = _download(to_download, annotations_dir)
+            for ref_id in downloaded:
+                _to_cache(cache, join(annotations_dir, ref_id + '.gb'))
+            summaries.update(downloaded)
+    finally:
+        if cache:
+            cache.close()
+
+    return [(ref_id, join(annotations_dir, ref_id + '.gb'), summaries.get(ref_id),
+             cached[ref_id], errors.get(ref_id)) for ref_id in ref_ids]
 
 
 def fetch_annotations_for_ids(annotations_dir, ref_ids, proxy=None):
-    ref_ids = list(chain(*[__range_of_ref_ids(line) for line in ref_ids]))
-    if None in ref_ids:
+    """ Downloads the records in batches of ANNOTATIONS_PER_REQUEST ids from
+        as many threads as requests are allowed per second. Ranges of ids are
+        expanded as they are fetched.
+    """
+    if not all([__is_valid_range(line) for line in ref_ids]):
         return 1
 
     if not isdir(annotations_dir):
@@ -103,46 +284,51 @@ def fetch_annotations_for_ids(annotations_dir, ref_ids, proxy=None):
 
     if ref_ids == []:
         log.info('   No references have been found.')
-        ids = raw_input('   Put reference ids manually:').split()
-        if ids == []:
+        ref_ids = raw_input('   Put reference ids manually:').split()
+        if ref_ids == []:
             log.error('   No references :(')
             return 1
 
     log.info('   IDs: %s' % ', '.join(ref_ids))
 
-    for i, ref_id in enumerate(ref_ids):
-        log.info('   Fetching annotations for %s...' % ref_id)
-
-        try:
-            try:
-                fetch_handle = Entrez.efetch(db='nucleotide', id=ref_id,
-                                             retmode='text', rettype='gbwithparts')
-
-            except urllib2.HTTPError as e:
-                log.error('   Error: cannot fetch data for reference id ' + ref_id)
-                log.error('   Http error code: %s, reason: %s' % (str(e.code), str(e.reason)))
-                return -1
-            else:
-                gb_fpath = join(annotations_dir, ref_id + '.gb')
-                with open(gb_fpath, 'w') as file:
-                    file.write(fetch_handle.read())
-
-                rec = SeqIO.read(gb_fpath, 'genbank')
-                genes_number = 0
-                cds_number = 0
-                for f in rec.features:
-                    if f.type == 'gene':
-                        genes_number += 1
-                    if f.type == 'CDS':
-                        cds_number += 1
-                log.info('       ' + rec.description)
-                log.info('       %d genes, %d coding regions found.' % (genes_number, cds_number))
-                log.info('       saved %s' % gb_fpath)
-                if i + 1 < len(ref_ids):
-                    log.info('')
+    ids = chain.from_iterable(imap(__range_of_ref_ids, ref_ids))
+    settings = config.current_settings()
+    batches = ((batch, annotations_dir, settings) for batch in _batches(ids, ANNOTATIONS_PER_REQUEST))
+    threads = requests_per_second(settings)
+    pool = ThreadPool(threads)
+    try:
+        first = True
+        while True:
+            # A few batches at a time, so that a long range is never expanded as a whole
+            window = list(islice(batches, threads * 2))
+            if not window:
+                break
+            for results in pool.map(_fetch_batch, window):
+                for ref_id, gb_fpath, summary, cached, error in results:
+                    if not first:
+                        log.info('')
+                    first = False
+                    log.info('   Fetching annotations for %s...' % ref_id)
+
+                    if error:
+                        log.error('   Error: cannot fetch data for reference id ' + ref_id)
+                        log.error('   Http error code: %s, reason: %s' % (str(error.code), str(error.reason)))
+                        return -1
+                    if summary is None:
+                        log.error('   Error: no record for reference id ' + ref_id + ' in the response')
+                        return -1
+
+                    if cached:
+                        log.info('       %s taken from the annotation cache' % cached)
+                    log.info('       ' + summary.description)
+                    log.info('       %d genes, %d coding regions found.' % (summary.genes, summary.cds))
+                    log.info('       saved %s' % gb_fpath)
 
-        except KeyboardInterrupt, e:
-            return 1
+    except KeyboardInterrupt, e:
+        pool.terminate()
+        return 1
+    finally:
+        pool.close()
 
     return 0
 
@@ -155,60 +341,68 @@ def fetch_annotations_species_name_entrez(save_dir, species_names, clip=100000):
     if not isdir(save_dir):
         mkdir(save_dir)
 
-    for species_i, species_name in enumerate(species_names):
-        species_name = species_name.strip()
-        if species_name == '' or species_name[0] == '#':
-            continue
+    cache = open_cache()
+    try:
+        for species_i, species_name in enumerate(species_names):
+            species_name = species_name.strip()
+            if species_name == '' or species_name[0] == '#':
+                continue
 
-        term = '(%s[Organism] AND (complete genome[Title] OR ' \
-               'complete sequence[Title] OR whole genome[Title])) NOT (partial[Title])' % species_name
-        log.info('   Query: %s' % term)
-        search_handle = Entrez.esearch(db='nuccore', retmax=100000, term=term)
-        ids = Entrez.read(search_handle)['IdList']
+            term = '(%s[Organism] AND (complete genome[Title] OR ' \
+                   'complete sequence[Title] OR whole genome[Title])) NOT (partial[Title])' % species_name
+            log.info('   Query: %s' % term)
+            search_handle = Entrez.esearch(db='nuccore', retmax=100000, term=term)
+            ids = Entrez.read(search_handle)['IdList']
 
-        if ids == []:
-            log.info('   No references are found.')
-            ids = raw_input('   Put reference ids manually:').split()
             if ids == []:
-                log.error('   No references :(')
-                return 1
-
-        log.info('   IDs (totally %d): %s' % (len(ids), ', '.join(ids)))
-
-        for i, id in enumerate(ids):
-            log.info('   Fetching %s...' % id)
+                log.info('   No references are found.')
+                ids = raw_input('   Put reference ids manually:').split()
+                if ids == []:
+                    log.error('   No references :(')
+                    return 1
+
+            log.info('   IDs (totally %d): %s' % (len(ids), ', '.join(ids)))
+            versions = _resolve_versions(ids, cache)
+
+            for i, id in enumerate(ids):
+                log.info('   Fetching %s...' % id)
+
+                gb_fpath = join(save_dir, str(species_i + 1) + '_' + str(i + 1) + '_' + id + '.gb')
+                cached = _from_cache(cache, versions, id, gb_fpath)
+                if cached:
+                    log.info('       %s taken from the annotation cache' % cached)
+                else:
+                    fetch_handle = Entrez.efetch(db='nuccore', id=id, retmode='text',
+                                                 rettype='gbwithparts')
+                    with open(gb_fpath, 'w') as file:
+                        try:
+                            data = fetch_handle.read()
+                            file.write(data)
+                        except:
+                            log.warning('Could not fetch annotation in ' + gb_fpath)
+                            log.exception(file=config.log_fname)
+
+                    if not isfile(gb_fpath):
+                        log.debug('No file ' + gb_fpath)
+                        continue
+                    with open(gb_fpath) as gb_f:
+                        if not gb_f.read(1):
+                            log.debug(gb_fpath + ' is empty.')
+                            continue
+                    _to_cache(cache, gb_fpath)
 
-            fetch_handle = Entrez.efetch(db='nuccore', id=id, retmode='text',
-                                         rettype='gbwithparts')
-            gb_fpath = join(save_dir, str(species_i + 1) + '_' + str(i + 1) + '_' + id + '.gb')
-            with open(gb_fpath, 'w') as file:
                 try:
-                    data = fetch_handle.read()
-                    file.write(data)
-                except:
-                    log.warning('Could not fetch annotation in ' + gb_fpath)
-                    log.exception(file=config.log_fname)
-
-            if not isfile(gb_fpath):
-                log.debug('No file ' + gb_fpath)
-                continue
-            with open(gb_fpath) as gb_f:
-                if gb_f.read():
-                    log.debug(gb_fpath + ' is empty.')
-                    continue
-
-            try:
-                rec = SeqIO.read(gb_fpath, 'gb')
-            except ValueError, e:
-                log.warning('Could not read annotation in ' + gb_fpath)
-            else:
-                log.info('       Organism: ' + rec.annotations['organism'])
-                log.info('       Definition: ' + rec.description)
-                if 'plasmid' in rec.description:
-                    remove(gb_fpath)
+                    rec = SeqIO.read(gb_fpath, 'gb')
+                except ValueError, e:
+                    log.warning('Could not read annotation in ' + gb_fpath)
                 else:
-                    log.info('       saved %s' % gb_fpath)
-                log.info('')
+                    log.info('       Organism: ' + rec.annotations['organism'])
+                    log.info('       Definition: ' + rec.description)
+                    if 'plasmid' in rec.description:
+                        remove(gb_fpath)
+                    else:
+                        log.info('       saved %s' % gb_fpath)
+                    log.info('')
 
             #fetch_handle = Entrez.efetch(db='nuccore', id=id, retmode='text', rettype=fasta_ext, **kwargs)
             #fasta_fpath = join(dirpath, str(i) + '_' + id + '.' + fasta_ext)
@@ -217,6 +411,10 @@ def fetch_annotations_species_name_entrez(save_dir, species_names, clip=100000):
             #    file.write(fetch_handle.read())
             #    print 'and .fasta'
 
+    finally:
+        if cache:
+            cache.close()
+
     return 0
 
 
@@ -0,0 +1,158 @@
+""" Splitting proteomes into good and poor proteins, as orthomclFilterFasta.pl
+    does and with the same output, but reading the files in parallel.
+
+    A protein is poor if it is shorter than min_length or more than
+    max_percent_stop percent of its sequence are not letters (stop codons
+    like "*"). The counts are saved next to the good proteins (see
+    read_stats), so that later steps do not have to count the records again.
+"""
+import json
+import re
+import string
+from itertools import izip
+from multiprocessing import Pool, cpu_count
+from os import listdir, rename, stat
+from os.path import join, isfile
+
+import config
+import logging
+log = logging.getLogger(config.log_fname)
+
+
+# orthomclFilterFasta.pl counts the characters of tr/[^A-Za-z]//, that is
+# letters and "[", "^", "]"; the rest are taken for stop codons
+_LETTERS = string.ascii_letters + '[^]'
+
+_extensions = [re.compile(r'(\S+)\.fasta$'), re.compile(r'(\S+)\.faa$'), re.compile(r'(\S+)\.fa$')]
+
+
+def proteome_files(proteomes_dir):
+    """ Returns [(path, taxon code)] in the order of the directory listing.
+    """
+    files = []
+    for fname in listdir(proteomes_dir):
+        if fname.startswith('.'):
+            continue
+        matches = filter(None, (e.search(fname) for e in _extensions))
+        if not matches:
+            log.debug('   Skipping file "%s" that is not in .faa or .fa or .fasta format' % fname)
+            continue
+        files.append((join(proteomes_dir, fname), matches[0].group(1)))
+    return files
+
+
+def _filter_file(args):
+    """ Returns (good text, poor text, [records, poor records, good residues]).
+        Raises ValueError on the errors orthomclFilterFasta.pl dies on.
+    """
+    fpath, taxon, min_length, max_percent_stop = args
+    with open(fpath, 'rb') as f:
+        lines = f.read().split('\n')
+    if lines and lines[-1] == '':
+        lines.pop()
+
+    good, poor = [], []
+    counts = [0, 0, 0]
+    record, length, stops = [], 0, 0
+
+    def handle():
+        counts[0] += 1
+        if length < min_length or float(stops) / length * 100 > max_percent_stop:
+            poor.extend(record)
+            counts[1] += 1
+        else:
+            good.extend(record)
+            counts[2] += length
+
+    for line in lines:
+        if '>' in line:
+            if not line.startswith('>') or line[1:].split('|', 1)[0] != taxon:
+                raise ValueError('The ID on def line "%s" is missing the prefix "%s|"' % (line, taxon))
+            if record:
+                if length == 0:
+                    raise ValueError('Zero length sequence in file %s. Look near line "%s"' % (fpath, line))
+                handle()
+                record, length, stops = [], 0, 0
+        else:
+            length += len(line)
+            stops += len(line.translate(None, _LETTERS))
+        record.append(line + '\n')
+
+    handle()
+    return ''.join(good), ''.join(poor), counts
+
+
+def filter_proteomes(proteomes_dir, min_length, max_percent_stop,
+                     good_fpath, poor_fpath, processes=None):
+    """ Returns the counts, like read_stats, or None on error.
+    """
+    files = proteome_files(proteomes_dir)
+    if not files:
+        log.error('   No .fasta, .faa or .fa files in ' + proteomes_dir)
+        return None
+
+    jobs = [(fpath, taxon, float(min_length), float(max_percent_stop)) for fpath, taxon in files]
+    processes = min(processes or cpu_count(), len(jobs))
+    pool = Pool(processes) if processes > 1 else None
+    stats = dict(records=0, good_records=0, poor_records=0, good_residues=0)
+    reject_rates = []
+    try:
+        results = pool.imap(_filter_file, jobs) if pool else (_filter_file(j) for j in jobs)
+        with open(good_fpath + '.tmp', 'w') as good_f, open(poor_fpath + '.tmp', 'w') as poor_f:
+            for (fpath, _), (good, poor, (records, rejected, residues)) in izip(files, results):
+                log.debug('   Processed ' + fpath)
+                good_f.write(good)
+                poor_f.write(poor)
+                stats['records'] += records
+                stats['poor_records'] += rejected
+                stats['good_records'] += records - rejected
+                stats['good_residues'] += residues
+                if rejected and rejected * 100.0 / records > 10:
+                    reject_rates.append((fpath, rejected * 100.0 / records))
+    except (ValueError, ZeroDivisionError), e:
+        log.error('   ' + str(e))
+        return None
+    finally:
+        if pool:
+            pool.terminate()
+
+    rename(good_fpath + '.tmp', good_fpath)
+    rename(poor_fpath + '.tmp', poor_fpath)
+
+    if reject_rates:
+        log.info('   Proteomes with > 10% poor proteins:')
+        for fpath, percent in sorted(reject_rates, key=lambda (_, p): -p):
+            log.info('     %s\t%d%%' % (fpath, int(percent)))
+    log.info('   %d good proteins (%d residues), %d poor proteins.' % (
+        stats['good_records'], stats['good_residues'], stats['poor_records']))
+
+    _save_stats(good_fpath, stats)
+    return stats
+
+
+def _stats_fpath(fasta):
+    return fasta + '.stats'
+
+
+def _save_stats(fasta, stats):
+    st = stat(fasta)
+    with open(_stats_fpath(fasta), 'w') as f:
+        json.dump(dict(stats, size=st.st_size, mtime=st.st_mtime), f)
+
+
+def read_stats(fasta):
+    """ Counts of the last filter_proteomes that produced fasta:
+        {'records', 'good_records', 'poor_records', 'good_residues'},
+        or None if fasta has changed since then.
+    """
+    if not isfile(_stats_fpath(fasta)) or not isfile(fasta):
+        return None
+    try:
+        with open(_stats_fpath(fasta)) as f:
+            stats = json.load(f)
+    except ValueError:
+        return None
+    st = stat(fasta)
+    if stats.pop('size', None) != st.st_size or stats.pop('mtime', None) != st.st_mtime:
+        return None
+    return stats
@@ -0,0 +1,123 @@
+""" Adding new proteomes to an existing all-vs-all BLAST.
+
+    Instead of blasting everything against everything again, only the new
+    proteins are blasted against all proteins and the old proteins against
+    the new ones; the results are merged into the old output so that hits
+    of every query stay together and sorted as BLAST sorts them.
+"""
+from itertools import groupby
+from os import rename
+from Bio import SeqIO
+
+import config
+import logging
+log = logging.getLogger(config.log_fname)
+
+
+def _taxon(seq_id):
+    return seq_id.split('|', 1)[0]
+
+
+def read_taxa(fasta):
+    """ Taxa of proteins named as "taxon|id", like orthomclAdjustFasta makes them.
+    """
+    taxa = set()
+    with open(fasta) as f:
+        for line in f:
+            if line.startswith('>'):
+                taxa.add(_taxon(line[1:].split(None, 1)[0]))
+    return taxa
+
+
+def _queries_in_order(blast_out):
+    seen = set()
+    with open(blast_out) as f:
+        for line in f:
+            query = line.split('\t', 1)[0]
+            if query and query not in seen:
+                seen.add(query)
+                yield query
+
+
+def write_old_proteins(good_proteins, old_blast_out, new_taxa, out_fpath):
+    """ Writes the proteins not of new_taxa in the order their queries
+        appear in old_blast_out, so that the search of them against the new
+        proteins can be merged with it in one pass. Returns the number of proteins.
+    """
+    index = SeqIO.index(good_proteins, 'fasta')
+    try:
+        written = set()
+        with open(out_fpath, 'w') as out:
+            for query in _queries_in_order(old_blast_out):
+                if query in index and _taxon(query) not in new_taxa:
+                    out.write(index.get_raw(query))
+                    written.add(query)
+            # proteins without any hits in the old output
+            for seq_id in index:
+                if seq_id not in written and _taxon(seq_id) not in new_taxa:
+                    out.write(index.get_raw(seq_id))
+                    written.add(seq_id)
+    finally:
+        index.close()
+    return len(written)
+
+
+def _query_blocks(fpath):
+    """ Yields (query, [lines]) for consecutive lines of the same query.
+    """
+    with open(fpath) as f:
+        for query, lines in groupby(f, key=lambda l: l.split('\t', 1)[0]):
+            if query.strip():
+                yield query, list(lines)
+
+
+def _subject_blocks(lines):
+    """ HSPs of the same subject are kept together, ordered by their best hit.
+    """
+    return [list(hsps) for _, hsps in groupby(lines, key=lambda l: l.split('\t', 2)[1])]
+
+
+def _subject_key(hsps):
+    fields = hsps[0].rstrip('\n').split('\t')
+    return float(fields[10]), -float(fields[11])
+
+
+def merge_query_lines(old_lines, new_lines):
+    blocks = _subject_blocks(old_lines) + _subject_blocks(new_lines)
+    blocks.sort(key=_subject_key)  # stable: old hits go first on ties
+    return [l for hsps in blocks for l in hsps]
+
+
+def merge_blast_outputs(old_blast_out, old_vs_new, new_vs_all, out_fpath):
+    """ Merges the hits of the old queries against the new proteins into the
+        old output, query by query, and appends the hits of the new queries.
+        The hits of old_vs_new must go in the order of queries in old_blast_out.
+    """
+    with open(out_fpath + '.tmp', 'w') as out:
+        additions = _query_blocks(old_vs_new)
+        next_addition = next(additions, None)
+
+        for query, lines in _query_blocks(old_blast_out):
+            if next_addition and next_addition[0] == query:
+                lines = merge_query_lines(lines, next_addition[1])
+                next_addition = next(additions, None)
+            out.writelines(lines)
+
+        while next_addition:
+            out.writelines(next_addition[1])
+            next_addition = next(additions, None)
+
+        with open(new_vs_all) as f:
+            for line in f:
+                out.write(line)
+    rename(out_fpath + '.tmp', out_fpath)
+
+
+def is_merged(blast_out, new_taxa):
+    """ The hits of new proteins go last after merging.
+    """
+    with open(blast_out, 'rb') as f:
+        f.seek(0, 2)
+        f.seek(max(0, f.tell() - 64 * 1024))
+        lines = [l for l in f.read().split('\n') if l.strip()]
+    return bool(lines) and _taxon(lines[-1].split('\t', 1)[0]) in new_taxa
@@ -0,0 +1,94 @@
+""" A FASTA file with an index next to it (<fasta>.fai), written as the
+    records are added. The index has the columns of samtools faidx (name,
+    length, offset of the sequence, bases and bytes per line) and a tag of
+    the record, like the number of its group.
+"""
+from itertools import izip
+from os import rename, remove
+
+import config
+import logging
+log = logging.getLogger(config.log_fname)
+
+
+LINE_WIDTH = 60
+
+
+def fasta_title(rec_id, description):
+    """ The header Bio.SeqIO writes for a record.
+    """
+    if description and description.split(None, 1)[0] == rec_id:
+        return description
+    elif description:
+        return rec_id + ' ' + description
+    return rec_id
+
+
+class IndexedFastaWriter:
+    """ Written under temporary names and renamed on close.
+    """
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self.fasta_f = open(fpath + '.tmp', 'w')
+        self.index_f = open(fpath + '.fai.tmp', 'w')
+        self.offset = 0
+        self.records = 0
+
+    def write(self, rec_id, description, seq, tag=''):
+        seq = str(seq)
+        header = '>' + fasta_title(rec_id, description) + '\n'
+        lines = [seq[i:i + LINE_WIDTH] + '\n' for i in range(0, len(seq), LINE_WIDTH)]
+        self.fasta_f.write(header)
+        self.fasta_f.writelines(lines)
+        self.index_f.write('\t'.join(map(str, [
+            rec_id, len(seq), self.offset + len(header), LINE_WIDTH, LINE_WIDTH + 1, tag])) + '\n')
+        self.offset += len(header) + sum(len(l) for l in lines)
+        self.records += 1
+
+    def close(self):
+        self.fasta_f.close()
+        self.index_f.close()
+        rename(self.fpath + '.tmp', self.fpath)
+        rename(self.fpath + '.fai.tmp', self.fpath + '.fai')
+
+    def abort(self):
+        self.fasta_f.close()
+        self.index_f.close()
+        remove(self.fpath + '.tmp')
+        remove(self.fpath + '.fai.tmp')
+
+
+class IndexEntry:
+    def __init__(self, line):
+        fields = line.rstrip('\n').split('\t')
+        self.name = fields[0]
+        self.length, self.offset, self.line_bases, self.line_bytes = map(int, fields[1:5])
+        self.tag = fields[5] if len(fields) > 5 else ''
+
+
+def read_index(fpath):
+    """ Entries of <fpath>.fai in the order of the records.
+    """
+    with open(fpath + '.fai') as f:
+        return [IndexEntry(l) for l in f if l.strip()]
+
+
+def read_sequence(fasta_f, entry):
+    """ Random access to a record by its index entry.
+    """
+    full_lines, rest = divmod(entry.length, entry.line_bases)
+    fasta_f.seek(entry.offset)
+    data = fasta_f.read(full_lines * entry.line_bytes + rest)
+    return data.replace('\n', '').replace('\r', '')
+
+
+def iter_records(fpath):
+    """ Streams (record, tag) with Bio.SeqIO.
+    """
+    from Bio import SeqIO
+
+    for rec, entry in izip(SeqIO.parse(fpath, 'fasta'), read_index(fpath)):
+        if rec.id != entry.name:
+            raise ValueError('%s.fai does not match %s: %s instead of %s' % (
+                fpath, fpath, entry.name, rec.id))
+        yield rec, entry.tag
@@ -0,0 +1,154 @@
+from os import makedirs, rename
+from os.path import join, isdir, realpath
+from shutil import rmtree, copyfileobj
+from threading import Thread, Lock
+from Queue import Queue, Empty
+from time import sleep
+
+from Workflow import cmdline
+import run_report
+from filter_proteomes import read_stats
+
+import config
+import logging
+log = logging.getLogger(config.log_fname)
+
+
+def _fasta_records(fasta):
+    """ Yields (record lines, number of residues) without parsing sequences.
+    """
+    lines, residues = [], 0
+    with open(fasta) as f:
+        for line in f:
+            if line.startswith('>'):
+                if lines:
+                    yield lines, residues
+                lines, residues = [line], 0
+            elif lines:
+                lines.append(line)
+                residues += len(line.strip())
+    if lines:
+        yield lines, residues
+
+
+def split_fasta_by_residues(fasta, shards_dir, num_shards):
+    """ Splits fasta into up to num_shards consecutive shards with about the
+        same number of residues each, so concatenated outputs keep the order
+        of queries. Returns a list of (shard path, residues).
+    """
+    stats = read_stats(fasta)  # counted by filter_proteomes
+    total = stats['good_residues'] if stats else \
+        sum(residues for _, residues in _fasta_records(fasta))
+    if total == 0:
+        return []
+    per_shard = float(total) / num_shards
+
+    if isdir(shards_dir):
+        rmtree(shards_dir)
+    makedirs(shards_dir)
+
+    shards = []
+    out_f, shard_residues, done_residues = None, 0, 0
+    for lines, residues in _fasta_records(fasta):
+        if out_f is None:
+            fpath = join(shards_dir, 'shard_' + str(len(shards) + 1) + '.fasta')
+            out_f = open(fpath, 'w')
+            shard_residues = 0
+        out_f.writelines(lines)
+        shard_residues += residues
+        done_residues += residues
+        if done_residues >= per_shard * (len(shards) + 1):
+            out_f.close()
+            shards.append((fpath, shard_residues))
+            out_f = None
+    if out_f is not None:
+        out_f.close()
+        shards.append((fpath, shard_residues))
+    return shards
+
+
+def run_sharded_blast(blast_params, fasta, out_fpath, workers,
+                      threads_per_worker=1, shards_per_worker=4, max_attempts=3):
+    """ Runs blastp over residue-balanced shards of fasta by a pool of
+        workers, each taking the biggest shard left when it becomes free.
+        Failed shards are retried up to max_attempts times. The outputs are
+        concatenated in the order of the shards into out_fpath.
+    """
+    shards_dir = join(config.intermediate_dir, 'blast_shards')
+    num_workers = max(1, workers / threads_per_worker)
+    shards = split_fasta_by_residues(fasta, shards_dir, num_workers * shards_per_worker)
+    if not shards:
+        log.error('   No sequences in ' + fasta)
+        return 1
+    log.info('   Split %s into %d shards for %d blastp workers with %d threads each.' % (
+        fasta, len(shards), num_workers, threads_per_worker))
+
+    queue = Queue()
+    for i in sorted(range(len(shards)), key=lambda i: -shards[i][1]):
+        queue.put((i, 1))
+
+    shard_outs = [join(shards_dir, 'shard_' + str(i + 1) + '.tsv') for i in range(len(shards))]
+    failed = []
+    in_flight = [0]
+    lock = Lock()
+    step = run_report.current_step()
+
+    def worker():
+        with run_report.in_step(step):
+            work()
+
+    def work():
+        while True:
+            with lock:
+                if failed:
+                    return
+                try:
+                    i, attempt = queue.get_nowait()
+                except Empty:
+                    if in_flight[0] == 0:
+                        return
+                    i = None
+                else:
+                    in_flight[0] += 1
+            if i is None:
+                # another worker may yet put a failed shard back
+                sleep(1)
+                continue
+
+            params = blast_params + ['-query', realpath(shards[i][0]),
+                                     '-out', realpath(shard_outs[i] + '.tmp')]
+            if threads_per_worker > 1:
+                params += ['-num_threads', threads_per_worker]
+            res = cmdline('blastp', params, ignore_output_lines_by_pattern=
+                          r'.* at position .* replaced by .*')()
+            if res == 0:
+                rename(shard_outs[i] + '.tmp', shard_outs[i])
+            elif attempt < max_attempts:
+                log.warn('   Shard %d failed with code %d, retrying (attempt %d of %d).' % (
+                         i + 1, res, attempt + 1, max_attempts))
+                queue.put((i, attempt + 1))
+            else:
+                log.error('   Shard %d failed %d times, giving up.' % (i + 1, max_attempts))
+                with lock:
+                    failed.append(res)
+            with lock:
+                in_flight[0] -= 1
+
+    threads = [Thread(target=worker) for _ in range(min(num_workers, len(shards)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        while t.is_alive():
+            t.join(1)
+
+    if failed:
+        return failed[0]
+
+    with open(out_fpath + '.tmp', 'w') as out:
+        for shard_out in shard_outs:
+            with open(shard_out) as shard_f:
+                copyfileobj(shard_f, out)
+    rename(out_fpath + '.tmp', out_fpath)
+    rmtree(shards_dir)
+    return 0
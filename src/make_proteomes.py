@@ -3,13 +3,20 @@ from itertools import izip, count
 from shutil import rmtree, copy, copyfile
 import subprocess
 from sys import stderr
-from os import makedirs, chdir, mkdir, listdir, remove
-from os.path import join, isdir, basename, splitext
-from Bio import SeqIO, Entrez
-from Bio.Seq import Seq
+from os import makedirs, chdir, mkdir, listdir, remove, rename
+from os.path import join, isdir, basename, splitext, getsize
+from multiprocessing import Pool, cpu_count
+from time import time
+from traceback import format_exc
+from Bio import SeqIO
+from Bio.Seq import Seq, UnknownSeq
+from Bio.Data.CodonTable import TranslationError
 from Bio.Alphabet import generic_protein
 from Bio.SeqRecord import SeqRecord
 
+from entrez_fetch import fetch_proteins
+from annotation_index import AnnotationIndex, file_digest, reference_genes
+
 import config
 import logging
 log = logging.getLogger(config.log_fname)
@@ -50,7 +57,111 @@ def adjust_proteomes(prot_fpaths, proteomes_dir, prot_id_field):
     return 0
 
 
-def make_proteomes(annotations, proteomes_dir):
+def _proteins_from_genbank(gb_fpath, messages):
+    """ Returns (taxon code, protein records, genes for the annotation index),
+        or Nones if gb_fpath can not be read. Messages are collected as
+        (level, text) to be logged by the parent process.
+    """
+    try:
+        rec = SeqIO.read(gb_fpath, 'genbank')
+    except ValueError:
+        messages.append((logging.WARNING, '   Can not read proteins from ' + gb_fpath))
+        return None, None, None
+
+    features = [f for f in rec.features if f.type == 'CDS']
+    messages.append((logging.INFO, '   %s: translating %d features' % (rec.id, len(features))))
+
+    taxoncode = rec.id
+
+    proteins = []
+    translated, to_fetch = 0, []
+    for f in features:
+        qs = f.qualifiers
+        protein_id = qs.get('protein_id', [None])[0]
+        gene_id = qs.get('gene', [None])[0]
+        if not protein_id:
+            messages.append((logging.WARNING, '   Warning: no protein_id for CDS'))
+            continue
+        #if not gene_id:
+        #    log.warn('   Warning: no gene_id for CDS')
+        #    continue
+
+        protein_descripton = rec.id + ' ' + rec.description + \
+                             ' ' + 'Gene ' + (gene_id or '<unknown>') + \
+                             '. Protein ' + protein_id
+        translation = None
+        translation_field = qs.get('translation', [None])
+        if translation_field and len(translation_field) > 0 and translation_field[0]:
+            translation = Seq(qs.get('translation', [None])[0], generic_protein)
+
+        if not translation:
+            translation = _translate_from_genome(f, rec)
+            if translation:
+                translated += 1
+            else:
+                to_fetch.append(len(proteins))
+
+        proteins.append(SeqRecord(seq=translation, id=taxoncode + '|' + protein_id,
+                                  description=protein_descripton))
+
+    if translated or to_fetch:
+        messages.append((logging.INFO, '   Notice: %d CDS have no translation field: '
+                         '%d translated from the genome, %d to fetch from NCBI.' % (
+                         translated + len(to_fetch), translated, len(to_fetch))))
+    if to_fetch:
+        protein_ids = [proteins[k].id.split('|', 1)[1] for k in to_fetch]
+        fetched = fetch_proteins(protein_ids)
+        for k, protein_id in zip(to_fetch, protein_ids):
+            if protein_id in fetched:
+                proteins[k].seq = Seq(fetched[protein_id], generic_protein)
+            else:
+                messages.append((logging.WARNING, '   No results for protein_id ' + protein_id + ', skipping.'))
+        proteins = [p for p in proteins if p.seq is not None]
+
+    return taxoncode, proteins, reference_genes(rec)[1]
+
+
+def _translate_from_genome(feature, rec):
+    """ Translates the CDS from the record's own sequence, if it has one and
+        the CDS is complete; returns None otherwise.
+    """
+    if isinstance(rec.seq, UnknownSeq) or int(feature.qualifiers.get('codon_start', [1])[0]) != 1:
+        return None
+    trans_table = int(feature.qualifiers.get('transl_table', [11])[0])
+    try:
+        return feature.extract(rec.seq).translate(table=trans_table, cds=True)
+    except (TranslationError, ValueError):
+        return None
+
+
+def _make_proteome(args):
+    """ Converts one GenBank file, writing the proteome atomically.
+        Returns (messages, number of proteins, seconds, index entry),
+        the entry being (file digest, taxon code, genes) or None.
+    """
+    gb_fpath, proteomes_dir = args
+    started = time()
+    messages = []
+    try:
+        taxoncode, proteins, genes = _proteins_from_genbank(gb_fpath, messages)
+        if proteins:
+            fpath = join(proteomes_dir, taxoncode + '.fasta')
+            SeqIO.write(proteins, fpath + '.tmp', 'fasta')
+            rename(fpath + '.tmp', fpath)
+            messages.append((logging.INFO, '   Written to ' + fpath))
+        entry = (file_digest(gb_fpath), taxoncode, genes) if taxoncode else None
+    except Exception:
+        messages.append((logging.ERROR, '   Error converting ' + gb_fpath + ':\n' + format_exc()))
+        return messages, None, time() - started, None
+    return messages, len(proteins or []), time() - started, entry
+
+
+def make_proteomes(annotations, proteomes_dir, processes=None,
+                   index_fpath=config.annotation_index):
+    """ Converts GenBank files into proteomes with a pool of processes
+        (all cores by default). Messages are logged in the order of the files.
+        The genes are saved to the annotation index for save_orthogroups.
+    """
     gb_files = None
     if isinstance(annotations, (list, tuple)):
         gb_files = annotations
@@ -62,85 +173,49 @@ def make_proteomes(annotations, proteomes_dir):
             for fname in listdir(annotations_dir)
             if fname and fname[0] != '.']
 
-    if not gb_files: log.error('   No references provided.')
+    if not gb_files:
+        log.error('   No references provided.')
+        return 1
 
     if not isdir(proteomes_dir): makedirs(proteomes_dir)
 
     #words = ' '.join(species_names).split()
     #speciescode = workflow_id[:4]  # ''.join(w[0].lower() for w in words[:3 - int(math.log10(ref_num))])
 
-    i = 1
-    for gb_fpath in gb_files:
-        try:
-            rec = SeqIO.read(gb_fpath, 'genbank')
-        except ValueError:
-            log.warning('   Can not read proteins from ' + gb_fpath)
-            continue
-
-        features = [f for f in rec.features if f.type == 'CDS']
-        log.info('   %s: translating %d features' % (rec.id, len(features)))
-
-        taxoncode = rec.id
-
-        proteins = []
-        for f in features:
-            qs = f.qualifiers
-            protein_id = qs.get('protein_id', [None])[0]
-            gene_id = qs.get('gene', [None])[0]
-            if not protein_id:
-                log.warn('   Warning: no protein_id for CDS')
-                continue
-            #if not gene_id:
-            #    log.warn('   Warning: no gene_id for CDS')
-            #    continue
-
-            protein_descripton = rec.id + ' ' + rec.description + \
-                                 ' ' + 'Gene ' + (gene_id or '<unknown>') + \
-                                 '. Protein ' + protein_id
-            #log.debug('   ' + protein_descripton)
-            translation = None
-            translation_field = qs.get('translation', [None])
-            if translation_field and len(translation_field) > 0 and translation_field[0]:
-                translation = Seq(qs.get('translation', [None])[0], generic_protein)
-
-            if not translation:
-                # Translate ourselves
-                # TODO: Fetch reference
-                # read genome_seq
-                #trans_table = int(qs.get('transl_table', [11])[0])
-                #my_translation = f.extract(genome_seq).seq.translate(table=trans_table, to_stop=True, cds=True)
-                #print my_translation
-                #if translation:
-                #    assert str(my_translation) == str(translation)
-
-                log.info('   Notice: no translation field for ' + protein_descripton + ', translating from genome.')
-
-                fetch_handle = Entrez.efetch(db='protein', id=protein_id,
-                                             retmode='text', rettype='fasta')
-                try:
-                    rec = SeqIO.read(fetch_handle, 'fasta')
-                except ValueError:
-                    log.warning('   No results for protein_id ' + protein_id + ', skipping.')
-                    continue
-                else:
-                    translation = rec.seq
-                    log.info('   Fetched ' + str(rec.seq))
-                    if not translation:
-                        log.warning('   No results for protein_id ' + protein_id + ', skipping.')
-                        continue
-
-            proteins.append(SeqRecord(seq=translation, id=taxoncode + '|' + protein_id,
-                                      description=protein_descripton))
-            #log.debug('')
-
-        if proteins:
-            fpath = join(proteomes_dir, taxoncode + '.fasta')
-            SeqIO.write(proteins, fpath, 'fasta')
-            log.info('   Written to ' + fpath)
-            i += 1
+    processes = min(processes or cpu_count(), len(gb_files))
+    jobs = [(gb_fpath, proteomes_dir) for gb_fpath in sorted(gb_files)]
+    index = AnnotationIndex(index_fpath)
+    try:
+        if processes > 1:
+            log.info('   Converting %d files with %d processes.' % (len(jobs), processes))
+            pool = Pool(processes)
+            try:
+                results = pool.imap(_make_proteome, jobs)
+                res = _log_results(jobs, results, index)
+            finally:
+                pool.terminate()
+        else:
+            res = _log_results(jobs, (_make_proteome(job) for job in jobs), index)
+    finally:
+        index.close()
+    return res
+
+
+def _log_results(jobs, results, index):
+    res = 0
+    for (gb_fpath, _), (messages, num_proteins, took, entry) in izip(jobs, results):
+        for level, text in messages:
+            log.log(level, text)
+        if num_proteins is None:
+            res = 1
+        else:
+            log.info('   %s: %d proteins in %.1f seconds (%.1f MB/s)' % (
+                basename(gb_fpath), num_proteins, took,
+                getsize(gb_fpath) / 1024.0 / 1024.0 / max(took, 1e-3)))
+        if entry:
+            index.put(*entry, fpath=gb_fpath)
         log.info('')
-
-    return 0
+    return res
 
 
 #if __name__ == '__main__':
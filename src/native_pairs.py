@@ -0,0 +1,319 @@
+""" Finding ortholog, inparalog and coortholog pairs in memory with NumPy,
+    as orthomclPairs.pl does with temporary tables in the database, and
+    writing them out as orthomclDumpPairsFiles.pl does.
+
+    SimilarSequences is read from similar_sequences.txt into columns, with
+    proteins and taxa numbered in the order of their names, so comparing
+    numbers is the same as comparing names in SQL. Every (query, subject)
+    is expected to occur once, which blast_parser guarantees.
+"""
+from array import array
+from os import makedirs, rename
+from os.path import isdir, join
+from shutil import rmtree
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import config
+import logging
+log = logging.getLogger(config.log_fname)
+
+
+def is_available():
+    return np is not None
+
+
+def read_cutoffs(orthomcl_config):
+    """ Returns (evalueExponentCutoff, percentMatchCutoff) from orthomcl.config.
+    """
+    with open(orthomcl_config) as f:
+        conf = dict(l.strip().split('=', 1) for l in f
+                    if l.strip() and l.strip()[0] != '#' and '=' in l)
+    return int(conf['evalueExponentCutoff']), float(conf['percentMatchCutoff'])
+
+
+def _numbered(ids, names_by_id):
+    """ Renumbers ids so that the numbers follow the order of names.
+    """
+    names = sorted(names_by_id, key=names_by_id.get)
+    order = sorted(range(len(names)), key=names.__getitem__)
+    ranks = np.empty(len(names), dtype=np.int64)
+    ranks[order] = np.arange(len(names))
+    return ranks[np.frombuffer(ids, dtype=np.int64) if len(ids) else
+                 np.zeros(0, dtype=np.int64)], [names[i] for i in order]
+
+
+class SimilarSequences:
+    def __init__(self, fpath):
+        protein_ids, taxon_ids = dict(), dict()
+        query, subject, query_taxon, subject_taxon = [array('l') for _ in range(4)]
+        evalue_mant, evalue_exp, percent_match = array('d'), array('l'), array('d')
+
+        with open(fpath) as f:
+            for line in f:
+                fields = line.rstrip('\r\n').split('\t')
+                if len(fields) < 8:
+                    continue
+                query.append(protein_ids.setdefault(fields[0], len(protein_ids)))
+                subject.append(protein_ids.setdefault(fields[1], len(protein_ids)))
+                query_taxon.append(taxon_ids.setdefault(fields[2], len(taxon_ids)))
+                subject_taxon.append(taxon_ids.setdefault(fields[3], len(taxon_ids)))
+                evalue_mant.append(float(fields[4]))
+                evalue_exp.append(int(fields[5]))
+                percent_match.append(float(fields[7]))
+
+        assert array('l').itemsize == 8
+        self.query, self.proteins = _numbered(query, protein_ids)
+        self.subject, _ = _numbered(subject, protein_ids)
+        self.query_taxon, self.taxa = _numbered(query_taxon, taxon_ids)
+        self.subject_taxon, _ = _numbered(subject_taxon, taxon_ids)
+        self.evalue_mant = np.frombuffer(evalue_mant, dtype=np.float64).copy()
+        self.evalue_exp = np.frombuffer(evalue_exp, dtype=np.int64).copy()
+        self.percent_match = np.frombuffer(percent_match, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.query)
+
+    def pair_keys(self, rows):
+        return self.query[rows] * len(self.proteins) + self.subject[rows]
+
+
+def _group_firsts(keys, *then_by):
+    """ Sorts by keys and then by then_by (all ascending). Returns the sorting
+        order and the mask of the first sorted element of every key.
+    """
+    order = np.lexsort(tuple(reversed(then_by)) + (keys,))
+    sorted_keys = keys[order]
+    firsts = np.ones(len(order), dtype=bool)
+    firsts[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    return order, firsts
+
+
+def _join(left_keys, right_keys):
+    """ Indexes (i, j) of all pairs with left_keys[i] == right_keys[j].
+    """
+    order = np.argsort(right_keys, kind='mergesort')
+    sorted_keys = right_keys[order]
+    lo = np.searchsorted(sorted_keys, left_keys, 'left')
+    counts = np.searchsorted(sorted_keys, left_keys, 'right') - lo
+    i = np.repeat(np.arange(len(left_keys)), counts)
+    j = order[np.repeat(lo - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())]
+    return i, j
+
+
+def _lookup(sorted_keys, keys):
+    """ Positions of keys in sorted_keys and the mask of found ones.
+    """
+    pos = np.minimum(np.searchsorted(sorted_keys, keys), max(len(sorted_keys) - 1, 0))
+    found = sorted_keys[pos] == keys if len(sorted_keys) else np.zeros(len(keys), dtype=bool)
+    return pos, found
+
+
+def _scores(mant_1, exp_1, mant_2, exp_2, min_mant):
+    """ ( -log10(evalue1) - log10(evalue2) ) / 2, with the rigged exponents
+        for zero e-values, like in orthomclPairs.pl: integer division in the
+        first case and log10 as log(x) / log(10) in the second.
+    """
+    rigged = (mant_1 < min_mant) | (mant_2 < min_mant)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        logged = (np.log(mant_1 * mant_2) / np.log(10) + exp_1 + exp_2) / -2
+    return np.where(rigged, np.trunc((exp_1 + exp_2) / -2.0), logged)
+
+
+def _averages(keys, values, of_keys):
+    """ Averages of values grouped by keys, taken for of_keys,
+        and the mask of of_keys that have them.
+    """
+    uniq, inverse = np.unique(keys, return_inverse=True)
+    if not len(uniq):
+        return np.zeros(len(of_keys)), np.zeros(len(of_keys), dtype=bool)
+    averages = np.bincount(inverse, weights=values) / np.bincount(inverse)
+    pos, found = _lookup(uniq, of_keys)
+    return averages[pos], found
+
+
+def _reciprocal(ss, rows):
+    """ Pairs (i, j) of rows where i is (a, b) with a < b and j is (b, a).
+    """
+    forward = rows[ss.query[rows] < ss.subject[rows]]
+    backward = rows[ss.query[rows] > ss.subject[rows]]
+    n = len(ss.proteins)
+    backward_keys = ss.subject[backward] * n + ss.query[backward]
+    order = np.argsort(backward_keys)
+    pos, found = _lookup(backward_keys[order], ss.pair_keys(forward))
+    return forward[found], backward[order][pos[found]]
+
+
+class Pairs:
+    def __init__(self, a, b, taxon_a, taxon_b, unnormalized, normalized):
+        self.a, self.b = a, b
+        self.taxon_a, self.taxon_b = taxon_a, taxon_b
+        self.unnormalized, self.normalized = unnormalized, normalized
+
+    def __len__(self):
+        return len(self.a)
+
+
+def _taxon_pair_normalized(a, b, taxon_a, taxon_b, scores, num_taxa):
+    keys = np.minimum(taxon_a, taxon_b) * num_taxa + np.maximum(taxon_a, taxon_b)
+    return Pairs(a, b, taxon_a, taxon_b, scores, scores / _averages(keys, scores, keys)[0])
+
+
+def find_pairs_in(ss, evalue_exp_cutoff=-5, percent_match_cutoff=50):
+    """ Returns orthologs, inparalogs and coorthologs as Pairs, following
+        the steps of orthomclPairs.pl.
+    """
+    mant, exp = ss.evalue_mant, ss.evalue_exp
+    num_proteins, num_taxa = len(ss.proteins), len(ss.taxa)
+
+    # updateMinimumEvalueExponent: zero e-values get an exponent below all others
+    nonzero = mant != 0
+    if nonzero.any():
+        exp[(exp == 0) & ~nonzero] = exp[nonzero].min() - 1
+
+    passes = (exp <= evalue_exp_cutoff) & (ss.percent_match >= percent_match_cutoff)
+    inter = np.nonzero(ss.query_taxon != ss.subject_taxon)[0]
+
+    # BestQueryTaxonScore: the best e-value of every query against every other taxon
+    order, firsts = _group_firsts(ss.query[inter] * num_taxa + ss.subject_taxon[inter],
+                                  exp[inter], mant[inter])
+    best = order[firsts][np.cumsum(firsts) - 1]
+    best_exp, best_mant = np.empty_like(exp), np.empty_like(mant)
+    best_exp[inter[order]] = exp[inter][best]
+    best_mant[inter[order]] = mant[inter][best]
+
+    # BestHit and orthologs
+    best_hits = inter[passes[inter] & (
+        (mant[inter] < 0.01) |
+        ((exp[inter] == best_exp[inter]) & (mant[inter] == best_mant[inter])))]
+    i, j = _reciprocal(ss, best_hits)
+    orthologs = _taxon_pair_normalized(
+        ss.query[i], ss.subject[i], ss.query_taxon[i], ss.subject_taxon[i],
+        _scores(mant[i], exp[i], mant[j], exp[j], 0.01), num_taxa)
+
+    # BestInterTaxonScore: the best e-value of every query against other taxa
+    order, firsts = _group_firsts(ss.query[inter], exp[inter], mant[inter])
+    has_bis = np.zeros(num_proteins, dtype=bool)
+    bis_exp = np.zeros(num_proteins, dtype=exp.dtype)
+    bis_mant = np.zeros(num_proteins, dtype=mant.dtype)
+    firsts_rows = inter[order[firsts]]
+    has_bis[ss.query[firsts_rows]] = True
+    bis_exp[ss.query[firsts_rows]] = exp[firsts_rows]
+    bis_mant[ss.query[firsts_rows]] = mant[firsts_rows]
+
+    # BetterHit: hits within a taxon at least as good as the best hit to other taxa,
+    # or any hits within a taxon for proteins with no hits to other taxa
+    intra = np.nonzero((ss.query_taxon == ss.subject_taxon) & passes)[0]
+    q = ss.query[intra]
+    better_hits = intra[~has_bis[q] | (
+        (q != ss.subject[intra]) & (
+            (mant[intra] < 0.001) |
+            (exp[intra] < bis_exp[q]) |
+            ((exp[intra] == bis_exp[q]) & (mant[intra] <= bis_mant[q]))))]
+
+    # inparalogs, normalized by the average score in the taxon, counting only
+    # inparalogs that have orthologs if there are any
+    i, j = _reciprocal(ss, better_hits)
+    a, b, taxon = ss.query[i], ss.subject[i], ss.query_taxon[i]
+    scores = _scores(mant[i], exp[i], mant[j], exp[j], 0.01)
+    has_orthologs = np.zeros(num_proteins, dtype=bool)
+    has_orthologs[orthologs.a] = True
+    has_orthologs[orthologs.b] = True
+    with_orthologs = has_orthologs[a] | has_orthologs[b]
+    all_averages, _ = _averages(taxon, scores, taxon)
+    orth_averages, found = _averages(taxon[with_orthologs], scores[with_orthologs], taxon)
+    averages = np.where(found, orth_averages, all_averages)
+    inparalogs = Pairs(a, b, taxon, taxon, scores, scores / averages)
+
+    # coortholog candidates: inparalog-ortholog and inparalog-ortholog-inparalog
+    # connections, which are not orthologs themselves
+    ip_a = np.concatenate([inparalogs.a, inparalogs.b])
+    ip_b = np.concatenate([inparalogs.b, inparalogs.a])
+    o_a = np.concatenate([orthologs.a, orthologs.b])
+    o_b = np.concatenate([orthologs.b, orthologs.a])
+
+    i, j = _join(ip_b, o_a)
+    ip_o = np.unique(ip_a[i] * num_proteins + o_b[j])
+    x, z = ip_o // num_proteins, ip_o % num_proteins
+    i, j = _join(z, ip_a)
+    x = np.concatenate([x, x[i]])
+    y = np.concatenate([z, ip_b[j]])
+    candidates = np.unique(np.minimum(x, y) * num_proteins + np.maximum(x, y))
+    candidates = candidates[~np.in1d(candidates, orthologs.a * num_proteins + orthologs.b)]
+
+    # coorthologs need significant hits both ways
+    hits = np.nonzero(passes)[0]
+    hit_keys = ss.pair_keys(hits)
+    order = np.argsort(hit_keys)
+    hits, hit_keys = hits[order], hit_keys[order]
+    a, b = candidates // num_proteins, candidates % num_proteins
+    pos_ab, found_ab = _lookup(hit_keys, candidates)
+    pos_ba, found_ba = _lookup(hit_keys, b * num_proteins + a)
+    found = found_ab & found_ba
+    ab, ba = hits[pos_ab[found]], hits[pos_ba[found]]
+    coorthologs = _taxon_pair_normalized(
+        a[found], b[found], ss.query_taxon[ab], ss.subject_taxon[ab],
+        _scores(mant[ab], exp[ab], mant[ba], exp[ba], 0.00001), num_taxa)
+
+    return orthologs, inparalogs, coorthologs
+
+
+def _format_score(score):
+    # rounded and printed as orthomclDumpPairsFiles.pl does
+    return '%.15g' % (int(score * 1000 + .5) / 1000.0)
+
+
+def _write_pairs(fpath, names, a, b, scores, order):
+    with open(fpath, 'w') as f:
+        for k in order:
+            f.write(names[a[k]] + '\t' + names[b[k]] + '\t' + _format_score(scores[k]) + '\n')
+
+
+def write_pairs(ss, orthologs, inparalogs, coorthologs, mcl_input, pairs_dir):
+    """ Writes pairs/orthologs.txt, inparalogs.txt, coorthologs.txt and the
+        mcl input in the order orthomclDumpPairsFiles.pl selects them.
+    """
+    if isdir(pairs_dir):
+        rmtree(pairs_dir)
+    makedirs(pairs_dir)
+
+    for pairs, fname in [(orthologs, 'orthologs.txt'), (coorthologs, 'coorthologs.txt')]:
+        _write_pairs(join(pairs_dir, fname), ss.proteins, pairs.a, pairs.b, pairs.normalized,
+                     np.lexsort((pairs.b, pairs.a, pairs.taxon_b, pairs.taxon_a)))
+    _write_pairs(join(pairs_dir, 'inparalogs.txt'), ss.proteins,
+                 inparalogs.a, inparalogs.b, inparalogs.normalized,
+                 np.lexsort((inparalogs.b, inparalogs.a, inparalogs.taxon_a)))
+
+    # the union of the three tables, which SQL returns sorted and distinct
+    a = np.concatenate([p.a for p in [inparalogs, orthologs, coorthologs]])
+    b = np.concatenate([p.b for p in [inparalogs, orthologs, coorthologs]])
+    scores = np.concatenate([p.normalized for p in [inparalogs, orthologs, coorthologs]])
+    order = np.lexsort((scores, b, a))
+    distinct = np.ones(len(order), dtype=bool)
+    distinct[1:] = ((a[order][1:] != a[order][:-1]) | (b[order][1:] != b[order][:-1]) |
+                    (scores[order][1:] != scores[order][:-1]))
+    _write_pairs(mcl_input + '.tmp', ss.proteins, a, b, scores, order[distinct])
+    rename(mcl_input + '.tmp', mcl_input)
+
+
+def find_pairs(similar_sequences, mcl_input, pairs_dir, evalue_exp_cutoff=-5, percent_match_cutoff=50):
+    if np is None:
+        log.error('   NumPy is required to find pairs in memory. '
+                  'Install it with "pip install numpy", or use the orthomcl engine.')
+        return 1
+
+    log.info('   Reading ' + similar_sequences)
+    ss = SimilarSequences(similar_sequences)
+    log.info('   %d similarities between %d proteins of %d taxa.' % (
+        len(ss), len(ss.proteins), len(ss.taxa)))
+
+    orthologs, inparalogs, coorthologs = find_pairs_in(ss, evalue_exp_cutoff, percent_match_cutoff)
+    log.info('   Found %d orthologs, %d inparalogs and %d coorthologs.' % (
+        len(orthologs), len(inparalogs), len(coorthologs)))
+
+    write_pairs(ss, orthologs, inparalogs, coorthologs, mcl_input, pairs_dir)
+    log.info('   Saved to ' + mcl_input + ' and ' + pairs_dir)
+    return 0
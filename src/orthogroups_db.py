@@ -0,0 +1,144 @@
+""" Orthogroups in an SQLite database, one row per gene, for analyses that
+    would otherwise parse orthogroups.tsv again: groups of a strain, core and
+    accessory groups, the group of a protein.
+"""
+import sqlite3
+from os import remove, rename
+from os.path import isfile
+
+import config
+import logging
+log = logging.getLogger(config.log_fname)
+
+
+COLUMNS = ['group_id', 'taxon', 'protein_id', 'strain', 'strain_id',
+           'locus_tag', 'gene', 'product']
+
+_indexes = [
+    ('genes_group_ix', 'group_id'),
+    ('genes_protein_ix', 'protein_id, taxon'),
+    ('genes_taxon_ix', 'taxon, group_id'),
+    ('genes_strain_ix', 'strain, group_id'),
+]
+
+
+class OrthogroupsDbWriter:
+    """ Fills a new database next to fpath and replaces fpath with it on close,
+        so that readers never see a half-written one.
+    """
+    def __init__(self, fpath, batch_rows=100000):
+        self.fpath = fpath
+        self.tmp_fpath = fpath + '.tmp'
+        if isfile(self.tmp_fpath):
+            remove(self.tmp_fpath)
+        self.conn = sqlite3.connect(self.tmp_fpath)
+        self.conn.text_factory = str
+        self.conn.execute('PRAGMA synchronous = OFF')
+        self.conn.execute('PRAGMA journal_mode = OFF')
+        self.conn.execute('CREATE TABLE genes (group_id INTEGER, taxon TEXT, protein_id TEXT, '
+                          'strain TEXT, strain_id TEXT, locus_tag TEXT, gene TEXT, product TEXT)')
+        self.batch_rows = batch_rows
+        self.rows = []
+
+    def add(self, group_id, taxon, protein_id, annotation=None):
+        """ annotation is [strain, strain_id, protein_id, locus_tag, gene, product, ...]
+            like the columns of orthogroups.tsv, or None if unknown.
+        """
+        strain, strain_id, _, locus_tag, gene, product = (annotation or ['NA'] * 6)[:6]
+        self.rows.append((group_id, taxon, protein_id, strain, strain_id, locus_tag, gene, product))
+        if len(self.rows) >= self.batch_rows:
+            self.__flush()
+
+    def __flush(self):
+        self.conn.executemany('INSERT INTO genes VALUES (%s)' % ', '.join(['?'] * len(COLUMNS)), self.rows)
+        self.rows = []
+
+    def close(self):
+        self.__flush()
+        for index, columns in _indexes:
+            self.conn.execute('CREATE INDEX %s ON genes(%s)' % (index, columns))
+        self.conn.commit()
+        self.conn.close()
+        rename(self.tmp_fpath, self.fpath)
+
+    def abort(self):
+        self.conn.close()
+        remove(self.tmp_fpath)
+
+
+class OrthogroupsDb:
+    """ Read access. Genomes are told apart by taxon (the prefix of the
+        protein ids) unless by='strain' is given.
+    """
+    def __init__(self, fpath=config.orthogroups_db):
+        self.conn = sqlite3.connect(fpath)
+        self.conn.text_factory = str
+
+    def groups_count(self):
+        return self.conn.execute('SELECT COUNT(DISTINCT group_id) FROM genes').fetchone()[0]
+
+    def genomes(self, by='taxon'):
+        column = _genome_column(by)
+        return [r[0] for r in self.conn.execute(
+            'SELECT DISTINCT %s FROM genes ORDER BY %s' % (column, column))]
+
+    def groups_of(self, genome, by='taxon'):
+        """ Ids of the groups with genes of the strain (or taxon).
+        """
+        return [r[0] for r in self.conn.execute(
+            'SELECT DISTINCT group_id FROM genes WHERE %s = ? ORDER BY group_id' % _genome_column(by),
+            (genome,))]
+
+    def group_of(self, protein_id, taxon=None):
+        """ The group id of the protein, or None.
+        """
+        if taxon:
+            row = self.conn.execute('SELECT group_id FROM genes WHERE protein_id = ? AND taxon = ?',
+                                    (protein_id, taxon)).fetchone()
+        else:
+            row = self.conn.execute('SELECT group_id FROM genes WHERE protein_id = ?',
+                                    (protein_id,)).fetchone()
+        return row[0] if row else None
+
+    def members(self, group_id):
+        """ Rows of the group as dicts with COLUMNS as keys.
+        """
+        return [dict(zip(COLUMNS, r)) for r in self.conn.execute(
+            'SELECT %s FROM genes WHERE group_id = ? ORDER BY rowid' % ', '.join(COLUMNS),
+            (group_id,))]
+
+    def partition(self, genomes=None, by='taxon'):
+        """ Splits the groups into core (with genes of every genome), accessory
+            (of several genomes) and unique (of one genome). Only the genes of
+            the given genomes are considered, all by default.
+            Returns three lists of group ids.
+        """
+        column = _genome_column(by)
+        genomes = genomes or self.genomes(by)
+        self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS selected (genome TEXT PRIMARY KEY)')
+        with self.conn:
+            self.conn.execute('DELETE FROM selected')
+            self.conn.executemany('INSERT OR IGNORE INTO selected VALUES (?)', ((g,) for g in genomes))
+
+        core, accessory, unique = [], [], []
+        total = len(set(genomes))
+        for group_id, n in self.conn.execute(
+                'SELECT group_id, COUNT(DISTINCT %s) FROM genes '
+                'WHERE %s IN (SELECT genome FROM selected) '
+                'GROUP BY group_id ORDER BY group_id' % (column, column)):
+            if n == total:
+                core.append(group_id)
+            elif n > 1:
+                accessory.append(group_id)
+            else:
+                unique.append(group_id)
+        return core, accessory, unique
+
+    def close(self):
+        self.conn.close()
+
+
+def _genome_column(by):
+    if by not in ('taxon', 'strain'):
+        raise ValueError('by must be "taxon" or "strain", not ' + str(by))
+    return by
@@ -3,6 +3,7 @@ from genericpath import isfile, isdir, exists
 from os.path import join
 import sys
 from src import config
+from src import native_pairs
 
 
 #class Option:
@@ -53,18 +54,33 @@ def add_common_arguments(op):
     op.add_argument('--ask', '--ask-each-step', dest='ask_each_step', action='store_true', default=False, help='Wait for user to press ke every time before proceed to next step.')
     op.add_argument('-t', '--threads', dest='threads', default=0)
     op.add_argument('-j', '--jobs', dest='jobs', default=0)
+    op.add_argument('--step-workers', dest='step_workers', default=4)
+    op.add_argument('--threads-per-blast', dest='threads_per_blast', default=1)
     op.add_argument('-w', '--overwrite', dest='overwrite', action='store_true', default=False)
+    op.add_argument('--no-cache', dest='use_cache', action='store_false', default=True)
     op.add_argument('--min-length', dest='min_length', default=10)
     op.add_argument('--max-percent-stop', dest='max_percent_stop', default=20)
     op.add_argument('--evalue', dest='evalue', default=1e-5)
+    op.add_argument('--pairs-engine', dest='pairs_engine', default='orthomcl', choices=['orthomcl', 'numpy'])
+    op.add_argument('--orthogroups-db', dest='save_db', action='store_true', default=False)
     op.add_argument('-d', '--debug', dest='debug', action='store_true', default=False)
     op.add_argument('--proxy', dest='proxy', default=None, help='Proxy for FTP, for example: --proxy 198.260.1.1:3333')
+    op.add_argument('--config', dest='config_options', action='append', default=[])
 
     op.usage += '''
     -j  Number of jobs to submit on cluster. Default is 30. Options used to submit:
         qsub -pe pe_smp 1 -S /bin/bash -cwd -j y -o intermediate/run_X.log -q batch.q
 
     -t  Use threads for BLAST instead of sumbitting jobs to cluster. Default is 30.
+        The proteins are split into shards of about the same total length,
+        blasted by parallel blastp processes.
+
+    --threads-per-blast
+        Number of threads for every blastp process with -t (default: 1).
+
+    --step-workers
+        Maximum number of independent steps to run at the same time (default: 4).
+        Use 1 to run the steps strictly one after another.
 
     --start-from
         Start from the specified step.
@@ -73,6 +89,20 @@ def add_common_arguments(op):
 
     -w  Force to overwrite previous results and intermediate files in working directory.
 
+    --orthogroups-db
+        Also save the groups to orthogroups.db, an SQLite database with a row
+        for every gene, indexed by group, protein, taxon and strain
+        (see src/orthogroups_db.py).
+
+    --no-cache
+        Run every step even if its inputs, parameters and tools have not changed
+        since the previous run (see intermediate/manifests).
+
+    --config
+        Override an option of config.txt for this run, e.g. --config db_vendor=mysql.
+        Can be given many times. Options can also be set with environment
+        variables like ORTHOFINDER_DB_VENDOR=mysql.
+
 Fine tuning:
     --min-length
         Minimum allowed length of proteins (default: 10)
@@ -82,6 +112,11 @@ Fine tuning:
 
     --evalue
         Blast e-value cut-off (default: 1e-5)
+
+    --pairs-engine
+        "orthomcl" (default) loads blast results into the database and finds pairs
+        with orthomclPairs.pl; "numpy" finds the same pairs in memory, which is
+        faster and needs no database, but requires NumPy.
     '''
 
 def check_common_args(params):
@@ -95,6 +130,16 @@ def check_common_args(params):
     if params.start_from:
         params.overwrite = True
 
+    if params.pairs_engine == 'numpy' and not native_pairs.is_available():
+        arg_parse_error('--pairs-engine numpy requires NumPy; install it with "pip install numpy".')
+
+    if any('=' not in o for o in params.config_options):
+        arg_parse_error('--config must look like option=value')
+    try:
+        params.settings = config.settings.replace(**config.parse_options(params.config_options))
+    except ValueError, e:
+        arg_parse_error('Incorrect configuration: ' + str(e))
+
 
 def arg_parse_error(msg, code=1):
     print >> sys.stderr, msg
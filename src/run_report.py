@@ -0,0 +1,173 @@
+import json
+import resource
+import sys
+import time
+from os.path import join
+from threading import local, Lock
+
+import config
+import logging
+log = logging.getLogger(config.log_fname)
+
+
+report_json_fname = 'run_report.json'
+report_tsv_fname = 'run_report.tsv'
+
+BLOCK_SIZE = 512  # ru_inblock and ru_oublock are counted in 512-byte blocks
+
+_records = []
+_lock = Lock()
+_current = local()
+# usage of all commands waited for by cmdline, to tell it from RUSAGE_CHILDREN
+_commands_total = dict(cpu_s=0.0, read_bytes=0, written_bytes=0)
+
+
+def _max_rss_kb(rusage):
+    # Linux reports kilobytes, OS X bytes
+    if sys.platform == 'darwin':
+        return rusage.ru_maxrss / 1024
+    return rusage.ru_maxrss
+
+
+def _usage(rusage):
+    return dict(
+        cpu_s=rusage.ru_utime + rusage.ru_stime,
+        max_rss_kb=_max_rss_kb(rusage),
+        read_bytes=rusage.ru_inblock * BLOCK_SIZE,
+        written_bytes=rusage.ru_oublock * BLOCK_SIZE)
+
+
+def reset():
+    with _lock:
+        del _records[:]
+
+
+def current_step():
+    """ The record of the step running in this thread, or None.
+    """
+    return getattr(_current, 'step', None)
+
+
+class in_step:
+    """ Makes commands run from this thread count for the step of rec,
+        for threads that a step starts.
+    """
+    def __init__(self, rec):
+        self.rec = rec
+
+    def __enter__(self):
+        self.previous = current_step()
+        _current.step = self.rec
+        return self.rec
+
+    def __exit__(self, type, value, traceback):
+        _current.step = self.previous
+
+
+def start_step(number, name):
+    """ Starts measuring a step in the current thread; commands run from
+        this thread (or from threads given the step with in_step) are
+        attributed to it. In-process figures come from RUSAGE_SELF, and those
+        of other child processes, like multiprocessing pools, from
+        RUSAGE_CHILDREN, so they are shared between steps running at the same time.
+        max_rss_kb is a high-water mark: the peak of the step's commands, and
+        that of this process or its other children only if it grew during the step.
+    """
+    rec = dict(
+        kind='step', number=number, name=name, status='running',
+        wall_s=0.0, cpu_s=0.0, max_rss_kb=0, read_bytes=0, written_bytes=0,
+        commands=[])
+    with _lock:
+        rec['_started'] = (time.time(),
+                           resource.getrusage(resource.RUSAGE_SELF),
+                           resource.getrusage(resource.RUSAGE_CHILDREN),
+                           dict(_commands_total))
+        _records.append(rec)
+    _current.step = rec
+    return rec
+
+
+def finish_step(rec, exit_code, reused=False):
+    started_time, started_self, started_children, started_commands = rec.pop('_started')
+    with _lock:
+        self_usage = _usage(resource.getrusage(resource.RUSAGE_SELF))
+        children_usage = _usage(resource.getrusage(resource.RUSAGE_CHILDREN))
+        commands_total = dict(_commands_total)
+    started_self = _usage(started_self)
+    started_children = _usage(started_children)
+
+    rec['wall_s'] = time.time() - started_time
+    # ru_maxrss is the peak since the start of the process, not of the step
+    if self_usage['max_rss_kb'] > started_self['max_rss_kb']:
+        rec['max_rss_kb'] = self_usage['max_rss_kb']
+    if children_usage['max_rss_kb'] > started_children['max_rss_kb']:
+        # the biggest child so far has been waited for during the step
+        rec['max_rss_kb'] = max(rec['max_rss_kb'], children_usage['max_rss_kb'])
+    for key in ['cpu_s', 'read_bytes', 'written_bytes']:
+        # children other than the commands recorded by add_command
+        other_children = children_usage[key] - started_children[key] - \
+            (commands_total[key] - started_commands[key])
+        rec[key] = self_usage[key] - started_self[key] + max(other_children, 0)
+    for cmd in rec['commands']:
+        rec['cpu_s'] += cmd['cpu_s']
+        rec['read_bytes'] += cmd['read_bytes']
+        rec['written_bytes'] += cmd['written_bytes']
+        rec['max_rss_kb'] = max(rec['max_rss_kb'], cmd['max_rss_kb'])
+
+    rec['exit_code'] = exit_code
+    rec['status'] = 'reused' if reused else ('done' if exit_code == 0 else 'failed')
+    _current.step = None
+
+    log.debug('   %s: wall %.1fs, cpu %.1fs, max rss %d KB, read %d bytes, written %d bytes' % (
+        rec['name'], rec['wall_s'], rec['cpu_s'], rec['max_rss_kb'],
+        rec['read_bytes'], rec['written_bytes']))
+
+
+def add_command(command_str, wall_s, rusage, exit_code, step=None):
+    """ rusage is the one os.wait4 returns for the command's process,
+        which includes its own children. The command counts for step,
+        by default the step running in this thread.
+    """
+    rec = dict(kind='command', name=command_str, wall_s=wall_s, exit_code=exit_code)
+    rec.update(_usage(rusage))
+
+    step = step or current_step()
+    with _lock:
+        for key in _commands_total:
+            _commands_total[key] += rec[key]
+        if step is not None:
+            rec['step'] = step['number']
+            step['commands'].append(rec)
+        else:
+            _records.append(rec)
+    return rec
+
+
+def save(working_dir):
+    """ Writes run_report.json and run_report.tsv with a row for every
+        step followed by rows for the commands it ran.
+    """
+    with _lock:
+        records = [dict((k, v) for k, v in r.items() if not k.startswith('_'))
+                   for r in _records]
+
+    json_fpath = join(working_dir, report_json_fname)
+    with open(json_fpath, 'w') as f:
+        json.dump(records, f, indent=1)
+
+    columns = ['kind', 'step', 'name', 'status', 'exit_code', 'wall_s', 'cpu_s',
+               'max_rss_kb', 'read_bytes', 'written_bytes']
+    tsv_fpath = join(working_dir, report_tsv_fname)
+    with open(tsv_fpath, 'w') as f:
+        f.write('\t'.join(columns) + '\n')
+        for rec in records:
+            rows = [dict(rec, step=rec.get('number', rec.get('step', '')))] + rec.get('commands', [])
+            for row in rows:
+                values = []
+                for c in columns:
+                    v = row.get(c, '')
+                    values.append('%.2f' % v if isinstance(v, float) else str(v))
+                f.write('\t'.join(values) + '\n')
+
+    log.debug('Run report saved to ' + json_fpath + ' and ' + tsv_fpath)
+    return json_fpath, tsv_fpath
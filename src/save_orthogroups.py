@@ -1,11 +1,16 @@
 from genericpath import exists
-from itertools import count, izip, repeat, chain
+from itertools import count, izip, repeat, chain, islice
+from Queue import Queue
+from threading import Thread
 from os import listdir, mkdir, rmdir
 from os.path import join, isdir, splitext, basename
 from shutil import rmtree
 
 from Bio import SeqIO, Entrez
 from fetch_annotations import fetch_annotations_for_ids
+from annotation_index import AnnotationIndex, reference_genes
+from orthogroups_db import OrthogroupsDbWriter
+from indexed_fasta import IndexedFastaWriter
 Entrez.email = 'vladislav.sav@gmail.com'
 
 import logging
@@ -61,45 +66,103 @@ def get_assembly_genes(assembly_proteins_fpath, max_lengths):
     return genes_by_protid, assembly_proteins_recs, max_lengths
 
 
-def get_reference_genes(fname, max_lengths):
-    log.debug('   Reading ' + fname)
-    try:
-        rec = SeqIO.read(fname, 'genbank')
-        strain_id = rec.id
-    except ValueError:
-        log.error('   Could not read annotations from ' + fname)
-        return 1
-        #if isdir(annotations):
-        #    rmtree(annotations)
-        #    mkdir(annotations)
-        #if __download(annotations, mcl_output) != 0:
-        #    return 1
-        #rec = SeqIO.read(fname, 'genbank')
-
-    strain = rec.annotations['source'] or rec.name
-    #gi = rec.annotations['gi'] or rec.id or 'NA'
-    description = rec.description
-
-    genes_by_protid = dict()
-
-    for feature in rec.features:
-        if feature.type == 'CDS':
-            qs = feature.qualifiers
-            prot_id = qs.get('protein_id', ['NA'])[0]
-            gene_id = qs.get('gene', ['NA'])[0]
-            product = qs.get('product', ['NA'])[0]
-            locus_tag = qs.get('locus_tag', ['NA'])[0]
+def index_reference_genes(fname, index):
+    """ Returns (strain id, file digest) of a file in the annotation index,
+        parsing and adding the file if make_proteomes has not seen it.
+    """
+    digest = index.digest(fname)
+    strain_id = index.strain_id(digest)
+    if strain_id is None:
+        log.debug('   Reading ' + fname)
+        try:
+            rec = SeqIO.read(fname, 'genbank')
+        except ValueError:
+            log.error('   Could not read annotations from ' + fname)
+            return None
+            #if isdir(annotations):
+            #    rmtree(annotations)
+            #    mkdir(annotations)
+            #if __download(annotations, mcl_output) != 0:
+            #    return 1
+            #rec = SeqIO.read(fname, 'genbank')
+        strain_id, genes = reference_genes(rec)
+        index.put(digest, strain_id, genes, fpath=fname)
+    return strain_id, digest
+
+
+def _count_lines(fpath):
+    """ Counts newlines block by block, without splitting the file into lines.
+    """
+    lines, last = 0, '\n'
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), ''):
+            lines += block.count('\n')
+            last = block[-1]
+    return lines + (last != '\n')
+
+
+class _Writer:
+    """ A buffered output file. If parallel, the writes are done by a thread
+        of its own, while the next groups are formatted.
+    """
+    def __init__(self, fpath, parallel=False, buffer_size=1 << 20):
+        self.f = open(fpath, 'w', buffer_size)
+        self.queue = None
+        self.error = None
+        if parallel:
+            self.queue = Queue(maxsize=256)
+            self.thread = Thread(target=self.__drain)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def __drain(self):
+        for chunk in iter(self.queue.get, None):
+            if self.error is None:
+                try:
+                    self.f.write(chunk)
+                except IOError, e:
+                    self.error = e
+
+    def write(self, chunk):
+        if self.error:
+            raise self.error
+        if self.queue:
+            self.queue.put(chunk)
+        else:
+            self.f.write(chunk)
+
+    def close(self):
+        if self.queue:
+            self.queue.put(None)
+            self.thread.join()
+        self.f.close()
+        if self.error:
+            raise self.error
 
-            genes_by_protid[prot_id] = \
-                [strain, strain_id, prot_id, locus_tag, gene_id, product, description]
 
-            max_lengths = map(max, zip(max_lengths, map(len, genes_by_protid[prot_id][:-1])))
-
-    return strain_id, genes_by_protid, max_lengths
+def save_orthogroups(new_prot_fpaths, annotations, mcl_output,
+                     out, out_nice, out_short, assembly_singletones, singletones_fasta,
+                     parallel_writers=False, db_fpath=None):
+    """ Reads the groups once, writing every file as it goes: the annotated
+        tsv and its aligned "nice" version, or only the short format if
+        there are no annotations. parallel_writers writes each file from
+        a thread of its own. If db_fpath is given, the groups are also saved
+        there for orthogroups_db.OrthogroupsDb. Proteins of the groups made
+        only of new proteins are saved to singletones_fasta, indexed with
+        the numbers of their groups (see indexed_fasta).
+    """
+    index = AnnotationIndex()
+    try:
+        return _save_orthogroups(new_prot_fpaths, annotations, mcl_output, out, out_nice,
+                                 out_short, assembly_singletones, singletones_fasta, index,
+                                 parallel_writers, db_fpath)
+    finally:
+        index.close()
 
 
-def save_orthogroups(new_prot_fpaths, annotations, mcl_output,
-                     out, out_nice, out_short, assembly_singletones, singletone_dir):
+def _save_orthogroups(new_prot_fpaths, annotations, mcl_output,
+                      out, out_nice, out_short, assembly_singletones, singletones_fasta, index,
+                      parallel_writers, db_fpath):
     strains = dict()
     max_lengths = repeat(0)
 
@@ -131,27 +194,34 @@ def save_orthogroups(new_prot_fpaths, annotations, mcl_output,
         new_protein_records.update(assembly_recs)
         strains[assembly_name] = genes
 
-    if new_protein_records:
-        if exists(singletone_dir):
-            rmtree(singletone_dir)
-        if not isdir(singletone_dir):
-            mkdir(singletone_dir)
-
+    # Genes of the reference strains stay in the index and are looked up by protein id
+    reference_strains = dict()
+    digests = []
     for gb_fname in gb_fpaths:
-        strain_id, genes, max_lengths = get_reference_genes(gb_fname, max_lengths)
-        strains[strain_id] = genes
-
-    with open(mcl_output) as mcl_f:
-        groups_total = sum(1 for _ in mcl_f)
+        indexed = index_reference_genes(gb_fname, index)
+        if indexed:
+            strain_id, digest = indexed
+            reference_strains[strain_id] = digest
+            strains.pop(strain_id, None)
+            digests.append(digest)
+    if digests:
+        max_lengths = map(max, zip(max_lengths, index.max_lengths(digests)))
+
+    groups_total = _count_lines(mcl_output)
+    widths = [len(str(groups_total))] + list(islice(max_lengths, 6))
+
+    if gb_fpaths:
+        writers = [_Writer(out, parallel_writers), _Writer(out_nice, parallel_writers)]
+    else:
+        writers = [_Writer(out_short, parallel_writers)]
+        open(out_nice, 'w').close()
+    db = OrthogroupsDbWriter(db_fpath) if db_fpath else None
+    singletones = IndexedFastaWriter(singletones_fasta) if new_prot_fpaths else None
 
-    if not gb_fpaths:
+    try:
         with open(mcl_output) as mcl_f, \
-             open(out_short, 'w') as out_f, \
-             open(out_nice, 'w') as nice_f, \
              open(assembly_singletones, 'a') as singletones_f:
 
-            singletone_assembly_recs = []
-
             gene_number = 0
             group_nunber = 0
             singletone_gene_number = 0
@@ -161,6 +231,7 @@ def save_orthogroups(new_prot_fpaths, annotations, mcl_output,
                 group_nunber += 1
 
                 known_genes_in_this_group = []
+                tsv_lines, nice_lines = [], []
                 for rec_id in group_line.split():
                     gene_number += 1
                     taxon_id, prot_id = rec_id.split('|')
@@ -168,60 +239,17 @@ def save_orthogroups(new_prot_fpaths, annotations, mcl_output,
                     if assembly_names and taxon_id not in assembly_names:
                         known_genes_in_this_group.append(prot_id)
 
-                out_f.write(str(group_nunber))
-                out_f.write(' ')
-                out_f.write(group_line)
-                out_f.write('\n')
-
-                if new_protein_records and known_genes_in_this_group == []:
-                    group = []
-                    singletone_group_number += 1
-
-                    singletones_f.write('Group %d\n' % group_nunber)
-                    for rec_id in group_line.split():
-                        singletone_gene_number += 1
-                        group.append(new_protein_records[rec_id])
-                        singletones_f.write(rec_id + ' ')
-                    singletones_f.write('\n')
-
-                    singletone_assembly_recs.append(group)
-
-                    a_singletone_filepath = join(
-                        singletone_dir,
-                        splitext(assembly_singletones)[0] + '_group_'
-                        + str(group_nunber) + '.fasta')
-                    SeqIO.write(group, a_singletone_filepath, 'fasta')
-
-        log.info('   Saved in short format %d groups, totally containing %d genes.' % (group_nunber, gene_number))
-
-        if singletone_assembly_recs:
-            log.info('   Saved %d singletone groups for the assembly, totally containing %d genes.' %
-                     (singletone_group_number, singletone_gene_number))
-    else:
-        with open(mcl_output) as mcl_f, \
-             open(out, 'w') as out_f, \
-             open(out_nice, 'w') as nice_f, \
-             open(assembly_singletones, 'a') as singletones_f:
-
-            singletone_assembly_recs = []
-
-            gene_number = 0
-            group_nunber = 0
-            singletone_gene_number = 0
-            singletone_group_number = 0
-
-            for group_line in mcl_f:
-                group_nunber += 1
-
-                known_genes_in_this_group = []
-                for rec_id in group_line.split():
-                    gene_number += 1
-                    taxon_id, prot_id = rec_id.split('|')
+                    if not gb_fpaths:
+                        if db:
+                            db.add(group_nunber, taxon_id, prot_id, strains.get(taxon_id, {}).get(prot_id))
+                        continue
 
-                    if assembly_names and taxon_id not in assembly_names:
-                        known_genes_in_this_group.append(prot_id)
-
-                    if taxon_id not in strains:
+                    if taxon_id in reference_strains:
+                        vals = index.gene(reference_strains[taxon_id], prot_id)
+                        if vals is None:
+                            log.warn('   Warning: no protein id "' + prot_id + '"')
+                            vals = repeat('NA')
+                    elif taxon_id not in strains:
                         log.warn('   Warning: no annotations for "' + taxon_id + '"')
                         vals = repeat('NA')
                     else:
@@ -231,45 +259,53 @@ def save_orthogroups(new_prot_fpaths, annotations, mcl_output,
                             vals = repeat('NA')
                         else:
                             vals = strain_prots[prot_id]
+                    if db:
+                        db.add(group_nunber, taxon_id, prot_id, vals if isinstance(vals, list) else None)
+
+                    row = [str(group_nunber)] + [str(v) for v in islice(vals, len(widths) - 1)]
+                    tsv_lines.append('\t'.join(row).strip() + '\n')
+                    nice_lines.append('\t'.join(v.ljust(w) for v, w in izip(row, widths)).strip() + '\n')
 
-                    out_line = ''
-                    nice_line = ''
-                    for l, val in izip(chain([len(str(groups_total))], max_lengths),
-                                       chain([group_nunber], vals)):
-                        out_line += str(val) + '\t'
-                        nice_line += str(val) + ' ' * (l - len(str(val))) + '\t'
-                    out_line = out_line.strip()
-                    nice_line = nice_line.strip()
-                    if out_line:
-                        out_f.write(out_line + '\n')
-                    if nice_line:
-                        nice_f.write(nice_line + '\n')
-                nice_f.write('\n')
+                if gb_fpaths:
+                    nice_lines.append('\n')
+                    writers[0].write(''.join(tsv_lines))
+                    writers[1].write(''.join(nice_lines))
+                else:
+                    writers[0].write(str(group_nunber) + ' ' + group_line + '\n')
 
                 if new_protein_records and known_genes_in_this_group == []:
-                    group = []
                     singletone_group_number += 1
 
                     singletones_f.write('Group %d\n' % group_nunber)
                     for rec_id in group_line.split():
                         singletone_gene_number += 1
-                        group.append(new_protein_records[rec_id])
+                        rec = new_protein_records[rec_id]
+                        singletones.write(rec.id, rec.description, rec.seq, group_nunber)
                         singletones_f.write(rec_id + ' ')
                     singletones_f.write('\n')
-
-                    singletone_assembly_recs.append(group)
-
-                    a_singletone_filepath = join(
-                        singletone_dir,
-                        splitext(assembly_singletones)[0] + '_group_'
-                        + str(group_nunber) + '.fasta')
-                    SeqIO.write(group, a_singletone_filepath, 'fasta')
-
+    except:
+        if db:
+            db.abort()
+        if singletones:
+            singletones.abort()
+        raise
+    finally:
+        for writer in writers:
+            writer.close()
+    if singletones:
+        singletones.close()
+    if db:
+        db.close()
+        log.info('   Saved groups to ' + db_fpath)
+
+    if gb_fpaths:
         log.info('   Saved %d groups, totally containing %d genes.' % (group_nunber, gene_number))
+    else:
+        log.info('   Saved in short format %d groups, totally containing %d genes.' % (group_nunber, gene_number))
 
-        if singletone_assembly_recs:
-            log.info('   Saved %d singletone groups for the assembly, totally containing %d genes.' %
-                     (singletone_group_number, singletone_gene_number))
+    if singletone_group_number:
+        log.info('   Saved %d singletone groups for the assembly, totally containing %d genes.' %
+                 (singletone_group_number, singletone_gene_number))
 
     return 0
 
@@ -11,6 +11,7 @@ import time
 
 from src import config
 from src.Workflow import Step, cmdline
+from src.indexed_fasta import read_index, iter_records
 from src.config import log_fname, config_file
 log = logging.getLogger(log_fname)
 
@@ -129,7 +130,7 @@ def search_for_best_hit(rec, res_xml_fpath, short_fpath):
     log.info('')
 
 
-def process_record(rec, group_i, blastdb, threads):
+def process_record(rec, group_number, blastdb, threads):
     from Bio.Blast import NCBIXML
     from Bio import SeqIO
     from Bio.Blast.Applications import NcbiblastpCommandline
@@ -139,10 +140,10 @@ def process_record(rec, group_i, blastdb, threads):
     # Blasting against NCBI
     res_xml_fpath = join(
         blasted_singletones_dir,
-        'group_' + str(group_i + 1) + '_refseq_blasted_' + rec.id.replace('|', '__') + '.xml')
+        'group_' + str(group_number) + '_refseq_blasted_' + rec.id.replace('|', '__') + '.xml')
     short_fpath = join(
         blasted_singletones_dir,
-        'group_' + str(group_i + 1) + '_refseq_blasted_' + rec.id.replace('|', '__') + '_summary.txt')
+        'group_' + str(group_number) + '_refseq_blasted_' + rec.id.replace('|', '__') + '_summary.txt')
 
     do_blast = True
     if isfile(res_xml_fpath):
@@ -198,14 +199,9 @@ def step_blast_singletones(threads, blast_singletones=True, blastdb=None, debug=
         #               if blastdb
         #               else 'Remote database will be used.')
 
-        if isdir(config.singletone_dir) and \
-            [join(config.singletone_dir, fname)
-             for fname in listdir(config.singletone_dir)
-             if fname and fname[0] != '.']:
-            pass
-        else:
+        if not isfile(config.singletones_fasta + '.fai') or not read_index(config.singletones_fasta):
             log.error('   No singletones in additional genomes, skipping the step.')
-            log.debug('   ' + realpath(config.singletone_dir))
+            log.debug('   ' + realpath(config.singletones_fasta))
             return 0
 
         if blastdb:
@@ -233,18 +229,20 @@ def step_blast_singletones(threads, blast_singletones=True, blastdb=None, debug=
         if not isdir(blasted_singletones_dir):
             mkdir(blasted_singletones_dir)
 
-        for group_i, group_singletones_file in enumerate(
-                (join(config.singletone_dir, fname)
-                 for fname in listdir(config.singletone_dir)
-                 if fname and fname[0] != '.')):
-            log.debug('   Group ' + str(group_i + 1) + '. ' + group_singletones_file)
+        group_number = None
+        for rec, tag in iter_records(config.singletones_fasta):
+            if tag != group_number:
+                group_number = tag
+                log.debug('   Group ' + group_number)
 
-            for rec in SeqIO.parse(group_singletones_file, 'fasta'):
-                res = process_record(rec, group_i, blastdb, threads)
-                if res == 1:
-                    return 1
+            res = process_record(rec, group_number, blastdb, threads)
+            if res == 1:
+                return 1
         return 0
 
     return Step(
         'Blasting singletones',
-        run=lambda: run(config.assembly_singletones_file, new_proteomes_dir))
\ No newline at end of file
+        run=lambda: run(config.assembly_singletones_file, new_proteomes_dir),
+        req_files=[config.singletones_fasta, config.singletones_fasta + '.fai']
+                  if blast_singletones else [],
+        params=dict(blastdb=blastdb, blast_singletones=blast_singletones))
\ No newline at end of file
@@ -0,0 +1,115 @@
+""" Subsets of orthogroups, like the groups of one clade.
+
+    A subset is defined by a name and prefixes of strain names (or of taxa,
+    i.e. the strain ids of orthogroups.tsv). Every group is read once and
+    its matching genes go to each subset whose genes come from at least
+    min_strains different strains; groups are numbered anew in every subset.
+"""
+from itertools import groupby
+from os.path import isfile
+
+from orthogroups_db import OrthogroupsDb
+
+import config
+import logging
+log = logging.getLogger(config.log_fname)
+
+
+class Subset:
+    def __init__(self, name, prefixes, out_fpath, by='strain', min_strains=2):
+        if by not in ('strain', 'taxon'):
+            raise ValueError('by must be "strain" or "taxon", not ' + str(by))
+        self.name = name
+        self.prefixes = tuple(prefixes)
+        self.out_fpath = out_fpath
+        self.column = 0 if by == 'strain' else 1  # in rows without the group number
+        self.min_strains = min_strains
+        self.groups = 0
+        self.genes = 0
+
+    def matches(self, row):
+        return row[self.column].startswith(self.prefixes)
+
+
+def parse_subset(text):
+    """ "name=prefix[,prefix...]" -> (name, [prefixes])
+    """
+    if '=' not in text:
+        raise ValueError('a subset must look like name=prefix[,prefix...]: ' + text)
+    name, prefixes = text.split('=', 1)
+    prefixes = [p for p in prefixes.split(',') if p]
+    if not name or not prefixes:
+        raise ValueError('a subset must look like name=prefix[,prefix...]: ' + text)
+    return name, prefixes
+
+
+def groups_from_tsv(fpath):
+    """ Yields every group as a list of rows without the group number:
+        [strain, strain_id, protein_id, locus_tag, gene, product]. Groups are
+        separated by the change of the group number or by an empty line.
+    """
+    def _lines():
+        group_i = 0
+        with open(fpath) as f:
+            for line in f:
+                line = line.rstrip('\r\n')
+                if not line.strip():
+                    group_i += 1
+                    continue
+                tokens = line.split('\t')
+                yield (group_i, tokens[0]), tokens[1:]
+
+    for _, rows in groupby(_lines(), key=lambda (key, _): key):
+        yield [tokens for _, tokens in rows]
+
+
+def groups_from_db(fpath):
+    db = OrthogroupsDb(fpath)
+    try:
+        rows = db.conn.execute(
+            'SELECT group_id, strain, strain_id, protein_id, locus_tag, gene, product '
+            'FROM genes ORDER BY group_id, rowid')
+        for _, group in groupby(rows, key=lambda r: r[0]):
+            yield [[str(v) for v in r[1:]] for r in group]
+    finally:
+        db.close()
+
+
+def split_groups(groups, subsets):
+    """ Writes the subsets of the groups in one pass. Returns the number of
+        genes that fall into no subset.
+    """
+    outs = [open(s.out_fpath, 'w') for s in subsets]
+    unmatched = 0
+    try:
+        for group in groups:
+            matched = set()
+            for subset, out in zip(subsets, outs):
+                rows = [r for r in group if subset.matches(r)]
+                matched.update(id(r) for r in rows)
+                if len(set(r[0] for r in rows)) >= subset.min_strains:
+                    subset.groups += 1
+                    subset.genes += len(rows)
+                    out.write(''.join('\t'.join([str(subset.groups)] + r) + '\n' for r in rows))
+                    out.write('\n')
+            unmatched += len(group) - len(matched)
+    finally:
+        for out in outs:
+            out.close()
+
+    for subset in subsets:
+        log.info('   %s: %d groups, %d genes saved to %s' % (
+            subset.name, subset.groups, subset.genes, subset.out_fpath))
+    if unmatched:
+        log.warn('   %d genes are in none of the subsets.' % unmatched)
+    return unmatched
+
+
+def read_groups(tsv_fpath=config.orthogroups_file, db_fpath=config.orthogroups_db):
+    """ The database is read if save_orthogroups has made one.
+    """
+    if db_fpath and isfile(db_fpath):
+        log.info('   Reading groups from ' + db_fpath)
+        return groups_from_db(db_fpath)
+    log.info('   Reading groups from ' + tsv_fpath)
+    return groups_from_tsv(tsv_fpath)
@@ -0,0 +1,103 @@
+""" Loading SimilarSequences into SQLite in-process, in place of
+    orthomclLoadBlast.pl, which pipes the file to the sqlite3 command line tool.
+"""
+import sqlite3
+from time import time
+
+import config
+import logging
+log = logging.getLogger(config.log_fname)
+
+
+BATCH_ROWS = 200000
+
+# The indexes orthomclLoadBlast.pl builds after loading
+SIMILAR_SEQUENCES_INDEXES = [
+    ('ss_qtaxexp_ix', 'query_id, subject_taxon_id, evalue_exp, evalue_mant, query_taxon_id, subject_id'),
+    ('ss_seqs_ix', 'query_id, subject_id, evalue_exp, evalue_mant, percent_match'),
+]
+
+NUM_COLUMNS = 8
+
+_load_pragmas = [
+    'PRAGMA synchronous = OFF',
+    'PRAGMA journal_mode = OFF',
+    'PRAGMA locking_mode = EXCLUSIVE',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -524288',  # KB, so 512 MB
+    'PRAGMA mmap_size = 1073741824',
+]
+
+
+def file_blocks(fpath, block_size=16 * 1024 * 1024):
+    """ Reads fpath in blocks of whole lines, like iter_similar_sequences yields them.
+    """
+    with open(fpath, 'rb') as f:
+        while True:
+            lines = f.readlines(block_size)
+            if not lines:
+                return
+            yield ''.join(lines)
+
+
+def _rows(blocks):
+    for block in blocks:
+        for line in block.split('\n'):
+            if line:
+                fields = line.rstrip('\r').split('\t')
+                if len(fields) != NUM_COLUMNS:
+                    raise ValueError('expected %d tab-separated fields, got %d: %s' % (
+                        NUM_COLUMNS, len(fields), line))
+                yield fields
+
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def load_similar_sequences(db_fpath, blocks, table='SimilarSequences', batch_rows=BATCH_ROWS):
+    """ Replaces the content of the table with the rows from the blocks of
+        tab-separated lines: either file_blocks(similar_sequences.txt) or
+        blast_parser.iter_similar_sequences(...) directly. The values are
+        passed as text, and the column affinity converts them as sqlite3's
+        .import does. Returns the number of rows loaded.
+    """
+    conn = sqlite3.connect(db_fpath, isolation_level=None)
+    conn.text_factory = str
+    try:
+        cursor = conn.cursor()
+        for pragma in _load_pragmas:
+            cursor.execute(pragma)
+        for index, _ in SIMILAR_SEQUENCES_INDEXES:
+            cursor.execute('DROP INDEX IF EXISTS %s' % index)
+
+        insert = 'INSERT INTO %s VALUES (%s)' % (table, ', '.join(['?'] * NUM_COLUMNS))
+        started = time()
+        total = 0
+        cursor.execute('BEGIN')
+        cursor.execute('DELETE FROM %s' % table)
+        for batch in _batches(_rows(blocks), batch_rows):
+            cursor.executemany(insert, batch)
+            total += len(batch)
+            if total % (batch_rows * 25) < len(batch):
+                log.debug('   %d rows loaded' % total)
+        cursor.execute('COMMIT')
+        took = time() - started
+        log.info('   Loaded %d rows into %s in %.1f seconds (%.0f rows/sec).' % (
+            total, table, took, total / max(took, 1e-6)))
+
+        # SQLite has a single writer, so the indexes are built one after another
+        for index, columns in SIMILAR_SEQUENCES_INDEXES:
+            started = time()
+            cursor.execute('CREATE INDEX %s ON %s(%s)' % (index, table, columns))
+            log.info('   Built index %s in %.1f seconds.' % (index, time() - started))
+    finally:
+        conn.close()
+    return total
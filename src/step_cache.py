@@ -0,0 +1,166 @@
+import hashlib
+import json
+import re
+import subprocess
+from os import walk, stat, makedirs, rename
+from os.path import join, isdir, isfile, exists
+from threading import Lock
+
+import config
+import logging
+log = logging.getLogger(config.log_fname)
+
+
+_tool_versions = dict()
+_tool_versions_lock = Lock()
+
+
+def _md5_of_file(fpath):
+    md5 = hashlib.md5()
+    with open(fpath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), ''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _files_under(path):
+    if isdir(path):
+        for root, dirs, files in walk(path):
+            dirs.sort()
+            for fname in sorted(files):
+                if fname[0] != '.':
+                    yield join(root, fname)
+    elif isfile(path):
+        yield path
+
+
+def _stat_signature(fpath):
+    st = stat(fpath)
+    return [st.st_size, int(st.st_mtime)]
+
+
+def tool_version(tool):
+    """ A file (like a perl script) is identified by its md5, a command
+        (like ['blastp', '-version']) by what it prints.
+    """
+    key = tool if isinstance(tool, basestring) else ' '.join(tool)
+    with _tool_versions_lock:
+        if key in _tool_versions:
+            return _tool_versions[key]
+
+    if isinstance(tool, basestring) and isfile(tool):
+        version = _md5_of_file(tool)
+    else:
+        command = tool.split() if isinstance(tool, basestring) else tool
+        try:
+            p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            version = p.communicate()[0].strip()
+        except OSError:
+            version = 'unknown'
+
+    with _tool_versions_lock:
+        _tool_versions[key] = version
+    return version
+
+
+class StepCache:
+    """ Remembers the fingerprint of every successfully finished step:
+        the content of its required files, its parameters, the versions of
+        the tools it uses and the fingerprints of the steps it depends on.
+        A step whose fingerprint matches the previous run and whose outputs
+        are intact is not run again.
+    """
+    def __init__(self, manifests_dir=config.step_manifests_dir):
+        self.manifests_dir = manifests_dir
+
+    def __manifest_fpath(self, step):
+        return join(self.manifests_dir, re.sub('[^0-9a-zA-Z_-]+', '_', step.name) + '.json')
+
+    def __load(self, step):
+        fpath = self.__manifest_fpath(step)
+        if not isfile(fpath):
+            return None
+        try:
+            with open(fpath) as f:
+                return json.load(f)
+        except ValueError:
+            log.debug('   Could not read ' + fpath)
+            return None
+
+    def fingerprint(self, step, upstream_fingerprints):
+        """ Returns the fingerprint and the input files hashes. Files with the
+            same size and mtime as in the previous run are not re-hashed.
+        """
+        previous_inputs = (self.__load(step) or {}).get('inputs', {})
+
+        inputs = dict()
+        for req in step.req_files:
+            for fpath in _files_under(req):
+                sig = _stat_signature(fpath)
+                prev = previous_inputs.get(fpath)
+                if prev and prev[:2] == sig:
+                    inputs[fpath] = prev
+                else:
+                    inputs[fpath] = sig + [_md5_of_file(fpath)]
+
+        md5 = hashlib.md5()
+        md5.update(json.dumps([
+            step.name,
+            sorted((str(k), str(v)) for k, v in step.params.items()),
+            [tool_version(t() if callable(t) else t) for t in step.tools],
+            sorted((fpath, h[2]) for fpath, h in inputs.items()),
+            sorted(upstream_fingerprints)]))
+        return md5.hexdigest(), inputs
+
+    def is_fresh(self, step, fingerprint, upstream_reused):
+        """ Steps that declare no products are trusted only if everything
+            they depend on was reused as well, since we can not check what
+            they have done. Steps that declare nothing at all always run:
+            their fingerprint does not change with what they do.
+        """
+        if not step.req_files and not step.params and \
+                not step.prod_files and not step.prod_tables:
+            return False
+
+        manifest = self.__load(step)
+        if not manifest or manifest.get('fingerprint') != fingerprint:
+            return False
+
+        if not step.prod_files and not step.prod_tables:
+            return upstream_reused
+
+        outputs = manifest.get('outputs', {})
+        for prod in step.prod_files:
+            if not exists(prod):
+                return False
+        for fpath, sig in outputs.items():
+            if not isfile(fpath) or _stat_signature(fpath) != sig:
+                log.debug('   ' + fpath + ' has changed since the last run.')
+                return False
+
+        if step.catalog.missing(step.prod_tables):
+            return False
+        return True
+
+    def save(self, step, fingerprint, inputs):
+        if not isdir(self.manifests_dir):
+            try:
+                makedirs(self.manifests_dir)
+            except OSError:
+                if not isdir(self.manifests_dir):
+                    raise
+
+        outputs = dict(
+            (fpath, _stat_signature(fpath))
+            for prod in step.prod_files
+            for fpath in _files_under(prod))
+
+        fpath = self.__manifest_fpath(step)
+        with open(fpath + '.tmp', 'w') as f:
+            json.dump(dict(
+                step=step.name,
+                fingerprint=fingerprint,
+                params=dict((str(k), str(v)) for k, v in step.params.items()),
+                inputs=inputs,
+                outputs=outputs), f, indent=1)
+        rename(fpath + '.tmp', fpath)
@@ -1,8 +1,11 @@
 from collections import namedtuple
+from functools import partial
 from os import remove, listdir
 import os
 from os.path import basename, join, relpath, exists, isdir, realpath, isfile
 from shutil import rmtree
+import shutil
+import sqlite3
 from time import sleep
 from Bio import SeqIO, Entrez
 from Bio.Seq import Seq
@@ -15,15 +18,29 @@ from process_assembly import filter_assembly
 from save_orthogroups import save_orthogroups
 from make_proteomes import make_proteomes, adjust_proteomes
 from fetch_annotations import fetch_annotations_for_species_from_ftp, fetch_annotations_for_ids
-from config import orthomcl_config_final_path, orthomcl_bin_dir, BLAST_DBSIZE
+from config import orthomcl_config_final_path, BLAST_DBSIZE
 import config
 from clean_db import clean_db
+import blast_parser
+from local_blast import run_sharded_blast
+from filter_proteomes import filter_proteomes as filter_proteomes_native, read_stats
+from cluster import Job, JobTracker, SgeScheduler
+import incremental_blast
+import blast_db_cache
+import sqlite_loader
+import native_pairs
 
 import config
 import logging
 log = logging.getLogger(config.log_fname)
 
 
+def orthomcl_script(name):
+    """ The script of the OrthoMCL build for the database of the running workflow.
+    """
+    return join(config.current_settings().orthomcl_bin_dir, name)
+
+
 def check_results_existence():
     existing = [obj for obj in [
         config.proteomes_dir,
@@ -95,20 +112,15 @@ best_hit_taxon_score_table = 'BestQueryTaxonScore'
 #         req_files=proteomes_files,
 #         prod_files=[proteomes_dir])
 
-def filter_proteomes(min_length=10, max_percent_stop=20):
+def filter_proteomes(min_length=10, max_percent_stop=20, threads=None):
     def run(starting_from_here=False):
-        res = cmdline(
-            'perl ' + join(orthomcl_bin_dir, 'orthomclFilterFasta.pl'),
-            parameters=[
-                realpath(config.proteomes_dir),
-                min_length, max_percent_stop,
-                realpath(config.good_proteins),
-                realpath(config.poor_proteins)])()
-        if res != 0:
-            return res
+        stats = filter_proteomes_native(
+            config.proteomes_dir, min_length, max_percent_stop,
+            config.good_proteins, config.poor_proteins, threads)
+        if stats is None:
+            return 1
 
-        total_seqs = sum(1 for _ in SeqIO.parse(config.good_proteins, 'fasta'))
-        if total_seqs == 0:
+        if stats['good_records'] == 0:
             log.error('No good protein sequences found.')
             return 1
 
@@ -119,7 +131,8 @@ def filter_proteomes(min_length=10, max_percent_stop=20):
         ', max percent of stop codons = ' + str(max_percent_stop),
         run=run,
         req_files=[config.proteomes_dir],
-        prod_files=[config.good_proteins, config.poor_proteins])
+        prod_files=[config.good_proteins, config.poor_proteins],
+        params=dict(min_length=min_length, max_percent_stop=max_percent_stop))
 
 # def filter_and_split_proteomes(max_jobs, min_length=10, max_percent_stop=20):
 #     def proc():
@@ -132,38 +145,35 @@ def filter_proteomes(min_length=10, max_percent_stop=20):
 #         req_files=[config.proteomes_dir],
 #         prod_files=[config.good_proteins, config.poor_proteins])
 
-def make_blast_db():
+def make_blast_db(proteins=config.good_proteins, blast_db=config.blast_db,
+                  name='Making blast database', new_proteins=None):
     def _run(starting_from_here=False):
-        return cmdline(
-            'makeblastdb',
-             parameters=[
-               '-in', realpath(config.good_proteins),
-               '-input_type', 'fasta',
-               '-out', realpath(config.blast_db),
-               '-dbtype', 'prot'],
-             stdout='log',
-             stderr='log')()
+        return blast_db_cache.make_blast_db(proteins, blast_db, new_proteins)
 
     return Step(
-        'Making blast database',
+        name,
         run=_run,
-        req_files=[config.good_proteins],
-        prod_files=[config.blast_db + '.' + ext for ext in ['phr', 'pin', 'psq']])
+        req_files=[proteins] + ([new_proteins] if new_proteins else []),
+        prod_files=[blast_db + '.pal'],
+        tools=[['makeblastdb', '-version']])
 
-def blast(workflow_id, max_jobs=30, on_cluster=True, new_good_proteomes=None, evalue=1e-5):
+def blast(workflow_id, max_jobs=30, on_cluster=True, new_good_proteomes=None, evalue=1e-5,
+          threads_per_worker=1):
     if not check_installed_tools(['blastp'], only_warn=False):
         return 1
 
-    _blast_basic_params = [
-        '-db', realpath(config.blast_db),
-        '-outfmt', 6,  # tabular
-        '-seg', 'yes',
-        '-soft_masking', 'true',
-        '-evalue', evalue,
-        '-dbsize', BLAST_DBSIZE]
-
-    def _blast(in_fpath, out_fpath, threads=1):
-        params = _blast_basic_params + [
+    def _blast_basic_params(db):
+        # the fixed -dbsize keeps e-values comparable between searches against different databases
+        return [
+            '-db', realpath(db),
+            '-outfmt', 6,  # tabular
+            '-seg', 'yes',
+            '-soft_masking', 'true',
+            '-evalue', evalue,
+            '-dbsize', BLAST_DBSIZE]
+
+    def _blast(in_fpath, out_fpath, db, threads=1):
+        params = _blast_basic_params(db) + [
             '-query', realpath(in_fpath),
             '-out', realpath(out_fpath)]
 
@@ -182,22 +192,30 @@ def blast(workflow_id, max_jobs=30, on_cluster=True, new_good_proteomes=None, ev
         else:
             return _callback(params)()
 
-    def _run(starting_from_here=False):
-        fasta_to_blast = new_good_proteomes or config.good_proteins
-        blast_out = config.blast_out + '_2' if new_good_proteomes else config.blast_out
+    def _blast_locally(in_fpath, out_fpath, db):
+        if max_jobs <= 1:
+            return _blast(in_fpath, out_fpath, db, threads=1)
+        return run_sharded_blast(_blast_basic_params(db), in_fpath, out_fpath,
+                                 workers=max_jobs, threads_per_worker=threads_per_worker)
 
+    def _search(fasta_to_blast, blast_out, db, tag=''):
+        """ Blasts fasta_to_blast against db, locally or on the cluster.
+            The tag distinguishes cluster job files of different searches.
+        """
         res = 10
         if not on_cluster:
             # threads
-            res = _blast(fasta_to_blast, blast_out, threads=max_jobs)
+            res = _blast_locally(fasta_to_blast, blast_out, db)
 
         else:
             qsub = which('qsub')
             if not qsub:
                 log.warn('No qsub in system: running multuthreaded')
-                res = _blast(fasta_to_blast, blast_out, threads=max_jobs)
+                res = _blast_locally(fasta_to_blast, blast_out, db)
             else:
-                total_seqs = sum(1 for _ in SeqIO.parse(fasta_to_blast, 'fasta'))
+                stats = read_stats(fasta_to_blast)
+                total_seqs = stats['good_records'] if stats else \
+                    sum(1 for _ in SeqIO.parse(fasta_to_blast, 'fasta'))
                 num_seqs_for_one_job = max(500, total_seqs/max_jobs)
                 num_jobs = total_seqs/num_seqs_for_one_job or 1
                 # num_seqs_for_one_job = total_seqs/2  # DEBUG
@@ -205,135 +223,210 @@ def blast(workflow_id, max_jobs=30, on_cluster=True, new_good_proteomes=None, ev
 
                 if num_jobs == 1:
                     # one single threaded run
-                    res = _blast(fasta_to_blast, blast_out, threads=1)
+                    res = _blast(fasta_to_blast, blast_out, db, threads=1)
 
                 else:
                     # jobs
                     timestamp = str(datetime.now()).replace('-', '_').replace(':', '_').replace(' ', '_')
 
-                    log.info('Splitting data for ' + str(num_jobs) + ' cluster jobs.')
-
                     class BlastJob:
                         def __init__(self, i):
                             self.i = i
-                            self.job_name = workflow_id + '_' + timestamp + '_' + str(i)
-                            self.prot_fpath = join(config.intermediate_dir, 'proteins_' + str(i) + '.fasta')
-                            self.out_fpath = join(config.intermediate_dir, 'blasted_part_' + str(i) + '.tsv')
-                            self.log_fpath = join(config.intermediate_dir, 'run_blast_' + str(i) + '.log')
-                            self.runner_fpath = join(config.intermediate_dir, 'run_blast_' + str(i) + '.sh')
+                            self.job_name = workflow_id + '_' + timestamp + '_' + tag + str(i)
+                            self.prot_fpath = join(config.intermediate_dir, 'proteins_' + tag + str(i) + '.fasta')
+                            self.out_fpath = join(config.intermediate_dir, 'blasted_part_' + tag + str(i) + '.tsv')
+                            self.done_fpath = self.out_fpath + '.done'
+                            self.log_fpath = join(config.intermediate_dir, 'run_blast_' + tag + str(i) + '.log')
+                            self.runner_fpath = join(config.intermediate_dir, 'run_blast_' + tag + str(i) + '.sh')
+
+                        def write_runner(self):
+                            # the output is moved in place and marked done only if blastp succeeds;
+                            # the temporary file is per job, as a straggler may run in two copies
+                            tmp_fpath = realpath(self.out_fpath) + '.tmp.${JOB_ID:-$$}'
                             cmd = ('blastp ' +
-                                   ' '.join(map(str, _blast_basic_params)) +
+                                   ' '.join(map(str, _blast_basic_params(db))) +
                                    ' -query ' + realpath(self.prot_fpath) +
-                                   ' -out ' + realpath(self.out_fpath))
+                                   ' -out ' + tmp_fpath)
                             with open(self.runner_fpath, 'w') as f:
                                 f.write('#!/bin/bash\n')
                                 f.write('. /etc/profile.d/modules.sh\n')
                                 f.write('module load blast\n')
-                                f.write(cmd + '\n')
+                                f.write(cmd + ' && \\\n')
+                                f.write('  mv ' + tmp_fpath + ' ' + realpath(self.out_fpath) + ' && \\\n')
+                                f.write('  touch ' + realpath(self.done_fpath) + '\n')
                                 f.write('date\n')
 
-                        def submit(self):
-                            cmdl = '-pe pe_smp 1 -S /bin/bash -cwd -j y -q batch.q -N {0} -o {1} ' \
-                                   '{2}'.format(self.job_name, realpath(self.log_fpath), realpath(self.runner_fpath))
-                            # cmdl = '-pe pe_smp 1 -S /bin/bash -cwd -j y -o {0} -q batch.q ' \
-                            #        '{1}'.format(self.log_fpath, self.runner_fpath)
-                            log.debug('submitting job ' + str(self.i))
-                            res = cmdline('qsub', parameters=cmdl.split())()
-                            log.debug('submitted, res = ' + str(res))
-                            log.info('')
-                            return res
-
-                    blast_jobs = []
-                    i, i_recs = 1, []
-                    for rec in SeqIO.parse(fasta_to_blast, 'fasta'):
-                        i_recs.append(rec)
-                        if len(i_recs) > num_seqs_for_one_job:
+                        def is_complete(self):
+                            return isfile(self.done_fpath) and is_complete_blast_output(self.out_fpath)
+
+                    plan = blast_jobs_plan(fasta_to_blast, _blast_basic_params(db), num_jobs)
+                    plan_fpath = join(config.intermediate_dir, tag + 'blast_jobs.plan')
+                    planned_jobs = read_blast_jobs_plan(plan_fpath, plan)
+                    if planned_jobs:
+                        blast_jobs = [BlastJob(i) for i in range(1, planned_jobs + 1)]
+                        log.info('Resuming ' + str(planned_jobs) + ' cluster jobs from the previous run.')
+                    else:
+                        log.info('Splitting data for ' + str(num_jobs) + ' cluster jobs.')
+                        blast_jobs = []
+                        i, i_recs = 1, []
+                        for rec in SeqIO.parse(fasta_to_blast, 'fasta'):
+                            i_recs.append(rec)
+                            if len(i_recs) > num_seqs_for_one_job:
+                                blast_job = BlastJob(i)
+                                blast_jobs.append(blast_job)
+                                SeqIO.write(i_recs, blast_job.prot_fpath, 'fasta')
+                                i, i_recs = i + 1, []
+                        if i_recs:
                             blast_job = BlastJob(i)
                             blast_jobs.append(blast_job)
                             SeqIO.write(i_recs, blast_job.prot_fpath, 'fasta')
-                            i, i_recs = i + 1, []
-                    if i_recs:
-                        blast_job = BlastJob(i)
-                        blast_jobs.append(blast_job)
-                        SeqIO.write(i_recs, blast_job.prot_fpath, 'fasta')
-
-                    for bj in blast_jobs:
-                        res = bj.submit()
-                        if res != 0:
-                            log.info('qsub returned exit code ' + str(res))
-                            return res
-
-                    results_script_fpath = join(config.intermediate_dir, 'collect_blasted' + '.sh')
-                    collect_log_fpath = join(config.intermediate_dir, 'collect_blasted.log')
-                    if isfile(collect_log_fpath):
-                        os.remove(collect_log_fpath)
-                    with open(results_script_fpath, 'w') as f:
-                        f.write('#!/bin/bash\n')
-                        f.write('touch ' + collect_log_fpath + '\n')
-
-                    cmdl = '-hold_jid {0} -S /bin/bash -cwd -j y -q batch.q {1}'.format(
-                        ','.join(j.job_name for j in blast_jobs), realpath(results_script_fpath))
-                    log.debug('wating for jobs...')
-                    res = cmdline('qsub', parameters=cmdl.split())()
-                    if res != 0:
-                        return res
-
-                    log.info('Waiting for blast jobs to finish...')
-                    while not isfile(collect_log_fpath):
-                        sleep(3)
-                    log.info('All blast finished, proceeding.')
-
-                    # cat_params = ''
-                    ok = True
-                    for bj in blast_jobs:
-                        if not verify_file(bj.out_fpath):
-                            ok = False
-                        else:
-                            log.debug(bj.out_fpath + ' exists, ok')
-                        # cat_params += ' ' + bj.prot_fpath
-                    if not ok:
+                        for bj in blast_jobs:
+                            for fpath in [bj.out_fpath, bj.done_fpath]:
+                                if isfile(fpath):
+                                    os.remove(fpath)
+                        write_blast_jobs_plan(plan_fpath, plan, len(blast_jobs))
+
+                    jobs_to_submit = [bj for bj in blast_jobs if not bj.is_complete()]
+                    if len(jobs_to_submit) < len(blast_jobs):
+                        log.info(str(len(blast_jobs) - len(jobs_to_submit)) + ' of ' + str(len(blast_jobs)) +
+                                 ' jobs have already completed, submitting the other ' +
+                                 str(len(jobs_to_submit)) + '.')
+
+                    if jobs_to_submit:
+                        for bj in jobs_to_submit:
+                            bj.write_runner()
+                        log.info('Submitting ' + str(len(jobs_to_submit)) + ' blast jobs and waiting for them...')
+                        res = JobTracker(SgeScheduler()).run([
+                            Job(bj.job_name, bj.runner_fpath, bj.log_fpath, is_complete=bj.is_complete)
+                            for bj in jobs_to_submit])
+                        if res == 0:
+                            log.info('All blast finished, proceeding.')
+
+                    incomplete = [bj for bj in blast_jobs if not bj.is_complete()]
+                    if incomplete:
+                        log.error('Blast jobs ' + ', '.join(str(bj.i) for bj in incomplete) + ' did not complete '
+                                  '(see ' + ', '.join(bj.log_fpath for bj in incomplete) + '). '
+                                  'Restarting this step will resubmit only them.')
                         return 3
 
-                    # res = cmdline('cat',
-                    #               parameters=cat_params,
-                    #               stdout=blast_out)
                     with open(blast_out, 'w') as out:
                         for bj in blast_jobs:
                             with open(bj.out_fpath) as bjout:
-                                out.write(bjout.read())
+                                shutil.copyfileobj(bjout, out)
 
                     if not verify_file(blast_out):
                         log.debug(blast_out + ' not exist, return 4')
                         return 4
-                    print res
-                    if res != 0:
-                        return res
+                    res = 0
+        return res
 
-        if new_good_proteomes:
-            log.info('   Appending ' + config.blast_out + '_2 to ' + config.blast_out)
+    def _blast_incrementally():
+        """ Adds to the all-vs-all results of the previous run the searches of the new
+            proteins against all proteins, and of the old proteins against the new ones.
+        """
+        old_blast_out = config.blast_out + '.old'
+        new_taxa = incremental_blast.read_taxa(new_good_proteomes)
+
+        if not isfile(old_blast_out):
+            if incremental_blast.is_merged(config.blast_out, new_taxa):
+                log.info('   ' + config.blast_out + ' already contains results for the new proteins.')
+                return 0
+            os.rename(config.blast_out, old_blast_out)
+
+        old_proteins = join(config.intermediate_dir, 'old_good_proteins.fasta')
+        log.info('   Collecting old proteins in the order of ' + old_blast_out)
+        if incremental_blast.write_old_proteins(
+                config.good_proteins, old_blast_out, new_taxa, old_proteins) == 0:
+            log.error('   No old proteins found in ' + config.good_proteins)
+            return 1
 
-            with open(config.blast_out, 'a') as b_out:
-                with open(config.blast_out + '_2') as b_out_2:
-                    b_out.write(b_out_2.read())
-        return res
+        new_vs_all = join(config.intermediate_dir, 'blasted_new_vs_all.tsv')
+        old_vs_new = join(config.intermediate_dir, 'blasted_old_vs_new.tsv')
+
+        log.info('   Blasting new proteins against all proteins.')
+        res = _search(new_good_proteomes, new_vs_all, config.blast_db, tag='new_')
+        if res != 0:
+            return res
+
+        log.info('   Blasting old proteins against new proteins.')
+        res = _search(old_proteins, old_vs_new, config.new_blast_db, tag='old_')
+        if res != 0:
+            return res
+
+        log.info('   Merging into ' + config.blast_out)
+        incremental_blast.merge_blast_outputs(old_blast_out, old_vs_new, new_vs_all, config.blast_out)
+        for fpath in [old_blast_out, old_proteins, new_vs_all, old_vs_new]:
+            os.remove(fpath)
+        return 0
+
+    def _run(starting_from_here=False):
+        if new_good_proteomes:
+            return _blast_incrementally()
+        return _search(config.good_proteins, config.blast_out, config.blast_db)
 
     return Step(
         'Blasting',
         run=_run,
-        req_files=[config.good_proteins])
-
-def parse_blast_results():
+        req_files=[config.good_proteins] + ([new_good_proteomes] if new_good_proteomes else []),
+        # when blasting new proteomes, the results are merged into the existing blast_out
+        prod_files=[] if new_good_proteomes else [config.blast_out],
+        params=dict(evalue=evalue, dbsize=BLAST_DBSIZE),
+        tools=[['blastp', '-version']])
+
+def is_complete_blast_output(fpath):
+    """ An empty output means no hits; otherwise the last line
+        must be a complete tabular record.
+    """
+    if not isfile(fpath):
+        return False
+    size = os.path.getsize(fpath)
+    if size == 0:
+        return True
+    with open(fpath) as f:
+        f.seek(max(0, size - 4096))
+        tail = f.read()
+    if not tail.endswith('\n'):
+        return False
+    return len(tail.rstrip('\n').rsplit('\n', 1)[-1].split('\t')) == 12
+
+
+def blast_jobs_plan(fasta, blast_params, num_jobs):
+    """ Identifies a split of fasta into cluster jobs: the same input, parameters
+        and number of jobs mean the parts of the previous run can be reused.
+    """
+    st = os.stat(fasta)
+    return ' '.join(map(str, [realpath(fasta), st.st_size, int(st.st_mtime), num_jobs] + blast_params))
+
+
+def read_blast_jobs_plan(plan_fpath, plan):
+    """ Returns the number of jobs if the previous split was made for the same plan.
+    """
+    if not isfile(plan_fpath):
+        return None
+    with open(plan_fpath) as f:
+        lines = f.read().split('\n')
+    if len(lines) < 2 or lines[0] != plan:
+        return None
+    return int(lines[1])
+
+
+def write_blast_jobs_plan(plan_fpath, plan, num_jobs):
+    with open(plan_fpath + '.tmp', 'w') as f:
+        f.write(plan + '\n' + str(num_jobs) + '\n')
+    os.rename(plan_fpath + '.tmp', plan_fpath)
+
+def parse_blast_results(threads=None):
     def _run(starting_from_here=False):
-        return cmdline(
-            join(orthomcl_bin_dir, 'orthomclBlastParser.pl'),
-            parameters=[realpath(config.blast_out), realpath(config.proteomes_dir)],
-            stdout=realpath(config.similar_sequences))()
+        return blast_parser.parse_blast_results(
+            config.blast_out, config.proteomes_dir, config.similar_sequences,
+            processes=threads)
 
     return Step(
         'Parsing blast results',
         run=_run,
         req_files=[config.proteomes_dir, config.blast_out],
-        prod_files=[config.similar_sequences])
+        prod_files=[config.similar_sequences],
+        tools=[join(config.src_dir, 'blast_parser.py')])
 
 def clean_database(suffix):
     def _run(starting_from_here=False):
@@ -341,12 +434,13 @@ def clean_database(suffix):
 
     return Step(
         'Cleaning database',
-        run=_run)
+        run=_run,
+        params=dict(suffix=suffix))
 
 def install_schema(suffix):
     def run(starting_from_here=False):
         return cmdline(
-            join(orthomcl_bin_dir, 'orthomclInstallSchema.pl'),
+            orthomcl_script('orthomclInstallSchema.pl'),
             parameters=[
                 realpath(orthomcl_config_final_path),
                 realpath(config.sql_log),
@@ -363,10 +457,21 @@ def install_schema(suffix):
             in_paralog_table + suffix,
             coortholog_table + suffix,
             similar_sequeces_table + suffix,
-            inter_taxon_match_view + suffix])
+            inter_taxon_match_view + suffix],
+        tools=[partial(orthomcl_script, 'orthomclInstallSchema.pl')])
 
 def load_blast_results(suffix):
     def run(starting_from_here=False):
+        if config.current_settings().db_vendor == 'sqlite':
+            try:
+                sqlite_loader.load_similar_sequences(
+                    config.sqlite_file, sqlite_loader.file_blocks(config.similar_sequences),
+                    table=similar_sequeces_table + suffix)
+            except (ValueError, sqlite3.Error), e:
+                log.error('   Error loading ' + config.similar_sequences + ': ' + str(e))
+                return 1
+            return 0
+
         with DbCursor() as cursor:
             for tbl in [
                 similar_sequeces_table + suffix,
@@ -391,7 +496,7 @@ def load_blast_results(suffix):
                 except Exception, e:
                     log.exception(e)
 
-        return cmdline(join(orthomcl_bin_dir, 'orthomclLoadBlast.pl'),
+        return cmdline(orthomcl_script('orthomclLoadBlast.pl'),
             parameters=[
                 realpath(orthomcl_config_final_path),
                 realpath(config.similar_sequences),
@@ -403,7 +508,9 @@ def load_blast_results(suffix):
         run=run,
         req_files=[orthomcl_config_final_path,
                    config.similar_sequences],  # and initialized database
-        prod_files=[])  # loads blast results into the db)
+        prod_files=[],  # loads blast results into the db)
+        params=dict(suffix=suffix),
+        tools=[partial(orthomcl_script, 'orthomclLoadBlast.pl'), join(config.src_dir, 'sqlite_loader.py')])
 
 def find_pairs(suffix):
     def run(starting_from_here=False):
@@ -453,7 +560,7 @@ def find_pairs(suffix):
             params += ['startAfter=useLog']
 
         return cmdline(
-            join(orthomcl_bin_dir, 'orthomclPairs.pl'),
+            orthomcl_script('orthomclPairs.pl'),
             parameters=params)()
 
     return Step(
@@ -489,12 +596,39 @@ def find_pairs(suffix):
             'OrthologUniqueId',
             'UniqSimSeqsQueryId',
         ]],
-        prod_files=[])  # populates InParalog, Ortholog, CoOrtholog
+        prod_files=[],  # populates InParalog, Ortholog, CoOrtholog
+        tools=[partial(orthomcl_script, 'orthomclPairs.pl')])
+
+def pairs_steps(engine, suffix):
+    if engine == 'numpy':
+        return [find_pairs_in_memory()]
+    return [
+        clean_database(suffix),
+        install_schema(suffix),
+        load_blast_results(suffix),
+        find_pairs(suffix),
+        dump_pairs_to_files(suffix)]
+
+def find_pairs_in_memory():
+    """ Replaces the database steps from cleaning to dumping pairs files.
+    """
+    def run(starting_from_here=False):
+        evalue_exp_cutoff, percent_match_cutoff = native_pairs.read_cutoffs(orthomcl_config_final_path)
+        return native_pairs.find_pairs(
+            config.similar_sequences, config.mcl_input, config.pairs_dir,
+            evalue_exp_cutoff, percent_match_cutoff)
+
+    return Step(
+        'Finding pairs in memory',
+        run=run,
+        req_files=[orthomcl_config_final_path, config.similar_sequences],
+        prod_files=[config.mcl_input, config.pairs_dir],
+        tools=[join(config.src_dir, 'native_pairs.py')])
 
 def dump_pairs_to_files(suffix):
     def run(starting_from_here=False):
         res = cmdline(
-            join(orthomcl_bin_dir, 'orthomclDumpPairsFiles.pl'),
+            orthomcl_script('orthomclDumpPairsFiles.pl'),
              parameters=[realpath(orthomcl_config_final_path),
                          realpath(config.mcl_input),
                          realpath(config.intermediate_dir),
@@ -531,7 +665,9 @@ def dump_pairs_to_files(suffix):
                     config.pairs_dir,
                     config.pairs_orthologs,
                     config.pairs_inparalogs,
-                    config.pairs_coorthologs])
+                    config.pairs_coorthologs],
+        params=dict(suffix=suffix),
+        tools=[partial(orthomcl_script, 'orthomclDumpPairsFiles.pl')])
 
 def mcl(debug, inflation=1.5):
     def run(starting_from_here=False):
@@ -554,10 +690,14 @@ def mcl(debug, inflation=1.5):
         'MCL',
         run=run,
         req_files=[config.mcl_input],
-        prod_files=[config.mcl_output])
+        prod_files=[config.mcl_output],
+        params=dict(inflation=inflation),
+        tools=[['mcl', '--version']])
 
 def step_save_orthogroups(added_proteomes_dir=None,
-                          annotations=None, internet_on=True):
+                          annotations=None, internet_on=True, save_db=False, threads=None):
+    """ Unless threads is 1, every output file is written by a thread of its own.
+    """
     def run(starting_from_here=False):
         if added_proteomes_dir:
             added_proteomes_files = [
@@ -571,24 +711,30 @@ def step_save_orthogroups(added_proteomes_dir=None,
             added_proteomes_files, annotations or config.annotations_dir, config.mcl_output,
             config.orthogroups_file, config.nice_orthogroups_file,
             config.short_orthogroups_file, config.assembly_singletones_file,
-            config.singletone_dir)
+            config.singletones_fasta, parallel_writers=threads != 1,
+            db_fpath=config.orthogroups_db if save_db else None)
 
     prod_files = [
         config.orthogroups_file,
         config.nice_orthogroups_file,
         config.short_orthogroups_file,
         config.assembly_singletones_file]
+    if save_db:
+        prod_files.append(config.orthogroups_db)
+    if added_proteomes_dir:
+        prod_files += [config.singletones_fasta, config.singletones_fasta + '.fai']
 
     return Step(
        'Saving orthogroups',
        run=run,
        req_files=[config.mcl_output],
-       prod_files=prod_files)
+       prod_files=prod_files,
+       params=dict(added_proteomes_dir=added_proteomes_dir, annotations=annotations, save_db=save_db))
 
 def groups_to_files(prefix, start_id=0):
     def run(starting_from_here=False):
         return cmdline(
-            join(orthomcl_bin_dir, 'orthomclMclToGroups.pl'),
+            orthomcl_script('orthomclMclToGroups.pl'),
             parameters=[prefix + '_', start_id],
             stdin=config.mcl_output,
             stdout=config.groups_file)
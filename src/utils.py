@@ -11,7 +11,7 @@ import tarfile
 import shutil
 import sys
 import config
-from config import config_file, orthomcl_config_final_path, log_fname, mcl_dir, \
+from config import orthomcl_config_final_path, log_fname, mcl_dir, \
     mysql_cnf, mysql_linux_tar, mysql_osx_tar, mysql_extracted_dir, src_dir
 import logging
 from Workflow import cmdline
@@ -371,6 +371,27 @@ def read_list(file, where_to_save=None):
     return results
 
 
+def _first_line(fpath, max_lines=100):
+    with open(fpath) as f:
+        for i, line in enumerate(f):
+            if line.strip() or i >= max_lines:
+                return line
+    return ''
+
+
+def is_fasta(fpath):
+    """ Checks only the first line, like ">id description".
+    """
+    return _first_line(fpath).startswith('>')
+
+
+def is_genbank(fpath):
+    """ Checks only the LOCUS line; the file is parsed later by make_proteomes.
+    """
+    fields = _first_line(fpath).split()
+    return len(fields) >= 2 and fields[0] == 'LOCUS'
+
+
 def test_entrez_conn():
     return test_internet_conn('http://eutils.ncbi.nlm.nih.gov/entrez')
 
@@ -394,21 +415,18 @@ def test_internet_conn(url):
         return True
 
 
-def set_up_config(output_dir):
-    with open(config_file) as cf:
-        conf = dict(
-            l.strip().split('=', 1) for l
-            in cf.readlines() if l.strip() and l.strip()[0] != '#')
-        log.debug('Read conf: ' + str(conf))
+def set_up_config(output_dir, settings=None):
+    conf = settings or config.settings
+    log.debug('Settings: ' + repr(conf))
 
     with open(join(src_dir, config.orthomcl_config_fname)) as ocf:
         omcl_conf = dict(l.strip().split('=', 1) for l
                          in ocf.readlines() if l.strip() and l.strip()[0] != '#')
 
-    memory = int(conf['memory'])
+    memory = conf.memory
     tmp_dir = realpath(join(config.intermediate_dir, 'tmp'))
 
-    if conf['db_vendor'] == 'sqlite':
+    if conf.db_vendor == 'sqlite':
         db_file = join(output_dir, config.sqlite_file)
 
         omcl_conf['dbVendor'] = 'sqlite'
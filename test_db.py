@@ -10,8 +10,7 @@ import sys
 from site import addsitedir
 addsitedir(join(realpath(__file__), 'src', 'mysql'))
 
-with open(config.config_file) as f:
-    conf = dict(l.strip().split('=', 1) for l in f.readlines() if l.strip() and l.strip()[0] != '#')
+conf = config.settings
 db_login = conf['db_login']
 db_passw = conf['db_password']
 db_port = conf['db_port']
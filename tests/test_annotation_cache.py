@@ -0,0 +1,202 @@
+""" Fetching annotations through the annotation cache, with efetch answered
+    by a local HTTP server instead of NCBI.
+
+    Run from the root directory: python -m unittest discover tests
+"""
+import BaseHTTPServer
+import SocketServer
+import os
+import tempfile
+import threading
+import time
+import unittest
+import urllib2
+import urlparse
+from os.path import join, isfile
+from shutil import rmtree
+
+from src import annotation_cache, fetch_annotations
+
+
+EUTILS_URL = 'https://eutils.ncbi.nlm.nih.gov'
+
+RECORD = '''LOCUS       %(accession)s               60 bp    DNA     linear   CON 01-JAN-2015
+DEFINITION  Test organism %(accession)s, complete genome.
+ACCESSION   %(accession)s
+VERSION     %(accession)s.1  GI:%(gi)d
+FEATURES             Location/Qualifiers
+     source          1..60
+     gene            1..30
+     CDS             1..30
+ORIGIN
+        1 atgaaacgca ttagcaccac cattaccacc accatcacca ttaccacagg taacggtgcg
+//
+'''
+
+
+def record(accession):
+    return RECORD % dict(accession=accession, gi=int(accession[3:]))
+
+
+class _EntrezHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Answers efetch with the records of the requested accession.versions.
+    """
+    def do_GET(self):
+        self.respond(urlparse.urlparse(self.path).query)
+
+    def do_POST(self):
+        self.respond(self.rfile.read(int(self.headers['Content-Length'])))
+
+    def respond(self, query):
+        ids = urlparse.parse_qs(query)['id'][0].split(',')
+        self.server.requests.append(ids)
+        time.sleep(self.server.delay)
+        if [i for i in ids if i.split('.')[0] not in self.server.accessions]:
+            self.send_error(400)
+            return
+        body = ''.join(record(i.split('.')[0]) + '\n' for i in ids)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _EntrezServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, accessions):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _EntrezHandler)
+        self.accessions = accessions
+        self.requests = []
+        self.delay = 0
+
+
+class _ToLocalServer(urllib2.BaseHandler):
+    """ Sends the requests for NCBI E-utilities to the local server.
+    """
+    handler_order = 100  # before HTTPSHandler
+
+    def __init__(self, port):
+        self.url = 'http://127.0.0.1:%d' % port
+        self.opener = urllib2.build_opener(urllib2.ProxyHandler({}))
+
+    def https_open(self, req):
+        if not req.get_full_url().startswith(EUTILS_URL):
+            return None
+        return self.opener.open(urllib2.Request(
+            self.url + req.get_full_url()[len(EUTILS_URL):], req.get_data()))
+
+
+class AnnotationCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = join(self.tmp_dir, 'cache')
+        self.previous_cache_dir = os.environ.get('ORTHOFINDER_ANNOTATION_CACHE')
+        os.environ['ORTHOFINDER_ANNOTATION_CACHE'] = self.cache_dir
+
+        self.server = _EntrezServer(['NC_000001', 'NC_000002'])
+        threading.Thread(target=self.server.serve_forever).start()
+        urllib2.install_opener(urllib2.build_opener(_ToLocalServer(self.server.server_address[1])))
+
+    def tearDown(self):
+        urllib2.install_opener(None)
+        self.server.shutdown()
+        self.server.server_close()
+        if self.previous_cache_dir is None:
+            del os.environ['ORTHOFINDER_ANNOTATION_CACHE']
+        else:
+            os.environ['ORTHOFINDER_ANNOTATION_CACHE'] = self.previous_cache_dir
+        rmtree(self.tmp_dir)
+
+    def fetch(self, name, ref_ids):
+        """ Fetches into a new annotations directory, returns its path.
+        """
+        annotations_dir = join(self.tmp_dir, name)
+        self.assertEqual(fetch_annotations.fetch_annotations_for_ids(annotations_dir, ref_ids), 0)
+        return annotations_dir
+
+    def cached_objects(self):
+        objects_dir = join(self.cache_dir, 'objects')
+        return [join(objects_dir, d, f) for d in os.listdir(objects_dir)
+                for f in os.listdir(join(objects_dir, d))]
+
+    def test_miss_then_hit(self):
+        first_dir = self.fetch('first', ['NC_000001.1', 'NC_000002.1'])
+        self.assertEqual(self.server.requests, [['NC_000001.1', 'NC_000002.1']])
+        for accession in ['NC_000001', 'NC_000002']:
+            with open(join(first_dir, accession + '.1.gb')) as f:
+                self.assertEqual(f.read(), record(accession))
+        self.assertEqual(len(self.cached_objects()), 2)
+
+        second_dir = self.fetch('second', ['NC_000001.1', 'NC_000002.1'])
+        self.assertEqual(len(self.server.requests), 1)
+        linked = [os.stat(join(second_dir, a + '.1.gb')).st_ino for a in ['NC_000001', 'NC_000002']]
+        self.assertEqual(sorted(linked), sorted(os.stat(o).st_ino for o in self.cached_objects()))
+
+    def test_copy_when_link_fails(self):
+        self.fetch('first', ['NC_000001.1'])
+
+        def link(src, dst):
+            raise OSError(18, 'Invalid cross-device link')
+        real_link, annotation_cache.link = annotation_cache.link, link
+        try:
+            second_dir = self.fetch('second', ['NC_000001.1'])
+        finally:
+            annotation_cache.link = real_link
+
+        self.assertEqual(len(self.server.requests), 1)
+        gb_fpath = join(second_dir, 'NC_000001.1.gb')
+        self.assertNotEqual(os.stat(gb_fpath).st_ino, os.stat(self.cached_objects()[0]).st_ino)
+        with open(gb_fpath) as f:
+            self.assertEqual(f.read(), record('NC_000001'))
+
+    def test_concurrent_fill(self):
+        self.server.delay = 0.5  # both runs miss the cache and store the record
+        threads = [threading.Thread(target=self.fetch, args=(name, ['NC_000001.1']))
+                   for name in ['first', 'second']]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(self.server.requests, [['NC_000001.1'], ['NC_000001.1']])
+        for name in ['first', 'second']:
+            with open(join(self.tmp_dir, name, 'NC_000001.1.gb')) as f:
+                self.assertEqual(f.read(), record('NC_000001'))
+        self.assertEqual(len(self.cached_objects()), 1)  # and no temporary files
+
+        third_dir = self.fetch('third', ['NC_000001.1'])
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertTrue(isfile(join(third_dir, 'NC_000001.1.gb')))
+
+    def test_lru_eviction(self):
+        gb_dir = join(self.tmp_dir, 'gb')
+        os.mkdir(gb_dir)
+        for accession in ['NC_000001', 'NC_000002', 'NC_000003']:
+            with open(join(gb_dir, accession + '.gb'), 'w') as f:
+                f.write(record(accession))
+
+        cache = annotation_cache.AnnotationCache(self.cache_dir, int(len(record('NC_000001')) * 2.5))
+        try:
+            cache.put(join(gb_dir, 'NC_000001.gb'))
+            time.sleep(0.01)
+            cache.put(join(gb_dir, 'NC_000002.gb'))
+            time.sleep(0.01)
+            self.assertTrue(cache.get('NC_000001.1', join(gb_dir, 'used.gb')))
+            time.sleep(0.01)
+            cache.put(join(gb_dir, 'NC_000003.gb'))
+
+            self.assertFalse(cache.get('NC_000002.1', join(gb_dir, 'evicted.gb')))
+            self.assertTrue(cache.get('NC_000001.1', join(gb_dir, 'kept.gb')))
+            self.assertTrue(cache.get('NC_000003.1', join(gb_dir, 'newest.gb')))
+            self.assertEqual(len(self.cached_objects()), 2)
+        finally:
+            cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+""" JobTracker following jobs run as local processes by LocalScheduler,
+    and SgeScheduler with qstat and qacct replaced by scripts.
+
+    Run from the root directory: python -m unittest discover tests
+"""
+import os
+import signal
+import tempfile
+import unittest
+from os.path import join
+from shutil import rmtree
+from time import time, sleep
+
+from src.cluster import Job, JobTracker, LocalScheduler, SgeScheduler, RUNNING, FINISHED
+
+
+# Every run of a runner counts its attempt in <name>.attempts
+RUNNER = '''cd %(tmp_dir)s
+attempt=$(( $(cat %(name)s.attempts 2>/dev/null || echo 0) + 1 ))
+echo $attempt > %(name)s.attempts
+%(body)s
+'''
+
+
+class JobTrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.scheduler = LocalScheduler()
+        self.tracker = JobTracker(self.scheduler, poll_interval=0.1, max_attempts=3,
+                                  straggler_factor=3.0)
+
+    def tearDown(self):
+        for job_id in self.scheduler.processes:
+            self.scheduler.cancel(job_id)
+        rmtree(self.tmp_dir)
+
+    def job(self, name, body):
+        runner_fpath = join(self.tmp_dir, name + '.sh')
+        with open(runner_fpath, 'w') as f:
+            f.write(RUNNER % dict(tmp_dir=self.tmp_dir, name=name, body=body))
+        return Job(name, runner_fpath, join(self.tmp_dir, name + '.log'))
+
+    def attempts(self, name):
+        with open(join(self.tmp_dir, name + '.attempts')) as f:
+            return int(f.read())
+
+    def test_finish_resubmit_and_straggler(self):
+        finishing = self.job('finishing', 'exit 0')
+        failing_once = self.job('failing_once', '[ $attempt -gt 1 ]')
+        straggler = self.job('straggler', '[ $attempt -gt 1 ] || sleep 60')
+
+        started = time()
+        self.assertEqual(self.tracker.run([finishing, failing_once, straggler]), 0)
+        self.assertTrue(time() - started < 30, 'the straggler has been waited for')
+
+        self.assertTrue(finishing.done)
+        self.assertEqual((finishing.attempts, self.attempts('finishing')), (1, 1))
+
+        self.assertTrue(failing_once.done)
+        self.assertEqual((failing_once.attempts, self.attempts('failing_once')), (2, 2))
+
+        self.assertTrue(straggler.done)
+        self.assertEqual((straggler.attempts, self.attempts('straggler')), (2, 2))
+        first, second = straggler.job_ids
+        self.assertEqual(self.scheduler.processes[first].returncode, -signal.SIGTERM)
+        self.assertEqual(self.scheduler.processes[second].returncode, 0)
+
+    def test_giving_up(self):
+        failing = self.job('failing', 'exit 3')
+        running = self.job('running', 'sleep 60')
+
+        self.assertEqual(self.tracker.run([failing, running]), 1)
+        self.assertTrue(failing.failed)
+        self.assertEqual((failing.attempts, self.attempts('failing')), (3, 3))
+        self.assertFalse(running.done)
+        self.assertEqual(self.scheduler.processes[running.job_ids[0]].returncode, -signal.SIGTERM)
+
+
+# No jobs in the queue; qacct has the record of a job once <job id>.done exists
+QSTAT = '''#!/bin/sh
+echo "job-ID  prior   name       user         state"
+echo "------------------------------------------------"
+'''
+QACCT = '''#!/bin/sh
+[ -f %(tmp_dir)s/$2.done ] || { echo "error: job id $2 not found" >&2; exit 1; }
+echo "failed       0"
+echo "exit_status  0"
+'''
+
+
+class SgeSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        for name, script in [('qstat', QSTAT), ('qacct', QACCT)]:
+            with open(join(self.tmp_dir, name), 'w') as f:
+                f.write(script % dict(tmp_dir=self.tmp_dir))
+            os.chmod(join(self.tmp_dir, name), 0755)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = self.tmp_dir + os.pathsep + self.path
+        self.scheduler = SgeScheduler()
+        self.scheduler.accounting_delay = 0.5
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        rmtree(self.tmp_dir)
+
+    def test_waiting_for_accounting(self):
+        self.assertEqual(self.scheduler.states(['1', '2']),
+                         {'1': (RUNNING, None), '2': (RUNNING, None)})
+        open(join(self.tmp_dir, '1.done'), 'w').close()
+        self.assertEqual(self.scheduler.states(['1', '2']),
+                         {'1': (FINISHED, 0), '2': (RUNNING, None)})
+        sleep(0.6)
+        self.assertEqual(self.scheduler.states(['2']), {'2': (FINISHED, None)})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+""" The numpy pairs engine (native_pairs) against orthomclPairs.pl.
+
+    Every directory in data/pairs holds similar_sequences.txt and, in
+    expected/, the files orthomclPairs.pl and orthomclDumpPairsFiles.pl
+    made of it: test_input has the similarities between the proteins of
+    test_input/proteins and test_input/new_proteins_1 (parsed by
+    blast_parser), coorthologs a few made up ones that give coorthologs.
+    The scripts were run unchanged, but without DBD::SQLite: a stand-in DBI
+    module passed their SQL statements to Python's sqlite3. When Perl with
+    DBI and DBD::SQLite is installed, the OrthoMCL scripts are run as well.
+
+    Run from the root directory: python -m unittest discover tests
+"""
+import subprocess
+import tempfile
+import unittest
+from os import listdir, makedirs
+from os.path import join, dirname, realpath
+from shutil import rmtree
+
+from src import config, native_pairs, sqlite_loader
+
+
+data_dir = join(dirname(realpath(__file__)), 'data', 'pairs')
+orthomcl_bin_dir = config.orthomcl_sqlite_bin_dir
+pairs_files = ['orthologs.txt', 'inparalogs.txt', 'coorthologs.txt']
+
+
+def _perl_available():
+    try:
+        return subprocess.call(
+            ['perl', '-I' + join(orthomcl_bin_dir, '..', 'lib', 'perl'),
+             '-MDBI', '-MDBD::SQLite', '-e', '1'],
+            stdout=open('/dev/null', 'w'), stderr=subprocess.STDOUT) == 0
+    except OSError:
+        return False
+
+perl_available = _perl_available()
+
+
+def _sorted_lines(fpath):
+    with open(fpath) as f:
+        return sorted(f)
+
+
+def _write_orthomcl_config(fpath, sqlite_fpath):
+    """ src/orthomcl.config with the database set as utils.set_up_config does.
+    """
+    with open(join(config.src_dir, config.orthomcl_config_fname)) as f:
+        conf = dict(l.strip().split('=', 1) for l in f if '=' in l)
+    conf['dbVendor'] = 'sqlite'
+    conf['dbConnectString'] = 'DBI:SQLite:' + sqlite_fpath
+    with open(fpath, 'w') as f:
+        for key, value in conf.items():
+            f.write(key + '=' + value + '\n')
+
+
+class PairsEnginesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def work_dir(self, name):
+        """ A directory with orthomcl.config for the SQLite database in it.
+        """
+        work_dir = join(self.tmp_dir, name)
+        makedirs(work_dir)
+        _write_orthomcl_config(join(work_dir, 'orthomcl.config'), join(work_dir, 'sqlite.db'))
+        return work_dir
+
+    def numpy_pairs(self, similar_sequences, work_dir):
+        """ Writes mcl_input and pairs/ into work_dir.
+        """
+        evalue_exp_cutoff, percent_match_cutoff = native_pairs.read_cutoffs(
+            join(work_dir, 'orthomcl.config'))
+        res = native_pairs.find_pairs(
+            similar_sequences, join(work_dir, 'mcl_input'), join(work_dir, 'pairs'),
+            evalue_exp_cutoff, percent_match_cutoff)
+        self.assertEqual(res, 0)
+
+    def orthomcl_pairs(self, similar_sequences, work_dir):
+        """ Runs the steps of the orthomcl engine on SQLite, as steps.pairs_steps
+            does, writing mcl_input and pairs/ into work_dir.
+        """
+        orthomcl_config = join(work_dir, 'orthomcl.config')
+        log = open(join(work_dir, 'orthomcl.log'), 'w')
+
+        def run(script, *parameters):
+            res = subprocess.call(['perl', join(orthomcl_bin_dir, script)] + list(parameters),
+                                  cwd=work_dir, stdout=log, stderr=subprocess.STDOUT)
+            self.assertEqual(res, 0, script + ' returned ' + str(res))
+
+        try:
+            run('orthomclInstallSchema.pl', orthomcl_config, join(work_dir, 'log.sql'), '')
+            sqlite_loader.load_similar_sequences(
+                join(work_dir, 'sqlite.db'), sqlite_loader.file_blocks(similar_sequences))
+            run('orthomclPairs.pl', orthomcl_config, join(work_dir, 'orthomclpairs.log'),
+                'cleanup=no', 'suffix=*')
+            run('orthomclDumpPairsFiles.pl', orthomcl_config, join(work_dir, 'mcl_input'), work_dir, '')
+        finally:
+            log.close()
+
+    def assertSamePairs(self, expected_dir, work_dir):
+        for fpath in [join('pairs', fname) for fname in pairs_files] + ['mcl_input']:
+            self.assertEqual(_sorted_lines(join(expected_dir, fpath)),
+                             _sorted_lines(join(work_dir, fpath)), fpath + ' differs')
+
+    @unittest.skipUnless(native_pairs.is_available(), 'NumPy is not installed')
+    def test_numpy_engine(self):
+        for name in sorted(listdir(data_dir)):
+            work_dir = self.work_dir('numpy_' + name)
+            self.numpy_pairs(join(data_dir, name, 'similar_sequences.txt'), work_dir)
+            self.assertSamePairs(join(data_dir, name, 'expected'), work_dir)
+
+    @unittest.skipUnless(perl_available, 'Perl with DBI and DBD::SQLite is not installed')
+    def test_orthomcl_engine(self):
+        for name in sorted(listdir(data_dir)):
+            work_dir = self.work_dir('orthomcl_' + name)
+            self.orthomcl_pairs(join(data_dir, name, 'similar_sequences.txt'), work_dir)
+            self.assertSamePairs(join(data_dir, name, 'expected'), work_dir)
+
+    @unittest.skipUnless(native_pairs.is_available() and perl_available,
+                         'NumPy or Perl with DBI and DBD::SQLite is not installed')
+    def test_engines_agree(self):
+        similar_sequences = join(data_dir, 'test_input', 'similar_sequences.txt')
+        numpy_dir, orthomcl_dir = self.work_dir('numpy'), self.work_dir('orthomcl')
+        self.numpy_pairs(similar_sequences, numpy_dir)
+        self.orthomcl_pairs(similar_sequences, orthomcl_dir)
+        self.assertSamePairs(orthomcl_dir, numpy_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()